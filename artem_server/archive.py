@@ -0,0 +1,125 @@
+# archive.py - Месячные архивы старых сообщений (отдельные файлы SQLite)
+#
+# Архивная задача переносит из messages самые старые сообщения (по возрастанию id)
+# в файлы messages_ГГГГ_ММ.db по месяцу отправки. Поэтому все id в архивах
+# меньше любого id в основной базе, а более поздний месяц - более поздние id.
+# Какие пары собеседников есть в каком месяце, записано в основной базе
+# (таблица message_archives), чтобы не открывать архивы без их сообщений.
+from collections import OrderedDict
+from pathlib import Path
+
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS {schema}.messages (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        timestamp TIMESTAMP
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_messages_pair ON messages(sender_id, receiver_id)",
+]
+
+# Полнотекстовый индекс архива - как migrations.py (миграция 4 server.py).
+# Архив только пополняется, поэтому нужен лишь триггер на вставку
+ARCHIVE_FTS_SCHEMA = [
+    '''
+    CREATE VIEW IF NOT EXISTS {schema}.messages_fts_source AS
+    SELECT id, text, 'u' || sender_id || ' u' || receiver_id AS members
+    FROM messages
+    ''',
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.messages_fts USING fts5(
+        text, members, content='messages_fts_source', content_rowid='id'
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS {schema}.messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text, members)
+        VALUES (new.id, new.text, 'u' || new.sender_id || ' u' || new.receiver_id);
+    END
+    ''',
+]
+
+
+def ensure_fts(conn, schema):
+    """Создать полнотекстовый индекс в подключенном на запись архиве, если его нет.
+
+    Архивы, записанные до появления индекса, индексируются целиком (rebuild).
+    """
+    exists = conn.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'messages_fts'").fetchone()
+    if exists:
+        return False
+    for sql in ARCHIVE_FTS_SCHEMA:
+        conn.execute(sql.format(schema=schema))
+    conn.execute(f"INSERT INTO {schema}.messages_fts (messages_fts) VALUES ('rebuild')")
+    return True
+
+
+class MessageArchive:
+    """Каталог с месячными архивами и подключенные к соединению архивы.
+
+    Архивы подключаются (ATTACH, только чтение) по требованию; одновременно
+    держится не больше max_attached, самый давно использованный отключается.
+    """
+
+    def __init__(self, conn, directory, max_attached=6):
+        self.conn = conn
+        self.directory = Path(directory)
+        self.max_attached = max_attached
+        self.attached = OrderedDict()  # месяц "ГГГГ_ММ" -> имя схемы
+
+    def path(self, month):
+        return self.directory / f"messages_{month}.db"
+
+    def months(self, pairs):
+        """Месяцы с архивными сообщениями пар (sender_id, receiver_id), от новых к старым"""
+        condition = " OR ".join(["(sender_id = ? AND receiver_id = ?)"] * len(pairs))
+        rows = self.conn.execute(
+            f"SELECT DISTINCT month FROM main.message_archives WHERE {condition} ORDER BY month DESC",
+            [value for pair in pairs for value in pair])
+        return [row[0] for row in rows]
+
+    def user_months(self, user_id):
+        """Месяцы с архивными сообщениями пользователя (любой стороны), от новых к старым"""
+        rows = self.conn.execute('''
+            SELECT month FROM main.message_archives WHERE sender_id = ?
+            UNION
+            SELECT month FROM main.message_archives WHERE receiver_id = ?
+            ORDER BY month DESC
+        ''', (user_id, user_id))
+        return [row[0] for row in rows]
+
+    def index_all(self):
+        """Добавить полнотекстовый индекс архивам, созданным без него; вернуть их число"""
+        indexed = 0
+        for path in sorted(self.directory.glob("messages_*.db")):
+            self.conn.execute("ATTACH DATABASE ? AS archive_index", (str(path),))
+            try:
+                indexed += ensure_fts(self.conn, "archive_index")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.execute("DETACH DATABASE archive_index")
+        return indexed
+
+    def attach(self, month):
+        """Подключить архив месяца только для чтения, вернуть имя схемы"""
+        schema = self.attached.get(month)
+        if schema is not None:
+            self.attached.move_to_end(month)
+            return schema
+
+        while len(self.attached) >= self.max_attached:
+            _, old_schema = self.attached.popitem(last=False)
+            self.conn.execute(f"DETACH DATABASE {old_schema}")
+
+        schema = f"archive_{month}"
+        uri = self.path(month).absolute().as_uri() + "?mode=ro"
+        self.conn.execute("ATTACH DATABASE ? AS " + schema, (uri,))
+        self.attached[month] = schema
+        return schema
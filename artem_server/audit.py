@@ -0,0 +1,105 @@
+# audit.py - Фоновая запись журнала действий (audit_log)
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+AUDIT_COLUMNS = "user_id, action_type, target_id, target_type, details, ip_address, timestamp"
+
+
+class AuditWriter:
+    """Журнал действий без commit() на горячем пути.
+
+    append() только кладет строку в ограниченную очередь; поток-писатель
+    забирает ее пачками и вставляет через executemany одной транзакцией.
+    При переполнении очереди overflow="drop" выбрасывает новые записи
+    (счетчик dropped), overflow="flush" ждет, пока писатель сбросит пачку.
+    close() дописывает все, что уже в очереди; вызывается и при выходе.
+    """
+
+    def __init__(self, db_name, max_queue=10000, batch_size=500,
+                 flush_interval=0.5, overflow="drop"):
+        if overflow not in ("drop", "flush"):
+            raise ValueError(f"Неизвестная политика переполнения: {overflow}")
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+
+        self.conn = sqlite3.connect(db_name, check_same_thread=False, timeout=30)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action_type TEXT NOT NULL,
+            target_id INTEGER,
+            target_type TEXT,
+            details TEXT,
+            ip_address TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_time ON audit_log(timestamp)")
+        self.conn.commit()
+
+        self.thread = threading.Thread(target=self.run, name="audit-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def append(self, user_id, action_type, target_id=None, target_type=None,
+               details="", ip_address=None):
+        """Поставить запись в очередь и сразу вернуться"""
+        # Время фиксируем в момент действия, а не в момент записи пачки
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        row = (user_id, action_type, target_id, target_type, details, ip_address, timestamp)
+        try:
+            self.queue.put(row, block=self.overflow == "flush")
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                print(f"⚠️ Очередь журнала переполнена, пропущено записей: {self.dropped}")
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            batch = []
+            # Копим пачку не дольше flush_interval: не чаще одного commit за интервал
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.write(batch)
+
+    def write(self, batch):
+        try:
+            self.conn.executemany(
+                f"INSERT INTO audit_log ({AUDIT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            self.conn.commit()
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.dropped += len(batch)
+            print(f"❌ Ошибка записи журнала ({len(batch)} записей): {e}")
+
+    def close(self):
+        """Дописать очередь и остановить поток"""
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.conn.close()
+        atexit.unregister(self.close)
@@ -0,0 +1,362 @@
+# backup.py - Выгрузка и загрузка базы сервера в NDJSON
+#
+# Примеры:
+#   python backup.py export artem_messenger.db backup.ndjson.gz
+#   python backup.py import backup.ndjson.gz restored.db
+#   python backup.py export artem_messenger.db - --gzip > backup.ndjson.gz
+#   python backup.py import backup.ndjson.gz restored.db --shards 4
+#
+# Формат: первая строка - заголовок {"type": "header", "format": "artem-ndjson", ...},
+# дальше по строке на запись: {"type": "<таблица>", <колонка>: <значение>, ...}.
+# Файл с суффиксом .gz (или с флагом --gzip) сжат gzip.
+# Обе команды работают потоково: память не зависит от размера базы.
+# Сообщения из месячных архивов выгружаются вместе с остальными и при загрузке
+# попадают в основную базу (архивная задача перенесет их снова). Поэтому таблица
+# message_archives (какие месяцы у какой пары) не выгружается: после загрузки
+# архивов еще нет, архивная задача заполнит ее заново.
+# База с шардами (ARTEM_DB_SHARDS, файлы <база>.shard<N>.db рядом) выгружается
+# вместе с сообщениями и беседами всех шардов, в заголовке - их число. Загрузка
+# по умолчанию раскладывает их по стольким же новым шардам (--shards 0 -
+# все в одну базу).
+import argparse
+import gzip
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import config
+from migrations import get_version
+from server import Database
+from sharding import MessageShard, shard_index, shard_path
+
+FORMAT = "artem-ndjson"
+VERSION = 1
+
+# Таблицы в порядке выгрузки и их ключи для постраничного чтения
+TABLES = {
+    "users": ("id",),
+    "sessions": ("id",),
+    "blocks": ("id",),
+    "messages": ("id",),
+    "conversations": ("user_id", "peer_id"),
+    "chats": ("id",),
+    "chat_members": ("chat_id", "user_id"),
+    "chat_messages": ("id",),
+}
+
+# Таблицы, которые с шардами лежат в файлах шардов, и колонки пары собеседников
+SHARDED_TABLES = {
+    "messages": ("sender_id", "receiver_id"),
+    "conversations": ("user_id", "peer_id"),
+}
+
+CHUNK_SIZE = 10000          # строк на один запрос при выгрузке
+READ_CHUNK = 4 * 1024 * 1024  # байт NDJSON на один json.loads при загрузке
+BATCH_SIZE = 50000          # строк на один executemany при загрузке
+COMMIT_EVERY = 1000000      # строк на транзакцию при загрузке
+
+
+def open_stream(path, mode, compress=None):
+    """Файл или stdin/stdout ("-") в текстовом режиме, при необходимости через gzip"""
+    if compress is None:
+        compress = path.endswith(".gz")
+    if path == "-":
+        raw = sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+        if compress:
+            return gzip.open(raw, mode + "t", encoding="utf-8", compresslevel=6)
+        return sys.stdin if mode == "r" else sys.stdout
+    if compress:
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_table(conn, table, key, chunk_size=CHUNK_SIZE):
+    """Строки таблицы кусками по chunk_size с курсором по ключу (без OFFSET).
+
+    Первым отдает список колонок, дальше - кортежи строк.
+    """
+    key_columns = ", ".join(key)
+    cursor = conn.execute(f"SELECT * FROM {table} ORDER BY {key_columns} LIMIT ?", (chunk_size,))
+    columns = [column[0] for column in cursor.description]
+    yield columns
+
+    positions = [columns.index(name) for name in key]
+    placeholders = ", ".join("?" * len(key))
+    while True:
+        rows = cursor.fetchall()
+        yield from rows
+        if len(rows) < chunk_size:
+            break
+        last = [rows[-1][i] for i in positions]
+        cursor = conn.execute(f'''
+        SELECT * FROM {table} WHERE ({key_columns}) > ({placeholders})
+        ORDER BY {key_columns} LIMIT ?
+        ''', (*last, chunk_size))
+
+
+def write_table(out, table, rows):
+    """Записать строки из iter_table как NDJSON, вернуть их число"""
+    columns = next(rows)
+    prefix = f'{{"type": "{table}", '
+    count = 0
+    for row in rows:
+        # {"type": ..., "id": ..., ...} без промежуточного словаря с "type"
+        out.write(prefix)
+        out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False)[1:])
+        out.write("\n")
+        count += 1
+    return count
+
+
+def iter_records(source, chunk_bytes=READ_CHUNK):
+    """Записи NDJSON по одной, декодированные пачками строк.
+
+    Один json.loads на пачку ("[строка,строка,...]") заметно быстрее вызова
+    на каждую строку; пачка с пустыми или испорченными строками разбирается
+    построчно, чтобы ошибка указывала на конкретную строку.
+    """
+    while True:
+        lines = source.readlines(chunk_bytes)
+        if not lines:
+            return
+        try:
+            records = json.loads("[" + ",".join(lines) + "]")
+        except json.JSONDecodeError:
+            records = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"Испорченная строка выгрузки: {line[:100]!r} ({e})")
+        yield from records
+
+
+def shard_files(db_name):
+    """Файлы шардов базы по порядку, пустой список - база без шардов"""
+    files = []
+    while Path(shard_path(db_name, len(files))).exists():
+        files.append(shard_path(db_name, len(files)))
+    return files
+
+
+def export_database(db_name, out, archive_dir=None):
+    """Выгрузить пользователей, сессии, сообщения (с архивами), сводку бесед и чаты"""
+    uri = Path(db_name).absolute().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    archive_dir = Path(archive_dir or config.ARCHIVE_DIR or Path(db_name).absolute().parent / "archive")
+    shards = shard_files(db_name)
+    counts = {}
+    try:
+        header = {"type": "header", "format": FORMAT, "version": VERSION,
+                  "schema_version": get_version(conn)}
+        if shards:
+            header["shards"] = len(shards)
+        out.write(json.dumps(header) + "\n")
+
+        # Один снимок основной базы на всю выгрузку (WAL: сервер может продолжать писать)
+        conn.execute("BEGIN")
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table, key in TABLES.items():
+            if table in tables:
+                counts[table] = write_table(out, table, iter_table(conn, table, key))
+
+        months = []
+        if "message_archives" in tables:
+            months = [row[0] for row in conn.execute(
+                "SELECT DISTINCT month FROM message_archives ORDER BY month")]
+        conn.rollback()
+
+        # Архивы читаются после снимка: сообщение, перенесенное во время выгрузки,
+        # попадет в файл дважды (загрузка пропускает повторы), но не потеряется
+        for month in months:
+            path = archive_dir / f"messages_{month}.db"
+            archive = sqlite3.connect(path.absolute().as_uri() + "?mode=ro", uri=True)
+            try:
+                counts["messages"] = counts.get("messages", 0) + write_table(
+                    out, "messages", iter_table(archive, "messages", ("id",)))
+            finally:
+                archive.close()
+
+        # Сообщения и беседы шардов - свой снимок у каждого файла
+        for path in shards:
+            shard = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+            try:
+                shard.execute("BEGIN")
+                for table, key in TABLES.items():
+                    if table in SHARDED_TABLES:
+                        counts[table] = counts.get(table, 0) + write_table(
+                            out, table, iter_table(shard, table, key))
+            finally:
+                shard.close()
+    finally:
+        conn.close()
+    return counts
+
+
+def defer_indexes(conn, tables):
+    """Снять индексы и триггеры (в т.ч. FTS) таблиц tables на время загрузки,
+    вернуть их SQL для восстановления"""
+    deferred = conn.execute(f'''
+    SELECT type, name, sql FROM sqlite_master
+    WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+      AND tbl_name IN ({", ".join("?" * len(tables))})
+    ''', list(tables)).fetchall()
+    for kind, name, _ in deferred:
+        conn.execute(f"DROP {kind.upper()} {name}")
+    return [sql for _, _, sql in deferred]
+
+
+def import_database(source, db_name, batch_size=BATCH_SIZE, commit_every=COMMIT_EVERY, shards=None):
+    """Загрузить NDJSON в новую базу: executemany большими транзакциями,
+    вторичные индексы и полнотекстовый индекс строятся один раз в конце.
+    shards - число новых шардов для сообщений и бесед (None - как в выгрузке,
+    0 - все в основной базе).
+    Возвращает {таблица: (загружено, пропущено повторов)}.
+    """
+    if Path(db_name).exists():
+        raise ValueError(f"Файл {db_name} уже существует: загрузка идет только в новую базу")
+    header = json.loads(source.readline() or "{}")
+    if header.get("type") != "header" or header.get("format") != FORMAT:
+        raise ValueError("Это не выгрузка ARTEM (нет заголовка)")
+    if header.get("version", 0) > VERSION:
+        raise ValueError(f"Выгрузка версии {header['version']} новее этой программы")
+    shards = header.get("shards", 0) if shards is None else shards
+    if shards < 0:
+        raise ValueError(f"Число шардов не может быть отрицательным: {shards}")
+    existing = [shard_path(db_name, index) for index in range(shards)
+                if Path(shard_path(db_name, index)).exists()]
+    if existing:
+        raise ValueError(f"Файл {existing[0]} уже существует: загрузка идет только в новую базу")
+
+    db = Database(db_name, synchronous="OFF", default_users=False)
+    # targets[0] - основная база, targets[1 + N] - шард N
+    targets = [db] + [MessageShard(shard_path(db_name, index), synchronous="OFF")
+                      for index in range(shards)]
+    try:
+        target_columns = [
+            {table: {row[1] for row in target.conn.execute(f"PRAGMA table_info({table})")}
+             for table in (TABLES if index == 0 else SHARDED_TABLES)}
+            for index, target in enumerate(targets)
+        ]
+        deferred = [defer_indexes(target.conn, target_columns[index])
+                    for index, target in enumerate(targets)]
+
+        counts = {table: [0, 0] for table in TABLES}
+        batches = {}  # (таблица, колонки, номер target) -> строки
+        checked = {}  # (таблица, колонки записи) -> колонки, которые пишутся
+        since_commit = 0
+
+        def flush(table, columns, index):
+            batch = batches.pop((table, columns, index))
+            cursor = targets[index].conn.executemany(
+                f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})", batch)
+            counts[table][0] += cursor.rowcount
+            counts[table][1] += len(batch) - cursor.rowcount
+
+        for record in iter_records(source):
+            table = record.pop("type", None)
+            columns = tuple(record)
+            layout = checked.get((table, columns))
+            if layout is None:
+                if table not in TABLES:
+                    raise ValueError(f"Неизвестный тип записи: {table}")
+                unknown = set(columns) - target_columns[0][table]
+                if unknown:
+                    raise ValueError(f"Неизвестные колонки {table}: {', '.join(sorted(unknown))}")
+                layout = columns
+                if shards and table in SHARDED_TABLES:
+                    # В шардах нет устаревших колонок основной базы (messages.is_read)
+                    layout = tuple(column for column in columns if column in target_columns[1][table])
+                checked[(table, columns)] = layout
+            if shards and table in SHARDED_TABLES:
+                pair = SHARDED_TABLES[table]
+                index = 1 + shard_index(record[pair[0]], record[pair[1]], shards)
+                key = (table, layout, index)
+                row = tuple(record[column] for column in layout)
+            else:
+                key = (table, columns, 0)
+                row = tuple(record.values())
+            batch = batches.setdefault(key, [])
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush(*key)
+                since_commit += batch_size
+                if since_commit >= commit_every:
+                    for target in targets:
+                        target.conn.commit()
+                    since_commit = 0
+        for key in list(batches):
+            flush(*key)
+
+        for target, statements in zip(targets, deferred):
+            for sql in statements:
+                target.conn.execute(sql)
+            target.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            target.conn.commit()
+            target.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception:
+        for target in targets:
+            target.conn.rollback()
+        raise
+    finally:
+        for target in targets:
+            target.close()
+    return {table: tuple(count) for table, count in counts.items()}
+
+
+def cmd_export(args):
+    started = time.perf_counter()
+    with open_stream(args.output, "w", args.gzip or None) as out:
+        counts = export_database(args.db, out, args.archive_dir)
+    elapsed = time.perf_counter() - started
+    for table, count in counts.items():
+        print(f"✅ {table}: {count}", file=sys.stderr)
+    print(f"⏱️ Выгрузка за {elapsed:.1f} с", file=sys.stderr)
+
+
+def cmd_import(args):
+    started = time.perf_counter()
+    with open_stream(args.input, "r", args.gzip or None) as source:
+        counts = import_database(source, args.db, args.batch_size, args.commit_every, args.shards)
+    elapsed = time.perf_counter() - started
+    for table, (loaded, skipped) in counts.items():
+        print(f"✅ {table}: {loaded}" + (f" (пропущено повторов: {skipped})" if skipped else ""))
+    messages = counts["messages"][0]
+    print(f"⏱️ Загрузка за {elapsed:.1f} с, {messages / elapsed:.0f} сообщений/с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка базы ARTEM Messenger в NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="база -> NDJSON")
+    export.add_argument("db", help="файл базы сервера")
+    export.add_argument("output", help="файл выгрузки (.ndjson или .ndjson.gz), - для stdout")
+    export.add_argument("--gzip", action="store_true", help="сжимать gzip независимо от имени файла")
+    export.add_argument("--archive-dir", help="папка месячных архивов (по умолчанию archive рядом с базой)")
+    export.set_defaults(handler=cmd_export)
+
+    load = commands.add_parser("import", help="NDJSON -> новая база")
+    load.add_argument("input", help="файл выгрузки, - для stdin")
+    load.add_argument("db", help="новый файл базы")
+    load.add_argument("--gzip", action="store_true", help="файл сжат gzip независимо от имени")
+    load.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    load.add_argument("--commit-every", type=int, default=COMMIT_EVERY)
+    load.add_argument("--shards", type=int, help="число шардов новой базы (по умолчанию - как в выгрузке, 0 - без шардов)")
+    load.set_defaults(handler=cmd_import)
+
+    args = parser.parse_args()
+    try:
+        args.handler(args)
+    except ValueError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,796 @@
+# bench.py - Нагрузочные замеры сервера
+#
+# Примеры:
+#   python bench.py latency --clients 1000
+#   python bench.py latency --clients 1000 --url ws://localhost:8765
+#   python bench.py writes --messages 20000 --batch-sizes 1,32,128
+#   python bench.py shards --shards 1,4,8
+#   python bench.py plans
+#   python bench.py history --messages 1000000
+#   python bench.py pages --requests 5000
+#   python bench.py search --messages 10000000
+#   python bench.py users --users 1000000
+#   python bench.py logins --rate 500
+#   python bench.py logins --rate 500 --inline
+#   python bench.py channel --members 50000
+#
+# Без --url сервер поднимается в этом же процессе на временной базе.
+# Для сравнения "до/после" запустите замер с --url против старой версии сервера.
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import statistics
+import tempfile
+import time
+
+import websockets
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def print_latency(title, latencies):
+    print(f"📊 {title}: {len(latencies)} замеров")
+    if not latencies:
+        return
+    print(f"   среднее: {statistics.mean(latencies) * 1000:.2f} мс")
+    print(f"   p50:     {percentile(latencies, 50) * 1000:.2f} мс")
+    print(f"   p99:     {percentile(latencies, 99) * 1000:.2f} мс")
+    print(f"   max:     {max(latencies) * 1000:.2f} мс")
+
+
+class local_server:
+    """Сервер в текущем процессе на временной базе"""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        from server import ChatServer
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_name = os.path.join(self.tmpdir.name, "bench.db")
+        self.chat_server = ChatServer(db_name=db_name, **self.kwargs)
+        await self.chat_server.start()
+        self.ws_server = await websockets.serve(self.chat_server.handler, "localhost", 0)
+        port = self.ws_server.sockets[0].getsockname()[1]
+        return f"ws://localhost:{port}"
+
+    async def __aexit__(self, *exc):
+        self.ws_server.close()
+        await self.ws_server.wait_closed()
+        await self.chat_server.stop()
+        self.tmpdir.cleanup()
+
+
+class BenchClient:
+    """Клиент, который регистрируется и меряет время до message_sent"""
+
+    def __init__(self, url):
+        self.url = url
+        self.user_id = None
+        self.pending = []
+        self.latencies = []
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        name = "bench_" + secrets.token_hex(6)
+        await self.ws.send(json.dumps({
+            "type": "register",
+            "username": name,
+            "tag": "@" + name,
+            "password": "bench-password",
+        }))
+        while self.user_id is None:
+            data = json.loads(await self.ws.recv())
+            if data.get("type") == "register_success":
+                self.user_id = data["user_id"]
+            elif data.get("type") == "error":
+                raise RuntimeError(data["error"])
+        self.reader = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            async for message in self.ws:
+                data = json.loads(message)
+                if data.get("type") == "message_sent" and self.pending:
+                    self.latencies.append(time.perf_counter() - self.pending.pop(0))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def send(self, receiver_id, text):
+        self.pending.append(time.perf_counter())
+        await self.ws.send(json.dumps({
+            "type": "message",
+            "receiver_id": receiver_id,
+            "text": text,
+        }))
+
+    async def close(self):
+        await self.ws.close()
+        self.reader.cancel()
+
+
+async def connect_clients(url, count):
+    clients = [BenchClient(url) for _ in range(count)]
+    # Подключаемся пачками, чтобы не упереться в backlog сокета
+    for start in range(0, count, 100):
+        await asyncio.gather(*(c.connect() for c in clients[start:start + 100]))
+    return clients
+
+
+async def run_latency(url, clients_count, messages, interval):
+    clients = await connect_clients(url, clients_count)
+    user_ids = [c.user_id for c in clients]
+    print(f"✅ Подключено клиентов: {len(clients)}")
+
+    async def sender(client):
+        for i in range(messages):
+            await asyncio.sleep(random.uniform(0, interval))
+            await client.send(random.choice(user_ids), f"bench message {i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(c) for c in clients))
+
+    # Ждем подтверждения всех отправок
+    deadline = time.perf_counter() + 30
+    while any(c.pending for c in clients) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    latencies = [value for c in clients for value in c.latencies]
+    print_latency("Задержка отправки (до message_sent)", latencies)
+    print(f"   пропускная способность: {len(latencies) / elapsed:.0f} сообщений/с")
+
+    await asyncio.gather(*(c.close() for c in clients))
+
+
+async def cmd_latency(args):
+    if args.url:
+        await run_latency(args.url, args.clients, args.messages, args.interval)
+    else:
+        async with local_server() as url:
+            await run_latency(url, args.clients, args.messages, args.interval)
+
+
+async def run_writes(messages, concurrency, batch_size, flush_interval_ms, synchronous, storage):
+    from db_executor import AsyncDatabase, MessageBatcher
+    from server import STORAGE_ENGINES
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = AsyncDatabase(STORAGE_ENGINES[storage], os.path.join(tmpdir, "bench.db"),
+                           synchronous=synchronous)
+        batcher = MessageBatcher(db, batch_size=batch_size, flush_interval=flush_interval_ms / 1000)
+        batcher.start()
+
+        per_worker = messages // concurrency
+
+        async def worker(n):
+            for i in range(per_worker):
+                await batcher.save(1, 2 + n % 4, f"bench message {n}/{i}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        await batcher.stop()
+        db.close()
+
+    total = per_worker * concurrency
+    print(f"   {storage:<6} batch={batch_size:<5} synchronous={synchronous:<7} "
+          f"{total / elapsed:>10.0f} сообщений/с")
+
+
+async def cmd_writes(args):
+    print(f"📊 Запись {args.messages} сообщений, {args.concurrency} отправителей")
+    for batch_size in args.batch_sizes:
+        await run_writes(args.messages, args.concurrency, batch_size,
+                         args.flush_interval_ms, args.synchronous, args.storage)
+
+
+# Запросы, которым индекс не поможет: поиск подстроки LIKE '%...%'.
+# В сервере поиск пользователей идет по индексу в памяти (text_search.py)
+SCAN_ALLOWED = {"search_users"}
+
+
+def explain_calls(conn, calls):
+    """Выполнить вызовы [(имя, функция)] и показать план каждого SQL-запроса,
+    который они сделали. Возвращает запросы с полным сканированием: ["имя: SQL"]."""
+    scans = []
+    for name, call in calls:
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+
+        for sql in statements:
+            head = sql.lstrip().split(None, 1)[0].upper()
+            if head not in ("SELECT", "UPDATE", "DELETE", "WITH"):
+                continue
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            # "SCAN t USING INDEX" - обход по индексу под ORDER BY ... LIMIT, это нормально,
+            # как и обход уже ограниченного подзапроса и виртуальной таблицы FTS5
+            full_scans = [step for step in plan
+                          if step.startswith("SCAN") and "USING" not in step
+                          and "CONSTANT ROW" not in step and "(subquery" not in step
+                          and "VIRTUAL TABLE" not in step]
+            if full_scans and name in SCAN_ALLOWED:
+                mark = "➖ "
+            elif full_scans:
+                mark = "⚠️ "
+                scans.append(f"{name}: " + " ".join(sql.split()))
+            else:
+                mark = "✅ "
+            print(f"{mark}{name}: " + " ".join(sql.split())[:100])
+            for step in plan:
+                print("      " + step)
+    return scans
+
+
+def server_plan_calls(db):
+    """Горячие запросы Database из server.py на небольших данных: [(имя, функция)]"""
+    # Пароль проверяет сервер в пуле процессов, здесь только запросы входа
+    _, login = db.get_login_user("@anna")
+    login.pop("password_hash")
+    _, user = db.login_user(login)
+    user_id = user["user_id"]
+    db.save_messages([(user_id, 1, "привет из плана", "plan-1")])
+    _, chat = db.create_chat(user_id, "bench", member_ids=[1])
+    db.save_chat_message(chat.id, user_id, "сообщение в чате")
+    return [
+        ("get_login_user", lambda: db.get_login_user("@anna")),
+        ("login_user", lambda: db.login_user(login)),
+        ("verify_session", lambda: db.verify_session(user["session_token"])),
+        ("get_conversations", lambda: db.get_conversations(user_id)),
+        ("get_chat_history", lambda: db.get_chat_history(user_id, 1)),
+        ("get_user_by_id", lambda: db.get_user_by_id(user_id)),
+        ("get_users_by_ids", lambda: db.get_users_by_ids([1, user_id])),
+        ("save_messages", lambda: db.save_messages([(user_id, 1, "повтор", "plan-1")])),
+        ("search_messages", lambda: db.search_messages(user_id, "привет")),
+        ("search_users", lambda: db.search_users("an", user_id)),
+        ("get_chat", lambda: db.get_chat(chat.id)),
+        ("get_user_chats", lambda: db.get_user_chats(user_id)),
+        ("get_chat_messages", lambda: db.get_chat_messages(chat.id)),
+        ("next_session_expiry", lambda: db.next_session_expiry()),
+        ("delete_expired_sessions", lambda: db.delete_expired_sessions()),
+    ]
+
+
+def chats_plan_calls(chats):
+    """Горячие запросы database.py: [(имя, функция)]"""
+    _, owner = chats.login_user("@owner", "admin123")
+    chat_id = chats.create_chat("group", "bench", owner["user_id"])
+    return [
+        ("login_user", lambda: chats.login_user("owner@example.com", "admin123")),
+        ("get_user_chats", lambda: chats.get_user_chats(owner["user_id"])),
+        ("get_chat_messages", lambda: chats.get_chat_messages(chat_id, owner["user_id"])),
+        ("search_messages", lambda: chats.search_messages(owner["user_id"], "bench")),
+        ("search_users", lambda: chats.search_users("an", owner["user_id"])),
+        ("get_audit_log", lambda: chats.get_audit_log(owner["user_id"])),
+    ]
+
+
+def cmd_plans(args):
+    import database
+    from server import Database as ServerDatabase
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print("📊 Планы запросов server.py")
+        db = ServerDatabase(os.path.join(tmpdir, "server.db"))
+        scans = explain_calls(db.conn, server_plan_calls(db))
+        db.close()
+
+        print("📊 Планы запросов database.py")
+        chats = database.Database(os.path.join(tmpdir, "chats.db"))
+        scans += explain_calls(chats.conn, chats_plan_calls(chats))
+        chats.close()
+
+    print(f"Запросов с полным сканированием: {len(scans)}")
+    if scans:
+        # Тот же контроль в CI - tests/test_query_plans.py
+        raise SystemExit(1)
+
+
+def seed_conversation(db, user1_id, user2_id, count, chunk=50000):
+    """Быстро залить в базу переписку из count сообщений"""
+    timestamp = "2025-01-01 00:00:00"
+    for start in range(0, count, chunk):
+        rows = []
+        for i in range(start, min(count, start + chunk)):
+            sender, receiver = (user1_id, user2_id) if i % 2 else (user2_id, user1_id)
+            rows.append((sender, receiver, f"seed message {i}", timestamp))
+        db.conn.executemany(
+            "INSERT INTO messages (sender_id, receiver_id, text, timestamp) VALUES (?, ?, ?, ?)",
+            rows)
+        db.conn.commit()
+    db.save_message(user1_id, user2_id, "last message")
+
+
+def time_calls(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def cmd_history(args):
+    from server import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "bench.db"))
+        print(f"⏳ Заливаем {args.messages} сообщений...")
+        seed_conversation(db, 1, 2, args.messages)
+        last_id = db.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+
+        print(f"📊 Страница из {args.limit} сообщений, среднее по {args.repeat} запросам")
+        for depth in (0, 0.5, 0.99):
+            offset = int(args.messages * depth)
+            before_id = last_id - offset if offset else None
+            keyset = time_calls(
+                lambda: db.get_chat_history(1, 2, args.limit, before_id=before_id), args.repeat)
+            # Старый вариант: ORDER BY ... LIMIT ? OFFSET ?
+            old = time_calls(lambda: db.conn.execute('''
+                SELECT id, sender_id, receiver_id, text, timestamp FROM messages
+                WHERE (sender_id = 1 AND receiver_id = 2) OR (sender_id = 2 AND receiver_id = 1)
+                ORDER BY id DESC LIMIT ? OFFSET ?
+                ''', (args.limit, offset)).fetchall(), args.repeat)
+            print(f"   глубина {offset:>8}: курсор {keyset * 1000:8.2f} мс   "
+                  f"OFFSET {old * 1000:8.2f} мс")
+        db.conn.close()
+
+
+def history_dict(row):
+    """Сообщение истории словарем, как до records.py"""
+    return {
+        "id": row[0],
+        "sender_id": row[1],
+        "receiver_id": row[2],
+        "text": row[3],
+        "timestamp": row[4],
+        "is_read": row[5],
+        "sender_name": row[6],
+        "sender_tag": row[7]
+    }
+
+
+def cmd_pages(args):
+    import tracemalloc
+    from records import Message, response_json
+    from server import Database
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "bench.db"))
+        print(f"⏳ Заливаем {args.messages} сообщений...")
+        db.save_messages([(3 + i % 2, 4 - i % 2, " ".join(rng.choices(SEARCH_WORDS, k=8)), None)
+                          for i in range(args.messages)])
+        last_id = db.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+        cursors = [rng.randint(args.limit + 1, last_id + 1) for _ in range(args.requests)]
+
+        # SQL и отметка прочтения одинаковы для обоих вариантов: меряем отдельно,
+        # а сравниваем то, что было словарями - сборку строк и запись в JSON
+        started = time.process_time()
+        pages = [db.get_chat_history(3, 4, args.limit, before_id=before_id)
+                 for before_id in cursors]
+        storage = (time.process_time() - started) / len(pages)
+        rows = [[tuple(message) for message in messages] for messages, _ in pages]
+        db.conn.close()
+
+    def response(before_id, messages, next_cursor):
+        return {"type": "chat_history", "user_id": 4, "messages": messages,
+                "before_id": before_id, "after_id": None, "next_cursor": next_cursor}
+
+    variants = {
+        "словари + json.dumps": (history_dict, json.dumps),
+        "записи + response_json": (lambda row: Message(*row), response_json),
+    }
+    print(f"📊 {args.requests} страниц по {args.limit} сообщений, CPU на страницу")
+    print(f"   SQL (одинаково для обоих): {storage * 1e6:8.1f} мкс")
+    outputs = {}
+    best = dict.fromkeys(variants, float("inf"))
+    # Варианты по очереди несколько кругов, берется лучший круг каждого
+    for _ in range(args.rounds):
+        for name, (build, dumps) in variants.items():
+            started = time.process_time()
+            outputs[name] = [
+                dumps(response(before_id, [build(row) for row in page], next_cursor))
+                for before_id, page, (_, next_cursor) in zip(cursors, rows, pages)]
+            best[name] = min(best[name], (time.process_time() - started) / len(rows))
+    for name, elapsed in best.items():
+        print(f"   {name:<24} {elapsed * 1e6:8.1f} мкс   "
+              f"до {1 / (storage + elapsed):>6.0f} страниц/с с SQL")
+    first, second = outputs.values()
+    print(f"   ответы совпадают побайтно: {'да' if first == second else 'НЕТ'}")
+
+    print(f"📊 Память: {args.in_flight} страниц в очередях на отправку")
+    held = [rows[i % len(rows)] for i in range(args.in_flight)]
+    for name, (build, _) in variants.items():
+        tracemalloc.start()
+        pages_in_flight = [[build(row) for row in page] for page in held]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del pages_in_flight
+        print(f"   {name:<24} {size / 1024 / 1024:8.1f} МБ "
+              f"({size / args.in_flight / args.limit:.0f} байт на сообщение без текста)")
+
+
+SEARCH_WORDS = ("привет", "как", "дела", "встреча", "завтра", "проект", "отчет", "кофе",
+                "hello", "meeting", "deploy", "release", "server", "client", "ticket", "weekend")
+
+
+def cmd_search(args):
+    from server import Database
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "bench.db"), synchronous="OFF")
+        print(f"⏳ Заливаем {args.messages} сообщений между {args.users} пользователями...")
+        chunk = 50000
+        for start in range(0, args.messages, chunk):
+            rows = []
+            for _ in range(min(chunk, args.messages - start)):
+                words = rng.choices(SEARCH_WORDS, k=8) + [secrets.token_hex(3)]
+                rows.append((rng.randint(1, args.users), rng.randint(1, args.users), " ".join(words)))
+            db.conn.executemany(
+                "INSERT INTO messages (sender_id, receiver_id, text) VALUES (?, ?, ?)", rows)
+            db.conn.commit()
+
+        latencies = []
+        for _ in range(args.queries):
+            user_id = rng.randint(1, args.users)
+            query = " ".join(rng.sample(SEARCH_WORDS, 2))
+            started = time.perf_counter()
+            db.search_messages(user_id, query)
+            latencies.append(time.perf_counter() - started)
+        print_latency("search_messages (20 результатов)", latencies)
+        print(f"   p95:     {percentile(latencies, 95) * 1000:.2f} мс")
+        db.conn.close()
+
+
+SYLLABLES = ("an", "na", "ar", "te", "ma", "ks", "im", "le", "na", "ol", "ga", "ser",
+             "ge", "ij", "dmi", "tri", "ka", "tya", "ole", "sya", "vla", "dim", "ir", "ina")
+
+
+def random_name(rng):
+    return "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))).capitalize()
+
+
+def cmd_users(args):
+    from server import Database
+    from text_search import UserSearchIndex
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = Database(os.path.join(tmpdir, "bench.db"), synchronous="OFF")
+        print(f"⏳ Заливаем {args.users} пользователей...")
+        rows = []
+        for i in range(args.users):
+            name = f"{random_name(rng)}{i}"
+            rows.append((name, f"@{name.lower()}_{i}", "x"))
+        db.conn.executemany(
+            "INSERT INTO users (username, tag, password_hash) VALUES (?, ?, ?)", rows)
+        db.conn.commit()
+
+        started = time.perf_counter()
+        index = UserSearchIndex()
+        index.load(db.get_users_for_index())
+        print(f"✅ Индекс построен за {time.perf_counter() - started:.1f} с, "
+              f"грамм: {len(index.postings)}")
+
+        queries = [random_name(rng)[:rng.randint(1, 6)] for _ in range(args.queries)]
+        for title, search in (
+            ("LIKE '%q%' (SQLite)", lambda q: db.search_users(q, 1)),
+            ("индекс в памяти", lambda q: index.search(q, exclude_id=1)),
+        ):
+            latencies = []
+            for query in queries:
+                started = time.perf_counter()
+                search(query)
+                latencies.append(time.perf_counter() - started)
+            print_latency(title, latencies)
+        db.conn.close()
+
+
+class InlineHasher:
+    """Старое поведение для сравнения: хеш считается прямо в event loop"""
+
+    async def hash(self, password):
+        from passwords import hash_password
+        return hash_password(password)
+
+    async def verify(self, password, password_hash):
+        from passwords import verify_password
+        return verify_password(password, password_hash)
+
+    def close(self):
+        pass
+
+
+async def login_once(url, identifier, password):
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({"type": "login", "identifier": identifier, "password": password}))
+        while True:
+            data = json.loads(await ws.recv())
+            if data.get("type") in ("login_success", "error"):
+                return data["type"] == "login_success"
+
+
+async def run_logins(url, clients_count, rate, duration, interval):
+    clients = await connect_clients(url, clients_count)
+    user_ids = [c.user_id for c in clients]
+    print(f"✅ Подключено клиентов: {len(clients)}")
+
+    async def chat(seconds):
+        for c in clients:
+            c.latencies.clear()
+        stop_at = time.perf_counter() + seconds
+
+        async def sender(client):
+            while time.perf_counter() < stop_at:
+                await asyncio.sleep(random.uniform(0, interval))
+                await client.send(random.choice(user_ids), "bench message")
+
+        await asyncio.gather(*(sender(c) for c in clients))
+        while any(c.pending for c in clients):
+            await asyncio.sleep(0.01)
+        return [value for c in clients for value in c.latencies]
+
+    print_latency("Задержка сообщений без входов", await chat(duration))
+
+    # Шторм входов: rate попыток в секунду параллельно с перепиской
+    logins = []
+
+    async def storm():
+        started = time.perf_counter()
+        for i in range(int(rate * duration)):
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            logins.append(asyncio.create_task(login_once(url, "@anna", "password123")))
+
+    storm_started = time.perf_counter()
+    latencies, _ = await asyncio.gather(chat(duration), storm())
+    print_latency(f"Задержка сообщений при {rate} входах/с", latencies)
+    results = await asyncio.gather(*logins, return_exceptions=True)
+    elapsed = time.perf_counter() - storm_started
+    ok = sum(1 for result in results if result is True)
+    print(f"   входов: {ok}/{len(results)} за {elapsed:.1f} с")
+
+    await asyncio.gather(*(c.close() for c in clients))
+
+
+async def cmd_logins(args):
+    if args.url:
+        await run_logins(args.url, args.clients, args.rate, args.duration, args.interval)
+        return
+
+    server = local_server()
+    async with server as url:
+        if args.inline:
+            server.chat_server.passwords.close()
+            server.chat_server.passwords = InlineHasher()
+        await run_logins(url, args.clients, args.rate, args.duration, args.interval)
+
+
+async def run_shards(shards, messages, concurrency, users, batch_size, synchronous):
+    from server import Database
+    from sharding import ShardedDatabase, ShardedMessageBatcher
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = ShardedDatabase(Database, os.path.join(tmpdir, "bench.db"), shards=shards,
+                             synchronous=synchronous)
+        batcher = ShardedMessageBatcher(db, batch_size=batch_size)
+        batcher.start()
+
+        per_worker = messages // concurrency
+        rng = random.Random(shards)
+        pairs = [(rng.randint(1, users), rng.randint(1, users)) for _ in range(concurrency)]
+
+        async def worker(n):
+            sender_id, receiver_id = pairs[n]
+            for i in range(per_worker):
+                await batcher.save(sender_id, receiver_id, f"bench message {n}/{i}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        # Сводка бесед собирается из всех шардов
+        started_read = time.perf_counter()
+        for user_id in range(1, 101):
+            await db.get_conversations(user_id)
+        conversations_ms = (time.perf_counter() - started_read) * 1000 / 100
+
+        await batcher.stop()
+        db.close()
+
+    total = per_worker * concurrency
+    print(f"   shards={shards:<3} {total / elapsed:>10.0f} сообщений/с   "
+          f"get_conversations {conversations_ms:.2f} мс")
+
+
+async def cmd_shards(args):
+    print(f"📊 Запись {args.messages} сообщений, {args.concurrency} пар, "
+          f"batch={args.batch_size}, synchronous={args.synchronous}")
+    for shards in args.shards:
+        await run_shards(shards, args.messages, args.concurrency, args.users,
+                         args.batch_size, args.synchronous)
+
+
+class FrameSink:
+    """Сокет без сети: рамка собирается как в websockets, но никуда не пишется"""
+
+    def __init__(self):
+        from websockets.protocol import State
+        self.state = State.OPEN
+        self.open = True
+        self.transport = self  # буфер отправки всегда пуст
+        self._fragmented_message_waiter = None
+        self.sent = 0
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def write_frame_sync(self, fin, opcode, data):
+        from websockets.frames import Frame, Opcode
+        self.sent += len(Frame(Opcode(opcode), data, fin).serialize(mask=False))
+
+    async def send(self, message):
+        from websockets.frames import Opcode
+        self.write_frame_sync(True, Opcode.TEXT, message.encode())
+
+
+async def cmd_channel(args):
+    from chats import ChatCache
+    from connections import ConnectionRegistry
+    from db_executor import AsyncDatabase
+    from server import Database
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = AsyncDatabase(Database, os.path.join(tmpdir, "bench.db"), synchronous="OFF")
+        _, chat = db.writer_db.create_chat(1, "Канал", is_channel=True)
+        db.writer_db.conn.executemany("INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)",
+                                      ((chat.id, user_id) for user_id in range(2, args.members + 2)))
+        db.writer_db.conn.commit()
+
+        cache = ChatCache(db)
+        started = time.perf_counter()
+        members = await cache.get(chat.id)
+        load_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        for _ in range(1000):
+            await cache.get(chat.id)
+        hit_us = (time.perf_counter() - started) * 1000
+        db.close()
+
+    print(f"📊 Канал на {len(members)} участников, онлайн {args.online}, {args.posts} постов")
+    print(f"   загрузка участников в кэш: {load_ms:.1f} мс, из кэша: {hit_us:.1f} мкс")
+
+    connections = ConnectionRegistry()
+    sockets = []
+    for user_id in range(2, args.online + 2):
+        sockets.append(FrameSink())
+        connections.add(user_id, sockets[-1])
+
+    def payload(n):
+        return {"type": "chat_message", "chat_id": chat.id, "message_id": n, "sender_id": 1,
+                "sender_name": "Артем", "sender_tag": "@artem",
+                "text": f"Новость номер {n}: " + "текст " * 20, "timestamp": "2026-01-01 12:00:00"}
+
+    async def per_socket(n):
+        # Как личные сообщения: JSON и await send() на каждого получателя
+        for user_id in members.roles:
+            for connection in connections.devices(user_id):
+                await connection.websocket.send(json.dumps(payload(n)))
+
+    async def broadcast(n):
+        connections.broadcast(members.roles, json.dumps(payload(n)))
+
+    best = {}
+    for _ in range(args.rounds):
+        for name, post in (("JSON и send() на сокет", per_socket), ("один JSON, broadcast", broadcast)):
+            started = time.process_time()
+            for n in range(args.posts):
+                await post(n)
+            elapsed = (time.process_time() - started) / args.posts
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for name, elapsed in best.items():
+        print(f"   {name:<24} {elapsed * 1000:8.1f} мс на пост   "
+              f"{args.online / elapsed:>10.0f} доставок/с")
+    frames = {socket.sent for socket in sockets}
+    print(f"   байт у каждого получателя одинаково: {'да' if len(frames) == 1 else 'НЕТ'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности ARTEM Messenger")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    latency = commands.add_parser("latency", help="p99 задержки отправки при N клиентах")
+    latency.add_argument("--url", help="адрес уже запущенного сервера")
+    latency.add_argument("--clients", type=int, default=1000)
+    latency.add_argument("--messages", type=int, default=10, help="сообщений на клиента")
+    latency.add_argument("--interval", type=float, default=1.0, help="макс. пауза между отправками, с")
+    latency.set_defaults(handler=cmd_latency)
+
+    writes = commands.add_parser("writes", help="сообщений/с через групповую запись")
+    writes.add_argument("--messages", type=int, default=20000)
+    writes.add_argument("--concurrency", type=int, default=500)
+    writes.add_argument("--batch-sizes", type=lambda v: [int(x) for x in v.split(",")],
+                        default=[1, 32, 128])
+    writes.add_argument("--flush-interval-ms", type=int, default=5)
+    writes.add_argument("--synchronous", default="FULL")
+    writes.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    writes.set_defaults(handler=cmd_writes)
+
+    shards = commands.add_parser("shards", help="сообщений/с при разном числе шардов")
+    shards.add_argument("--shards", type=lambda v: [int(x) for x in v.split(",")],
+                        default=[1, 4, 8])
+    shards.add_argument("--messages", type=int, default=20000)
+    shards.add_argument("--concurrency", type=int, default=500, help="отправителей (по паре на каждого)")
+    shards.add_argument("--users", type=int, default=1000)
+    shards.add_argument("--batch-size", type=int, default=128)
+    shards.add_argument("--synchronous", default="FULL")
+    shards.set_defaults(handler=cmd_shards)
+
+    plans = commands.add_parser("plans", help="EXPLAIN QUERY PLAN горячих запросов")
+    plans.set_defaults(handler=cmd_plans)
+
+    history = commands.add_parser("history", help="страницы истории: курсор против OFFSET")
+    history.add_argument("--messages", type=int, default=1000000)
+    history.add_argument("--limit", type=int, default=50)
+    history.add_argument("--repeat", type=int, default=20)
+    history.set_defaults(handler=cmd_history)
+
+    pages = commands.add_parser("pages", help="CPU и память на отдачу страниц истории")
+    pages.add_argument("--messages", type=int, default=20000)
+    pages.add_argument("--requests", type=int, default=5000)
+    pages.add_argument("--limit", type=int, default=50)
+    pages.add_argument("--rounds", type=int, default=5)
+    pages.add_argument("--in-flight", type=int, default=1000, help="страниц, ждущих отправки")
+    pages.set_defaults(handler=cmd_pages)
+
+    search = commands.add_parser("search", help="задержка полнотекстового поиска")
+    search.add_argument("--messages", type=int, default=1000000)
+    search.add_argument("--users", type=int, default=10000)
+    search.add_argument("--queries", type=int, default=500)
+    search.set_defaults(handler=cmd_search)
+
+    users = commands.add_parser("users", help="поиск пользователей: LIKE против индекса")
+    users.add_argument("--users", type=int, default=1000000)
+    users.add_argument("--queries", type=int, default=300)
+    users.set_defaults(handler=cmd_users)
+
+    logins = commands.add_parser("logins", help="задержка сообщений во время шторма входов")
+    logins.add_argument("--url", help="адрес уже запущенного сервера")
+    logins.add_argument("--clients", type=int, default=50)
+    logins.add_argument("--rate", type=int, default=500, help="попыток входа в секунду")
+    logins.add_argument("--duration", type=float, default=5.0, help="длительность фазы, с")
+    logins.add_argument("--interval", type=float, default=0.1, help="макс. пауза между отправками, с")
+    logins.add_argument("--inline", action="store_true", help="хешировать в event loop (как раньше)")
+    logins.set_defaults(handler=cmd_logins)
+
+    channel = commands.add_parser("channel", help="рассылка поста в канал на N участников")
+    channel.add_argument("--members", type=int, default=50000)
+    channel.add_argument("--online", type=int, default=50000, help="участников с открытым соединением")
+    channel.add_argument("--posts", type=int, default=20)
+    channel.add_argument("--rounds", type=int, default=3)
+    channel.set_defaults(handler=cmd_channel)
+
+    args = parser.parse_args()
+    result = args.handler(args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# chats.py - Участники групповых чатов и каналов в памяти
+from collections import OrderedDict
+
+ADMIN_ROLES = frozenset({"creator", "admin"})
+MAX_INITIAL_MEMBERS = 200  # участников, добавляемых при создании чата
+
+
+class ChatMembers:
+    """Чат из кэша: кто в нем состоит и кто может писать"""
+    __slots__ = ("summary", "roles", "muted")
+
+    def __init__(self, summary, members):
+        self.summary = summary
+        self.roles = {user_id: role for user_id, (role, _) in members.items()}  # user_id -> роль
+        self.muted = {user_id for user_id, (_, is_muted) in members.items() if is_muted}
+
+    def __contains__(self, user_id):
+        return user_id in self.roles
+
+    def __len__(self):
+        return len(self.roles)
+
+    def is_admin(self, user_id):
+        return self.roles.get(user_id) in ADMIN_ROLES
+
+    def can_post(self, user_id):
+        """В группе пишут все участники без мута, в канале - только админы"""
+        if user_id not in self.roles or user_id in self.muted:
+            return False
+        return not self.summary.is_channel or self.is_admin(user_id)
+
+
+class ChatCache:
+    """chat_id -> ChatMembers, загруженные из хранилища при первом обращении.
+
+    Вступление, выход и мут сбрасывают запись чата (invalidate): следующее
+    сообщение перечитает участников. Загрузка, начатая до сброса, свой
+    результат в кэш не кладет - иначе в нем остался бы состав до изменения.
+    Больше max_chats чатов не держит, вытесняются давно не использованные.
+    """
+
+    def __init__(self, db, max_chats=10000):
+        self.db = db
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.generation = 0  # растет при каждом сбросе
+        self.loads = 0
+
+    async def get(self, chat_id):
+        """ChatMembers чата или None, если чата нет"""
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            self.chats.move_to_end(chat_id)
+            return chat
+
+        generation = self.generation
+        loaded = await self.db.get_chat(chat_id)
+        self.loads += 1
+        if loaded is None:
+            return None
+        chat = ChatMembers(*loaded)
+        if generation == self.generation:
+            self.chats[chat_id] = chat
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        return chat
+
+    def invalidate(self, chat_id):
+        self.generation += 1
+        self.chats.pop(chat_id, None)
@@ -0,0 +1,265 @@
+# cluster.py - Несколько процессов сервера на одном порту и шина между ними
+#
+# ARTEM_WORKERS=4 python server.py
+#
+# Супервизор создает базу, запускает шину (BusHub) на Unix-сокете и N процессов
+# ChatServer. Все процессы слушают один порт (SO_REUSEPORT): ядро раскладывает
+# подключения между ними. Шина знает, на каких процессах открыты соединения
+# пользователя (таблица маршрутов), и доставляет туда личные сообщения; события,
+# меняющие состояние в памяти (индекс пользователей, кэши, участники чатов,
+# сообщения в чатах), рассылает всем остальным процессам.
+#
+# Протокол шины - строки JSON:
+#   процесс -> шина: hello {worker}, online/offline {user_id},
+#                    send {user_ids, frame, key}, event {name, args}
+#   шина -> процесс: send {user_ids, frame, key}, event {name, args},
+#                    remote {user_id, online} - пользователь онлайн на другом процессе
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+
+import config
+
+LINE_LIMIT = 16 * 1024 * 1024  # самая длинная строка шины (сообщение со списком получателей)
+BUFFER_LIMIT = 4 * LINE_LIMIT  # непрочитанного в одном соединении шины, дальше - разрыв
+RECONNECT_DELAY = 1            # пауза перед переподключением к шине, секунд
+RESTART_DELAY = 1              # пауза перед перезапуском упавшего процесса, секунд
+
+
+def bus_path():
+    return config.BUS_PATH or os.path.join(tempfile.gettempdir(), f"artem-bus-{config.PORT}.sock")
+
+
+def _line(message):
+    return (json.dumps(message, ensure_ascii=False) + "\n").encode()
+
+
+def _write(writer, data, peer):
+    """Записать в соединение шины, не дожидаясь отправки.
+
+    Если другая сторона не читает и в буфере больше BUFFER_LIMIT, соединение
+    разрывается: процесс переподключится и получит маршруты заново, а память
+    отправителя не растет без предела.
+    """
+    if writer.is_closing():
+        return
+    writer.write(data)
+    buffered = writer.transport.get_write_buffer_size()
+    if buffered > BUFFER_LIMIT:
+        print(f"⚠️ Шина: {peer} не успевает читать ({buffered} байт в буфере), разрыв связи")
+        writer.transport.abort()
+
+
+class BusHub:
+    """Шина в процессе супервизора: таблица маршрутов user_id -> процессы"""
+
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}  # worker_id -> StreamWriter
+        self.routes = {}   # user_id -> set(worker_id) с открытыми соединениями
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # сокет от прошлого запуска
+        self.server = await asyncio.start_unix_server(self.handle, self.path, limit=LINE_LIMIT)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def handle(self, reader, writer):
+        hello = json.loads(await reader.readline() or "{}")
+        worker = hello.get("worker")
+        if worker is None:
+            writer.close()
+            return
+        self.workers[worker] = writer
+        # Новому (или перезапущенному) процессу - кто уже онлайн на остальных
+        for user_id, holders in self.routes.items():
+            if holders - {worker}:
+                self.write(worker, _line({"op": "remote", "user_id": user_id, "online": True}))
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                op = message["op"]
+                if op == "event":
+                    for other in list(self.workers):
+                        if other != worker:
+                            self.write(other, line)
+                elif op == "send":
+                    self.route(worker, message["user_ids"], message["frame"], message.get("key"))
+                elif op == "online":
+                    self.update(message["user_id"], worker, True)
+                elif op == "offline":
+                    self.update(message["user_id"], worker, False)
+        except (ConnectionError, json.JSONDecodeError, KeyError) as e:
+            print(f"⚠️ Шина: процесс {worker}: {e}")
+        finally:
+            if self.workers.get(worker) is writer:
+                del self.workers[worker]
+                for user_id in [user_id for user_id, holders in self.routes.items() if worker in holders]:
+                    self.update(user_id, worker, False)
+            writer.close()
+
+    def write(self, worker, data):
+        """Строка шины процессу worker, если он подключен"""
+        writer = self.workers.get(worker)
+        if writer:
+            _write(writer, data, f"процесс {worker}")
+
+    def route(self, origin, user_ids, frame, key=None):
+        """Отправить frame на процессы получателей, кроме процесса-отправителя"""
+        by_worker = {}
+        for user_id in user_ids:
+            for worker in self.routes.get(user_id, ()):
+                if worker != origin:
+                    by_worker.setdefault(worker, []).append(user_id)
+        for worker, ids in by_worker.items():
+            self.write(worker, _line({"op": "send", "user_ids": ids, "frame": frame, "key": key}))
+
+    def update(self, user_id, worker, online):
+        """Изменить маршрут и сообщить процессам, для которых поменялось "онлайн где-то еще" """
+        before = self.routes.get(user_id, set())
+        after = before | {worker} if online else before - {worker}
+        if after:
+            self.routes[user_id] = after
+        else:
+            self.routes.pop(user_id, None)
+        for other in list(self.workers):
+            elsewhere = bool(after - {other})
+            if bool(before - {other}) != elsewhere:
+                self.write(other, _line({"op": "remote", "user_id": user_id, "online": elsewhere}))
+
+
+class WorkerBus:
+    """Подключение процесса ChatServer к шине.
+
+    handler(message) получает входящие сообщения шины; при потере связи -
+    {"op": "reset"}. После переподключения процесс заново объявляет своих
+    пользователей из local_users(). Пока связи нет, исходящее теряется.
+    """
+
+    def __init__(self, path, worker_id, handler, local_users):
+        self.path = path
+        self.worker_id = worker_id
+        self.handler = handler
+        self.local_users = local_users
+        self.writer = None
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            self.writer = writer
+            self._write({"op": "hello", "worker": self.worker_id})
+            for user_id in list(self.local_users()):
+                self.online(user_id)
+            try:
+                async for line in reader:
+                    await self.handler(json.loads(line))
+            except (ConnectionError, json.JSONDecodeError) as e:
+                print(f"⚠️ Шина: {e}")
+            finally:
+                self.writer = None
+                writer.close()
+                await self.handler({"op": "reset"})
+            print("⚠️ Связь с шиной потеряна, переподключение")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def _write(self, message):
+        if self.writer is not None:
+            _write(self.writer, _line(message), "супервизор")
+
+    def online(self, user_id):
+        self._write({"op": "online", "user_id": user_id})
+
+    def offline(self, user_id):
+        self._write({"op": "offline", "user_id": user_id})
+
+    def send(self, user_ids, frame, key=None):
+        """Доставить готовый JSON frame устройствам user_ids на других процессах
+        (key - как у ConnectionRegistry.send)"""
+        self._write({"op": "send", "user_ids": list(user_ids), "frame": frame, "key": key})
+
+    def publish(self, name, *args):
+        """Повторить событие name(*args) на всех остальных процессах"""
+        self._write({"op": "event", "name": name, "args": args})
+
+
+def check_cluster():
+    """Ошибка, если в этой конфигурации несколько процессов работать не могут"""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("Несколько процессов требуют SO_REUSEPORT (Linux, macOS, BSD)")
+    if config.STORAGE != "sqlite":
+        raise ValueError(f"Хранилище {config.STORAGE} живет в одном процессе, нужно sqlite")
+    if config.DB_SHARDS:
+        # ShardedDatabase выдает id сообщений в памяти своего процесса
+        raise ValueError("Шарды пока работают только в одном процессе")
+
+
+def run_worker(worker_id, path):
+    """Точка входа процесса: ChatServer на общем порту, подключенный к шине"""
+    import server
+    asyncio.run(server.serve(worker_id=worker_id, bus_path=path))
+
+
+async def run_supervisor(workers):
+    """Запустить шину и workers процессов, перезапускать упавшие до SIGINT/SIGTERM"""
+    from server import Database
+
+    check_cluster()
+    # Схема и сброс статусов онлайн - один раз до запуска процессов
+    db = Database(config.DB_PATH, journal_mode=config.DB_JOURNAL_MODE,
+                  synchronous=config.DB_SYNCHRONOUS)
+    db.reset_presence()
+    db.close()
+
+    hub = BusHub(bus_path())
+    await hub.start()
+    print(f"🚌 Шина: {hub.path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # spawn: процессы не наследуют event loop и сокет шины супервизора
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+
+    def launch(worker_id):
+        process = context.Process(target=run_worker, args=(worker_id, hub.path),
+                                  name=f"artem-worker-{worker_id}")
+        process.start()
+        processes[worker_id] = process
+        print(f"👷 Процесс {worker_id} запущен (pid {process.pid})")
+
+    for worker_id in range(workers):
+        launch(worker_id)
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), RESTART_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            for worker_id, process in list(processes.items()):
+                if not process.is_alive() and not stop.is_set():
+                    print(f"❌ Процесс {worker_id} завершился с кодом {process.exitcode}, перезапуск")
+                    launch(worker_id)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            await loop.run_in_executor(None, process.join)
+        await hub.stop()
+        print("🛑 Все процессы остановлены")
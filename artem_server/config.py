@@ -0,0 +1,83 @@
+# config.py - Настройки сервера (переопределяются переменными окружения)
+import os
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+# База данных. ARTEM_STORAGE: sqlite или memory (в памяти, для нагрузочных тестов и CI)
+STORAGE = os.environ.get("ARTEM_STORAGE", "sqlite")
+DB_PATH = os.environ.get("ARTEM_DB_PATH", "artem_messenger.db")
+DB_READERS = _env_int("ARTEM_DB_READERS", 4)  # Потоки чтения (read-only WAL соединения)
+DB_JOURNAL_MODE = os.environ.get("ARTEM_DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.environ.get("ARTEM_DB_SYNCHRONOUS", "FULL")  # OFF / NORMAL / FULL / EXTRA
+# Сообщения в DB_SHARDS файлах по хешу пары собеседников (0 - все в основной базе).
+# Задается при создании базы, у существующей базы менять нельзя
+DB_SHARDS = _env_int("ARTEM_DB_SHARDS", 0)
+
+# Групповая запись сообщений: одна транзакция на пачку
+MESSAGE_BATCH_SIZE = _env_int("ARTEM_MESSAGE_BATCH_SIZE", 128)
+MESSAGE_FLUSH_INTERVAL_MS = _env_int("ARTEM_MESSAGE_FLUSH_INTERVAL_MS", 5)
+# Последние client_msg_id в памяти: повтор отправки отвечается без базы
+CLIENT_MSG_CACHE_SIZE = _env_int("ARTEM_CLIENT_MSG_CACHE_SIZE", 10000)
+
+# Кэш сессий и удаление истекших сессий (по таймеру на срок ближайшей, пачками)
+SESSION_CACHE_SIZE = _env_int("ARTEM_SESSION_CACHE_SIZE", 100000)
+SESSION_CACHE_TTL = _env_int("ARTEM_SESSION_CACHE_TTL", 300)  # секунд
+SESSION_SWEEP_BATCH = _env_int("ARTEM_SESSION_SWEEP_BATCH", 500)
+
+# Статус онлайн: как часто изменения пишутся в базу
+PRESENCE_FLUSH_INTERVAL = _env_int("ARTEM_PRESENCE_FLUSH_INTERVAL", 30)  # секунд
+
+# Архив: сообщения старше ARCHIVE_AFTER_DAYS дней переносятся в месячные файлы
+# в ARCHIVE_DIR (пусто - папка archive рядом с базой). 0 - архивация выключена.
+# С DB_SHARDS архивации нет (сервер предупреждает при старте)
+ARCHIVE_DIR = os.environ.get("ARTEM_ARCHIVE_DIR", "")
+ARCHIVE_AFTER_DAYS = _env_int("ARTEM_ARCHIVE_AFTER_DAYS", 0)
+ARCHIVE_INTERVAL = _env_int("ARTEM_ARCHIVE_INTERVAL", 3600)  # секунд
+ARCHIVE_BATCH = _env_int("ARTEM_ARCHIVE_BATCH", 5000)
+
+# Обслуживание базы (maintenance.py): ANALYZE, PRAGMA optimize, контрольная точка WAL,
+# incremental_vacuum и резервная копия - раз в сутки в окне MAINTENANCE_WINDOW
+# (местное время, "03:00-05:00"; пусто - выключено), пока сообщений в минуту
+# не больше MAINTENANCE_MAX_RATE. MAINTENANCE_BUDGET_MS - предел одной работы.
+# BACKUP_DIR - папка копий (пусто - без копий), хранятся BACKUP_KEEP последних
+MAINTENANCE_WINDOW = os.environ.get("ARTEM_MAINTENANCE_WINDOW", "03:00-05:00")
+MAINTENANCE_MAX_RATE = _env_int("ARTEM_MAINTENANCE_MAX_RATE", 60)
+MAINTENANCE_BUDGET_MS = _env_int("ARTEM_MAINTENANCE_BUDGET_MS", 2000)
+BACKUP_DIR = os.environ.get("ARTEM_BACKUP_DIR", "")
+BACKUP_KEEP = _env_int("ARTEM_BACKUP_KEEP", 7)
+
+# Журнал действий (database.py): фоновая запись пачками.
+# AUDIT_DB_PATH - отдельный файл для журнала (пусто - основная база).
+# AUDIT_OVERFLOW при переполнении очереди: drop - пропускать записи, flush - ждать записи пачки
+AUDIT_DB_PATH = os.environ.get("ARTEM_AUDIT_DB_PATH", "")
+AUDIT_QUEUE_SIZE = _env_int("ARTEM_AUDIT_QUEUE_SIZE", 10000)
+AUDIT_BATCH_SIZE = _env_int("ARTEM_AUDIT_BATCH_SIZE", 500)
+AUDIT_FLUSH_INTERVAL_MS = _env_int("ARTEM_AUDIT_FLUSH_INTERVAL_MS", 500)
+AUDIT_OVERFLOW = os.environ.get("ARTEM_AUDIT_OVERFLOW", "drop")
+
+# Очередь исходящих рамок каждого соединения (connections.py): не больше
+# OUTBOX_SIZE рамок ждут медленного получателя. OUTBOX_OVERFLOW при переполнении:
+# drop - выбросить самую старую рамку состояния, coalesce - заменять рамки
+# состояния о том же событии, disconnect - закрыть соединение (клиент
+# переподключится). Сообщения не выбрасываются: если в очереди только они,
+# соединение закрывается при любой политике
+OUTBOX_SIZE = _env_int("ARTEM_OUTBOX_SIZE", 256)
+OUTBOX_OVERFLOW = os.environ.get("ARTEM_OUTBOX_OVERFLOW", "coalesce")
+
+# Процессы для хеширования паролей (scrypt)
+PASSWORD_WORKERS = _env_int("ARTEM_PASSWORD_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+
+# Процессы сервера на одном порту (cluster.py): больше 1 - супервизор, шина и
+# ARTEM_WORKERS процессов. BUS_PATH - Unix-сокет шины (пусто - во временной папке)
+WORKERS = _env_int("ARTEM_WORKERS", 1)
+BUS_PATH = os.environ.get("ARTEM_BUS_PATH", "")
+# Как часто процесс рассылает остальным свои события статистики (сообщения, регистрации)
+STATS_SYNC_INTERVAL = _env_int("ARTEM_STATS_SYNC_INTERVAL", 1)  # секунд
+
+# Сетевые настройки
+HOST = os.environ.get("ARTEM_HOST", "localhost")
+PORT = _env_int("ARTEM_PORT", 8765)
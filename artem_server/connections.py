@@ -0,0 +1,220 @@
+# connections.py - Открытые соединения пользователей (несколько устройств на пользователя)
+import asyncio
+import time
+from collections import deque
+
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+OVERFLOW_POLICIES = ("drop", "coalesce", "disconnect")
+WRITE_BUFFER_LIMIT = 64 * 1024  # байт в буфере сокета, до которых рамка пишется сразу
+SLOW_CLOSE_CODE = 1013          # Try Again Later: клиент переподключится и дочитает историю
+SLOW_REPORT_SIZE = 10           # соединений с самыми длинными очередями в статистике
+
+
+class Connection:
+    """Одно открытое соединение: сокет, владелец, время входа и очередь исходящих.
+
+    queue - рамки (key, frame), которые ждут, пока сокет освободится; ее
+    разбирает своя задача writer, чтобы медленный получатель не задерживал
+    корутину отправителя.
+    """
+    __slots__ = ("websocket", "user_id", "connected_at", "queue", "writer",
+                 "dropped", "peak")
+
+    def __init__(self, user_id, websocket):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.connected_at = time.time()
+        self.queue = deque()
+        self.writer = None
+        self.dropped = 0  # рамок выброшено при переполнении
+        self.peak = 0     # самая длинная очередь
+
+    def ready(self):
+        """Рамку можно записать сразу: очередь пуста и буфер сокета почти пуст"""
+        return not self.queue and self.websocket.transport.get_write_buffer_size() < WRITE_BUFFER_LIMIT
+
+
+class ConnectionRegistry:
+    """user_id -> множество Connection.
+
+    Пользователь онлайн, пока у него есть хотя бы одно соединение: add()
+    сообщает о первом, remove() - о последнем. Вход со второго устройства
+    не вытесняет первое, закрытие одного не снимает статус с остальных.
+
+    Рамки другим пользователям (send, broadcast) не ждут сети: пока буфер
+    сокета получателя почти пуст, рамка пишется в него сразу, иначе встает
+    в очередь соединения длиной не больше queue_size.
+
+    Терять можно только рамки с key - состояние, которое устаревает (отметка
+    прочтения messages_read: важно только последнее значение). Сообщения идут
+    без key и не выбрасываются никогда. При переполнении overflow решает, что делать:
+      drop       - выбросить самую старую рамку с key
+      coalesce   - рамка с key заменяет ждущую рамку с тем же key,
+                   если места все равно нет - как drop
+      disconnect - закрыть соединение кодом 1013, клиент переподключится
+    Если выбросить нечего (в очереди одни сообщения), соединение закрывается
+    при любой политике: клиент переподключится и дочитает историю.
+    """
+
+    def __init__(self, queue_size=256, overflow="coalesce"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения очереди: {overflow}")
+        self.by_user = {}
+        self.total = 0  # соединений всего (len() - пользователей онлайн)
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.dropped = 0       # рамок выброшено при переполнении, всего
+        self.disconnected = 0  # соединений закрыто из-за переполнения
+        self.closing = set()   # задачи закрытия медленных соединений
+
+    def add(self, user_id, websocket):
+        """Зарегистрировать сокет: (Connection, первое ли это соединение пользователя)"""
+        connection = Connection(user_id, websocket)
+        devices = self.by_user.get(user_id)
+        if devices is None:
+            devices = self.by_user[user_id] = set()
+        devices.add(connection)
+        self.total += 1
+        return connection, len(devices) == 1
+
+    def remove(self, connection):
+        """Убрать соединение, True - если оно было последним у пользователя"""
+        devices = self.by_user.get(connection.user_id)
+        if not devices or connection not in devices:
+            return False
+        devices.remove(connection)
+        self.total -= 1
+        connection.queue.clear()
+        if connection.writer and not connection.writer.done():
+            connection.writer.cancel()
+        if devices:
+            return False
+        del self.by_user[connection.user_id]
+        return True
+
+    def devices(self, user_id):
+        return self.by_user.get(user_id, ())
+
+    def select(self, user_ids, exclude=None):
+        """Соединения всех устройств пользователей из user_ids (множество или словарь),
+        кроме сокета exclude.
+
+        Проходит по меньшему из двух: участникам или пользователям онлайн -
+        канал на 50 тысяч при сотне подключенных не перебирается целиком.
+        """
+        online = self.by_user
+        if len(user_ids) <= len(online):
+            present = [online[user_id] for user_id in user_ids if user_id in online]
+        else:
+            present = [devices for user_id, devices in online.items() if user_id in user_ids]
+        return [connection for devices in present for connection in devices
+                if connection.websocket is not exclude]
+
+    def broadcast(self, user_ids, message, exclude=None, key=None):
+        """Одна готовая рамка message всем устройствам user_ids без ожидания отправки.
+
+        Свободные сокеты получают ее одним websockets.broadcast (JSON
+        кодируется один раз), занятые - через свои очереди. Закрытые и
+        закрывающиеся сокеты пропускаются. Возвращает число сокетов.
+        """
+        connections = self.select(user_ids, exclude)
+        if not connections:
+            return 0
+        ready = []
+        for connection in connections:
+            if connection.ready():
+                ready.append(connection.websocket)
+            else:
+                self.push(connection, message, key)
+        websockets.broadcast(ready, message)
+        return len(connections)
+
+    def send(self, user_id, message, exclude=None, key=None):
+        """Отправить message на все устройства пользователя, кроме сокета exclude.
+
+        Не ждет сети: медленное устройство копит свою очередь и не задерживает
+        ни отправителя, ни остальные устройства. Возвращает число сокетов.
+        """
+        return self.broadcast((user_id,), message, exclude, key)
+
+    def push(self, connection, message, key=None):
+        """Поставить рамку в очередь соединения и запустить его writer"""
+        if not connection.websocket.open:
+            return  # закрывается: рамки ему уже не нужны
+        queue = connection.queue
+        if key is not None and self.overflow == "coalesce":
+            for index, (queued_key, _) in enumerate(queue):
+                if queued_key == key:
+                    del queue[index]
+                    break
+        if len(queue) >= self.queue_size:
+            if self.overflow == "disconnect" or not self.drop_oldest(connection, key):
+                self.close_slow(connection)
+                return
+            if key is not None and len(queue) >= self.queue_size:
+                return  # выброшена сама новая рамка
+        queue.append((key, message))
+        connection.peak = max(connection.peak, len(queue))
+        if connection.writer is None or connection.writer.done():
+            connection.writer = asyncio.create_task(self.write(connection))
+
+    def drop_oldest(self, connection, key=None):
+        """Выбросить самую старую рамку с key из очереди, а если таких нет -
+        новую рамку, если она с key. False - выбросить нечего"""
+        queue = connection.queue
+        for index, (queued_key, _) in enumerate(queue):
+            if queued_key is not None:
+                del queue[index]
+                break
+        else:
+            if key is None:
+                return False
+        connection.dropped += 1
+        self.dropped += 1
+        return True
+
+    def close_slow(self, connection):
+        """Закрыть соединение, которое не успевает принимать рамки"""
+        connection.queue.clear()
+        if connection.writer and not connection.writer.done():
+            connection.writer.cancel()
+        self.disconnected += 1
+        print(f"🐢 Медленное соединение пользователя {connection.user_id} закрыто")
+        task = asyncio.create_task(connection.websocket.close(SLOW_CLOSE_CODE, "Не успевает принимать"))
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def write(self, connection):
+        """Задача соединения: отправлять рамки из очереди по одной, ожидая сеть"""
+        queue = connection.queue
+        try:
+            while queue:
+                _, message = queue.popleft()
+                await connection.websocket.send(message)
+        except ConnectionClosed:
+            queue.clear()
+
+    def __contains__(self, user_id):
+        return user_id in self.by_user
+
+    def __len__(self):
+        return len(self.by_user)
+
+    def report(self):
+        """Очереди исходящих для статистики: всего, и соединения с самыми длинными"""
+        connections = [connection for devices in self.by_user.values() for connection in devices]
+        slowest = sorted((connection for connection in connections if connection.queue or connection.dropped),
+                         key=lambda connection: (len(connection.queue), connection.dropped),
+                         reverse=True)[:SLOW_REPORT_SIZE]
+        return {
+            "queued": sum(len(connection.queue) for connection in connections),
+            "queue_size": self.queue_size,
+            "overflow": self.overflow,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "slowest": [{"user_id": connection.user_id, "depth": len(connection.queue),
+                         "peak": connection.peak, "dropped": connection.dropped}
+                        for connection in slowest],
+        }
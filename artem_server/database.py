@@ -1,14 +1,44 @@
 # database.py
 import sqlite3
 import json
-from datetime import datetime
-import hashlib
+from datetime import datetime, timedelta, timezone
 import secrets
 
+import config
+import passwords
+from audit import AuditWriter
+from stats import StatsCounters
+from migrations import migrate, CHATS_MIGRATIONS
+from text_search import fts_query
+
 class Database:
-    def __init__(self, db_name="artem_messenger.db"):
+    def __init__(self, db_name="artem_messenger.db", audit_db_name=None):
         self.conn = sqlite3.connect(db_name, check_same_thread=False)
         self.create_tables()
+        migrate(self.conn, CHATS_MIGRATIONS)
+        
+        # Журнал действий пишется в фоне пачками, можно в отдельный файл
+        audit_db_name = audit_db_name or config.AUDIT_DB_PATH or db_name
+        self.audit = AuditWriter(
+            audit_db_name,
+            max_queue=config.AUDIT_QUEUE_SIZE,
+            batch_size=config.AUDIT_BATCH_SIZE,
+            flush_interval=config.AUDIT_FLUSH_INTERVAL_MS / 1000,
+            overflow=config.AUDIT_OVERFLOW,
+        )
+        self.audit_table = "audit_log"
+        if audit_db_name != db_name:
+            self.conn.execute("ATTACH DATABASE ? AS audit", (audit_db_name,))
+            self.audit_table = "audit.audit_log"
+        
+        # Статистика считается в памяти по событиям, из базы - только при запуске
+        self.stats = StatsCounters()
+        self.stats.load(*self.load_statistics())
+    
+    def close(self):
+        """Дописать журнал действий и закрыть базу"""
+        self.audit.close()
+        self.conn.close()
     
     def create_tables(self):
         cursor = self.conn.cursor()
@@ -144,12 +174,12 @@ class Database:
         print("✅ Создан владелец системы: @owner / admin123")
     
     def hash_password(self, password):
-        """Хеширование пароля"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Хеширование пароля (scrypt с солью)"""
+        return passwords.hash_password(password)
     
     def verify_password(self, password, password_hash):
-        """Проверка пароля"""
-        return self.hash_password(password) == password_hash
+        """Проверка пароля (scrypt или старый SHA-256)"""
+        return passwords.verify_password(password, password_hash)
     
     def generate_session_token(self):
         """Генерация токена сессии"""
@@ -179,6 +209,8 @@ class Database:
             
             user_id = cursor.lastrowid
             self.conn.commit()
+            self.stats.incr("total_users")
+            self.stats.hit("new_users")
             
             # Логируем регистрацию
             self.log_action(user_id, "register", user_id, "user", 
@@ -194,7 +226,7 @@ class Database:
         
         # Ищем пользователя
         cursor.execute('''
-        SELECT id, username, tag, password_hash, is_banned, ban_until 
+        SELECT id, username, tag, password_hash, is_banned, ban_until, is_online
         FROM users 
         WHERE username = ? OR tag = ? OR email = ?
         ''', (identifier, identifier, identifier))
@@ -203,7 +235,7 @@ class Database:
         if not user:
             return False, "Пользователь не найден"
         
-        user_id, username, tag, password_hash, is_banned, ban_until = user
+        user_id, username, tag, password_hash, is_banned, ban_until, is_online = user
         
         # Проверяем бан
         if is_banned:
@@ -213,11 +245,17 @@ class Database:
                 # Разбан если срок истек
                 cursor.execute("UPDATE users SET is_banned = 0 WHERE id = ?", (user_id,))
                 self.conn.commit()
+                self.stats.incr("banned_users", -1)
         
         # Проверяем пароль
         if not self.verify_password(password, password_hash):
             return False, "Неверный пароль"
         
+        # Старый хеш SHA-256 заменяем на scrypt при первом успешном входе
+        if passwords.needs_rehash(password_hash):
+            cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?",
+                           (self.hash_password(password), user_id))
+        
         # Создаем сессию
         session_token = self.generate_session_token()
         expires_at = datetime.now().timestamp() + (30 * 24 * 3600)  # 30 дней
@@ -234,6 +272,8 @@ class Database:
         ''', (datetime.now(), user_id))
         
         self.conn.commit()
+        if not is_online:
+            self.stats.incr("online_users")
         
         # Логируем вход
         self.log_action(user_id, "login", user_id, "user")
@@ -364,6 +404,7 @@ class Database:
                     ''', (chat_id, user_id))
         
         self.conn.commit()
+        self.stats.incr("total_chats")
         
         self.log_action(creator_id, "create_chat", chat_id, "chat", 
                        f"Создан {chat_type}: {name}")
@@ -383,7 +424,10 @@ class Database:
                 ORDER BY timestamp DESC LIMIT 1) as last_message,
                (SELECT timestamp FROM messages 
                 WHERE chat_id = c.id 
-                ORDER BY timestamp DESC LIMIT 1) as last_message_time
+                ORDER BY timestamp DESC LIMIT 1) as last_message_time,
+               (SELECT COUNT(*) FROM messages 
+                WHERE chat_id = c.id AND id > cm.last_read_message_id
+                  AND sender_id != cm.user_id AND is_deleted = 0) as unread_count
         FROM chats c
         JOIN chat_members cm ON c.id = cm.chat_id
         WHERE cm.user_id = ?
@@ -402,7 +446,8 @@ class Database:
                 'created_at': row[6],
                 'members_count': row[7],
                 'last_message': row[8],
-                'last_message_time': row[9]
+                'last_message_time': row[9],
+                'unread_count': row[10]
             })
         
         return chats
@@ -427,49 +472,62 @@ class Database:
         
         message_id = cursor.lastrowid
         self.conn.commit()
+        self.stats.incr("total_messages")
+        self.stats.hit("messages")
         
         self.log_action(sender_id, "send_message", message_id, "message", 
                        f"Отправлено в чат {chat_id}")
         
         return True, message_id
     
-    def get_chat_messages(self, chat_id, user_id, limit=50, offset=0):
-        """Получение сообщений чата"""
+    def get_chat_messages(self, chat_id, user_id, limit=50, before_id=None, after_id=None):
+        """Получение страницы сообщений чата по курсору.
+        
+        before_id - сообщения старше этого id, after_id - новее этого id.
+        Возвращает (messages, next_cursor) в хронологическом порядке.
+        """
         cursor = self.conn.cursor()
+        limit = max(1, min(int(limit), 200))
         
-        # Проверяем доступ
+        # Проверяем доступ и берем отметку прочтения участника
         cursor.execute('''
-        SELECT id FROM chat_members 
+        SELECT last_read_message_id FROM chat_members 
         WHERE chat_id = ? AND user_id = ?
         ''', (chat_id, user_id))
         
-        if not cursor.fetchone():
-            return []
+        member = cursor.fetchone()
+        if not member:
+            return [], None
+        last_read_id = member[0]
         
-        cursor.execute('''
+        # Диапазон по индексу (chat_id, id) вместо OFFSET:
+        # глубина прокрутки не влияет на стоимость запроса
+        if after_id is not None:
+            condition, order, cursor_id = "m.id > ?", "ASC", after_id
+        else:
+            condition, order = "m.id < ?", "DESC"
+            cursor_id = before_id if before_id is not None else 2 ** 63 - 1
+        
+        cursor.execute(f'''
         SELECT m.id, m.sender_id, u.username, u.display_name, u.tag, u.avatar_path,
                m.message_text, m.message_type, m.file_path, m.is_edited, 
-               m.edited_at, m.timestamp, m.read_by
+               m.edited_at, m.timestamp
         FROM messages m
         JOIN users u ON m.sender_id = u.id
-        WHERE m.chat_id = ? AND m.is_deleted = 0
-        ORDER BY m.timestamp DESC
-        LIMIT ? OFFSET ?
-        ''', (chat_id, limit, offset))
+        WHERE m.chat_id = ? AND {condition} AND m.is_deleted = 0
+        ORDER BY m.id {order}
+        LIMIT ?
+        ''', (chat_id, cursor_id, limit))
+        rows = cursor.fetchall()
+        
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        if order == "DESC":
+            rows.reverse()
         
         messages = []
-        for row in cursor.fetchall():
-            # Проверяем прочитано ли сообщение пользователем
-            read_by = json.loads(row[12] or '[]')
-            is_read = user_id in read_by
-            
-            # Если не прочитано - отмечаем как прочитанное
-            if not is_read and row[1] != user_id:  # Не свои сообщения
-                read_by.append(user_id)
-                cursor.execute('''
-                UPDATE messages SET read_by = ? WHERE id = ?
-                ''', (json.dumps(read_by), row[0]))
-            
+        max_id = 0
+        for row in rows:
+            max_id = max(max_id, row[0])
             messages.append({
                 'id': row[0],
                 'sender_id': row[1],
@@ -483,11 +541,80 @@ class Database:
                 'is_edited': bool(row[9]),
                 'edited_at': row[10],
                 'timestamp': row[11],
-                'is_read': is_read or row[1] == user_id
+                'is_read': row[0] <= last_read_id or row[1] == user_id
             })
         
+        # Отмечаем прочитанным все до последнего показанного сообщения
+        if max_id > last_read_id:
+            self.mark_read(chat_id, user_id, max_id)
+        
+        return messages, next_cursor
+    
+    def mark_read(self, chat_id, user_id, message_id):
+        """Сдвинуть отметку прочтения участника (одна строка, только вперед)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        UPDATE chat_members 
+        SET last_read_message_id = MAX(last_read_message_id, ?)
+        WHERE chat_id = ? AND user_id = ?
+        ''', (message_id, chat_id, user_id))
         self.conn.commit()
-        return list(reversed(messages))
+    
+    def get_unread_count(self, chat_id, user_id):
+        """Количество непрочитанных сообщений чата (от отметки прочтения)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT COUNT(*)
+        FROM chat_members cm
+        JOIN messages m ON m.chat_id = cm.chat_id AND m.id > cm.last_read_message_id
+        WHERE cm.chat_id = ? AND cm.user_id = ?
+          AND m.sender_id != cm.user_id AND m.is_deleted = 0
+        ''', (chat_id, user_id))
+        return cursor.fetchone()[0]
+    
+    def search_messages(self, user_id, query, limit=20, before_id=None):
+        """Полнотекстовый поиск по чатам пользователя, новые первыми.
+        
+        Возвращает (results, next_cursor); next_cursor передается как before_id.
+        """
+        match = fts_query(query, column="message_text")
+        if not match:
+            return [], None
+        
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT chat_id FROM chat_members WHERE user_id = ?", (user_id,))
+        chats = [f"c{row[0]}" for row in cursor.fetchall()]
+        if not chats:
+            return [], None
+        
+        limit = max(1, min(int(limit), 100))
+        cursor.execute('''
+        SELECT f.rowid, m.chat_id, m.sender_id, u.username, u.display_name, m.timestamp,
+               snippet(messages_fts, 0, '[', ']', '...', 12)
+        FROM messages_fts f
+        JOIN messages m ON m.id = f.rowid
+        JOIN users u ON u.id = m.sender_id
+        WHERE messages_fts MATCH ?
+          AND f.rowid < ?
+        ORDER BY f.rowid DESC
+        LIMIT ?
+        ''', (f"{match} AND chat:({' OR '.join(chats)})",
+              before_id if before_id is not None else 2 ** 63 - 1, limit))
+        
+        results = []
+        for row in cursor.fetchall():
+            results.append({
+                'id': row[0],
+                'chat_id': row[1],
+                'sender_id': row[2],
+                'sender_username': row[3],
+                'sender_display_name': row[4],
+                'timestamp': row[5],
+                'snippet': row[6]
+            })
+        
+        next_cursor = results[-1]['id'] if len(results) == limit else None
+        return results, next_cursor
     
     def is_admin(self, user_id):
         """Проверка является ли пользователь админом"""
@@ -534,6 +661,10 @@ class Database:
             from datetime import datetime, timedelta
             ban_until = (datetime.now() + timedelta(days=days)).isoformat()
         
+        cursor.execute("SELECT is_banned FROM users WHERE id = ?", (user_id,))
+        row = cursor.fetchone()
+        was_banned = bool(row and row[0])
+        
         cursor.execute('''
         UPDATE users SET is_banned = 1, ban_reason = ?, ban_until = ?
         WHERE id = ?
@@ -546,6 +677,8 @@ class Database:
         ''', (user_id,))
         
         self.conn.commit()
+        if row and not was_banned:
+            self.stats.incr("banned_users")
         
         duration = f"на {days} дней" if days > 0 else "навсегда"
         self.log_action(admin_id, "ban_user", user_id, "user", 
@@ -629,18 +762,11 @@ class Database:
         return True, "Сообщение удалено"
     
     def log_action(self, user_id, action_type, target_id=None, target_type=None, details=""):
-        """Логирование действий"""
-        cursor = self.conn.cursor()
-        
+        """Логирование действий (без ожидания записи на диск)"""
         # Маскируем IP в логах
         ip_address = "HIDDEN"  # Скрываем IP от пользователей
         
-        cursor.execute('''
-        INSERT INTO audit_log (user_id, action_type, target_id, target_type, details, ip_address)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, action_type, target_id, target_type, details, ip_address))
-        
-        self.conn.commit()
+        self.audit.append(user_id, action_type, target_id, target_type, details, ip_address)
     
     def get_audit_log(self, admin_id, limit=100):
         """Получение логов (только для админов)"""
@@ -648,9 +774,9 @@ class Database:
             return []
         
         cursor = self.conn.cursor()
-        cursor.execute('''
+        cursor.execute(f'''
         SELECT al.timestamp, u.username, al.action_type, al.target_type, al.details
-        FROM audit_log al
+        FROM {self.audit_table} al
         LEFT JOIN users u ON al.user_id = u.id
         ORDER BY al.timestamp DESC
         LIMIT ?
@@ -658,42 +784,50 @@ class Database:
         
         return cursor.fetchall()
     
+    def load_statistics(self):
+        """Начальные значения счетчиков: (итоги, события за сутки по минутам)"""
+        cursor = self.conn.cursor()
+        
+        totals = {}
+        for name, sql in (
+            ("total_users", "SELECT COUNT(*) FROM users"),
+            ("online_users", "SELECT COUNT(*) FROM users WHERE is_online = 1"),
+            ("total_chats", "SELECT COUNT(*) FROM chats"),
+            ("total_messages", "SELECT COUNT(*) FROM messages"),
+            ("banned_users", "SELECT COUNT(*) FROM users WHERE is_banned = 1"),
+        ):
+            totals[name] = cursor.execute(sql).fetchone()[0]
+        
+        # CURRENT_TIMESTAMP в SQLite - UTC
+        yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+        yesterday = yesterday.strftime("%Y-%m-%d %H:%M:%S")
+        recent = {}
+        for name, table, column in (("messages", "messages", "timestamp"),
+                                    ("new_users", "users", "created_at")):
+            cursor.execute(f'''
+            SELECT CAST(strftime('%s', {column}) AS INTEGER) / 60 * 60 AS minute, COUNT(*)
+            FROM {table} WHERE {column} > ?
+            GROUP BY minute
+            ''', (yesterday,))
+            recent[name] = [(minute, count) for minute, count in cursor.fetchall() if minute]
+        
+        return totals, recent
+    
     def get_statistics(self, admin_id):
-        """Получение статистики (только для админов)"""
+        """Получение статистики (только для админов), из счетчиков в памяти"""
         if not (self.is_admin(admin_id) or self.is_owner(admin_id)):
             return {}
         
-        cursor = self.conn.cursor()
-        
-        stats = {}
-        
-        # Общая статистика
-        cursor.execute("SELECT COUNT(*) FROM users")
-        stats['total_users'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_online = 1")
-        stats['online_users'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM chats")
-        stats['total_chats'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        stats['total_messages'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-        stats['banned_users'] = cursor.fetchone()[0]
-        
-        # Активность за последние 24 часа
-        from datetime import datetime, timedelta
-        yesterday = (datetime.now() - timedelta(days=1)).isoformat()
-        
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE timestamp > ?", (yesterday,))
-        stats['messages_last_24h'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE created_at > ?", (yesterday,))
-        stats['new_users_last_24h'] = cursor.fetchone()[0]
-        
-        return stats
+        return self.stats.snapshot()
+
+_db = None
+
 
-# Создаем глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+def __getattr__(name):
+    """database.db - глобальный экземпляр, создается при первом обращении, а не при импорте"""
+    global _db
+    if name == "db":
+        if _db is None:
+            _db = Database()
+        return _db
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
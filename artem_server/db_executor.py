@@ -0,0 +1,213 @@
+# db_executor.py - Асинхронный доступ к базе данных
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database.
+
+    Все записи идут через один поток-писатель с единственным соединением,
+    чтения - через пул потоков, у каждого свое read-only соединение (WAL).
+    Event loop никогда не ждет SQLite напрямую.
+    """
+
+    # Методы, которые ничего не пишут в базу и могут выполняться параллельно
+    READ_METHODS = frozenset({
+        "get_user_by_id",
+        "get_login_user",
+        "get_user_profile",
+        "search_users",
+        "get_conversations",
+        "get_read_marks",
+        "search_messages",
+        "get_users_by_ids",
+        "get_users_for_index",
+        "load_statistics",
+        "admin_search_users",
+        "verify_session",
+        "next_session_expiry",
+        "get_moderation_expirations",
+        "backup",
+        "get_chat",
+        "get_user_chats",
+        "get_chat_messages",
+    })
+
+    def __init__(self, database_cls, db_name, readers=4, **db_options):
+        self.database_cls = database_cls
+        self.db_name = db_name
+
+        # Соединение писателя создает таблицы и настраивает журнал
+        self.writer_db = database_cls(db_name, **db_options)
+
+        self._local = threading.local()
+        self._reader_dbs = []
+        self._reader_lock = threading.Lock()
+
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        # Хранилище без параллельных чтений (в памяти) - все в одном потоке
+        self.concurrent_reads = getattr(database_cls, "concurrent_reads", True)
+
+    def _reader_db(self):
+        """Read-only соединение текущего потока-читателя"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self.database_cls(self.db_name, read_only=True)
+            self._local.db = db
+            with self._reader_lock:
+                self._reader_dbs.append(db)
+        return db
+
+    async def write(self, method, *args, **kwargs):
+        """Выполнить метод Database в потоке-писателе"""
+        loop = asyncio.get_running_loop()
+        func = functools.partial(getattr(self.writer_db, method), *args, **kwargs)
+        return await loop.run_in_executor(self.writer, func)
+
+    async def read(self, method, *args, **kwargs):
+        """Выполнить метод Database в пуле читателей"""
+        if not self.concurrent_reads:
+            return await self.write(method, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+
+        def call():
+            return getattr(self._reader_db(), method)(*args, **kwargs)
+
+        return await loop.run_in_executor(self.readers, call)
+
+    def __getattr__(self, name):
+        # Awaitable-версия любого публичного метода Database
+        if name.startswith("_") or not callable(getattr(self.database_cls, name, None)):
+            raise AttributeError(name)
+
+        runner = self.read if name in self.READ_METHODS else self.write
+
+        async def method(*args, **kwargs):
+            return await runner(name, *args, **kwargs)
+
+        method.__name__ = name
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        """Дождаться завершения запросов и закрыть соединения"""
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        for db in self._reader_dbs:
+            db.close()
+        self.writer_db.close()
+
+
+class MessageBatcher:
+    """Групповая запись сообщений.
+
+    Вставки из process_message копятся в очереди и сбрасываются одной
+    транзакцией каждые batch_size сообщений или flush_interval секунд.
+    save() возвращает (id, timestamp, is_new) только после коммита всей пачки.
+
+    Последние recent_size пар (sender_id, client_msg_id) помнятся вместе с
+    результатом записи: повтор, пока запись в памяти (в том числе пока первая
+    попытка еще в очереди), получает тот же результат без обращения к базе.
+    Более старые повторы ловит уникальный индекс в самой базе.
+    """
+
+    def __init__(self, db, batch_size=128, flush_interval=0.005, recent_size=10000):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.recent_size = recent_size
+        self.recent = OrderedDict()  # (sender_id, client_msg_id) -> future записи
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def save(self, sender_id, receiver_id, text, client_msg_id=None):
+        """Поставить сообщение в очередь и дождаться его записи на диск"""
+        key = (sender_id, client_msg_id)
+        if client_msg_id is not None and key in self.recent:
+            self.recent.move_to_end(key)
+            message_id, timestamp, _ = await asyncio.shield(self.recent[key])
+            return message_id, timestamp, False
+
+        future = asyncio.get_running_loop().create_future()
+        if client_msg_id is not None:
+            self.remember(key, future)
+        self.queue.put_nowait(((sender_id, receiver_id, text, client_msg_id), future))
+        if self.queue.qsize() >= self.batch_size:
+            self._full.set()
+        return await future
+
+    def remember(self, key, future):
+        self.recent[key] = future
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+
+        def forget(future):
+            # Неудачную запись можно повторить с тем же client_msg_id
+            if not future.cancelled() and future.exception() is None:
+                return
+            if self.recent.get(key) is future:
+                del self.recent[key]
+
+        future.add_done_callback(forget)
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            
+            # Ждем добора пачки, но не дольше flush_interval
+            if self.flush_interval > 0 and self.queue.qsize() + 1 < self.batch_size:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            
+            while len(batch) < self.batch_size and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        rows = [row for row, _ in batch]
+        try:
+            saved = await self.db.write("save_messages", rows)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        # Хранилище с шардами может вернуть исключение вместо результата части пачки
+        for (_, future), result in zip(batch, saved):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def stop(self):
+        """Записать все, что уже стоит в очереди, и остановиться"""
+        if self.task is None:
+            return
+        self.queue.put_nowait(None)
+        self._full.set()
+        await self.task
+        self.task = None
@@ -0,0 +1,187 @@
+# maintenance.py - Плановое обслуживание файлов SQLite в окно низкой нагрузки
+#
+# Работы (каждая - не чаще раза в сутки):
+#   optimize   - PRAGMA optimize (пересчет статистики, которую планировщик считает устаревшей)
+#   analyze    - ANALYZE всех таблиц с ограничением analysis_limit
+#   checkpoint - контрольная точка WAL с усечением файла журнала
+#   vacuum     - incremental_vacuum: свободные страницы возвращаются файловой системе
+#   backup     - онлайн-копия через sqlite3 backup API
+# Запускаются только внутри окна MAINTENANCE_WINDOW (местное время) и только
+# пока поток сообщений ниже MAINTENANCE_MAX_RATE в минуту. SQL-работы идут в
+# потоке-писателе с бюджетом времени: по его исчерпании запрос прерывается
+# (progress handler) и откатывается, база остается как была.
+import asyncio
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+
+JOBS = ("optimize", "analyze", "checkpoint", "vacuum", "backup")
+JOB_INTERVAL = 20 * 3600    # повтор работы не раньше чем через 20 часов
+CHECK_INTERVAL = 60         # как часто проверять окно и нагрузку, секунд
+OPTIMIZE_LIMIT = 400        # analysis_limit для PRAGMA optimize (рекомендация SQLite)
+ANALYZE_LIMIT = 10000       # analysis_limit для ANALYZE: строк на индекс
+VACUUM_STEP = 1000          # страниц на один incremental_vacuum
+
+
+def parse_window(value):
+    """"03:00-05:00" -> (180, 300) в минутах от полуночи; пусто - None"""
+    if not value:
+        return None
+    try:
+        start, end = (datetime.strptime(part.strip(), "%H:%M") for part in value.split("-"))
+    except ValueError:
+        raise ValueError(f"Окно обслуживания должно быть вида 03:00-05:00, а не {value!r}")
+    return start.hour * 60 + start.minute, end.hour * 60 + end.minute
+
+
+def in_window(window, now=None):
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    start, end = window
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end  # окно через полночь
+
+
+def run_job(conn, job, budget_ms):
+    """Выполнить SQL-работу на соединении писателя, вернуть краткий итог"""
+    deadline = time.monotonic() + budget_ms / 1000
+    # Прерывание долгого запроса: SQLite откатит его с "interrupted"
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        if job == "optimize":
+            conn.execute(f"PRAGMA analysis_limit = {OPTIMIZE_LIMIT}")
+            conn.execute("PRAGMA optimize")
+            conn.commit()
+            return "ok"
+        if job == "analyze":
+            conn.execute(f"PRAGMA analysis_limit = {ANALYZE_LIMIT}")
+            conn.execute("ANALYZE")
+            conn.commit()
+            return "ok"
+        if job == "checkpoint":
+            # TRUNCATE ждет читателей не дольше busy_timeout соединения
+            busy, log_pages, done = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if log_pages < 0:
+                return "журнал не WAL"
+            return f"{done}/{log_pages} страниц" + (", ждали читателей" if busy else "")
+        if job == "vacuum":
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return "auto_vacuum не INCREMENTAL (нужен VACUUM)"
+            freed = 0
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            while free and time.monotonic() < deadline:
+                conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP})").fetchall()
+                conn.commit()
+                left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                freed += free - left
+                free = left
+            return f"освобождено {freed} страниц, осталось {free}"
+        raise ValueError(f"Неизвестная работа обслуживания: {job}")
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        if "interrupted" in str(e):
+            return f"прервано по бюджету {budget_ms} мс"
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def backup_connection(conn, path):
+    """Копия базы соединения conn в файл path через backup API.
+
+    Копия делается за один шаг из снимка читателя: в режиме WAL писатели
+    его не ждут. Файл появляется под своим именем только целиком.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + ".partial")
+    target = sqlite3.connect(partial)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+    partial.replace(path)
+    return path.stat().st_size
+
+
+class MaintenanceScheduler:
+    """Запускает работы из JOBS в окно обслуживания и хранит их последние итоги.
+
+    db - AsyncDatabase или ShardedDatabase: run_maintenance(job, budget_ms)
+    выполняется в потоке-писателе, backup(path) - в потоке-читателе.
+    """
+
+    def __init__(self, db, stats, window, max_rate, budget_ms, backup_dir="", backup_keep=7,
+                 db_name="artem_messenger.db"):
+        self.db = db
+        self.stats = stats
+        self.window = parse_window(window)
+        self.max_rate = max_rate
+        self.budget_ms = budget_ms
+        self.backup_dir = Path(backup_dir) if backup_dir else None
+        self.backup_keep = backup_keep
+        self.db_stem = Path(db_name).stem
+        self.last_run = {}  # job -> time.time() последнего запуска
+        self.results = {}   # job -> {"at", "duration_ms", "result"}
+
+    def busy(self):
+        return self.stats.rate("messages") > self.max_rate
+
+    def due(self):
+        jobs = [job for job in JOBS if job != "backup" or self.backup_dir]
+        return [job for job in jobs if time.time() - self.last_run.get(job, 0) >= JOB_INTERVAL]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            if self.window and in_window(self.window):
+                await self.run_due()
+
+    async def run_due(self):
+        """Выполнить все просроченные работы, пока нагрузка низкая"""
+        for job in self.due():
+            if self.busy():
+                break
+            await self.run_one(job)
+
+    async def run_one(self, job):
+        started = time.perf_counter()
+        self.last_run[job] = time.time()
+        try:
+            if job == "backup":
+                result = await self.backup()
+            else:
+                result = await self.db.run_maintenance(job, self.budget_ms)
+        except Exception as e:
+            result = f"ошибка: {e}"
+        if result is None:
+            return  # хранилищу без файла обслуживать нечего
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.results[job] = {
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "duration_ms": duration_ms,
+            "result": result,
+        }
+        print(f"🛠️ Обслуживание {job}: {duration_ms} мс, {result}")
+
+    async def backup(self):
+        """Копия в backup_dir/<база>-<время>.db, старше backup_keep копий удаляются"""
+        if not self.backup_dir:
+            return None
+        prefix = f"{self.db_stem}-"
+        name = f"{prefix}{datetime.now():%Y%m%d-%H%M%S}.db"
+        size = await self.db.backup(str(self.backup_dir / name))
+        if size is None:
+            return None
+        # Копия - это файл базы и файлы ее шардов (<имя>.shardN.db) с одной меткой времени
+        stamps = sorted({path.name[len(prefix):len(prefix) + 15]
+                         for path in self.backup_dir.glob(prefix + "*.db")})
+        for stamp in stamps[:-self.backup_keep]:
+            for path in self.backup_dir.glob(f"{prefix}{stamp}.*"):
+                path.unlink()
+        return f"{name}, {size / 1024 / 1024:.1f} МБ"
+
+    def report(self):
+        return dict(self.results)
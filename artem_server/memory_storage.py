@@ -0,0 +1,684 @@
+# memory_storage.py - Хранилище в памяти (нагрузочные тесты, CI)
+#
+# Повторяет поведение Database из server.py: те же ответы, порядок сортировки,
+# курсоры и ошибки, но без SQLite и без файлов. Данные живут до остановки процесса.
+import heapq
+import re
+import secrets
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+
+from passwords import hash_password
+from records import Message, MessageMatch, Conversation, User, UserSummary, ChatMessage, ChatSummary
+from storage import (Storage, DEFAULT_USERS, SESSION_DAYS, MAX_MESSAGE_ID,
+                     message_preview, sql_timestamp, print_default_users)
+
+# LIKE в SQLite без учета регистра только для ASCII
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+SNIPPET_TOKENS = 12
+# Слова как у токенайзера unicode61: буквы и цифры, "_" - разделитель
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def _like(value, query):
+    """Аналог value LIKE '%query%'"""
+    return value is not None and query.translate(_ASCII_LOWER) in value.translate(_ASCII_LOWER)
+
+
+def _page(ids, condition, cursor_id, limit):
+    """До limit id из отсортированного списка: "<" - старше курсора, ">" - новее"""
+    if condition == "<":
+        end = bisect_left(ids, cursor_id)
+        return ids[max(0, end - limit):end][::-1]
+    start = bisect_right(ids, cursor_id)
+    return ids[start:start + limit]
+
+
+class MemoryStorage(Storage):
+    """Хранилище в словарях с теми же ответами, что и у Database"""
+
+    # Один экземпляр на процесс, все вызовы - из потока-писателя AsyncDatabase
+    concurrent_reads = False
+
+    def __init__(self, db_name=None, read_only=False, **options):
+        self.lock = threading.RLock()
+        self.users = {}         # id -> dict полей таблицы users
+        self.by_username = {}   # username -> id
+        self.by_tag = {}        # tag -> id
+        self.by_email = {}      # email -> set(id): при регистрации email не уникален
+        self.next_user_id = 1
+
+        self.sessions = {}      # token -> (user_id, expires_at)
+        self.session_expiry = []  # куча (expires_at, token)
+
+        self.messages = {}      # id -> (sender_id, receiver_id, text, timestamp)
+        self.pair_ids = {}      # (sender_id, receiver_id) -> [id] по возрастанию
+        self.user_ids = {}      # user_id -> [id] всех сообщений пользователя
+        self.client_ids = {}    # (sender_id, client_msg_id) -> id
+        self.last_message_id = 0
+
+        self.conversations = {}  # (user_id, peer_id) -> dict сводки
+        self.user_peers = {}     # user_id -> set(peer_id)
+
+        self.chats = {}          # id -> dict полей таблицы chats
+        self.chat_members = {}   # chat_id -> {user_id: [role, is_muted]}
+        self.user_chats = {}     # user_id -> set(chat_id)
+        self.chat_messages = {}  # id -> (chat_id, sender_id, text, timestamp)
+        self.chat_message_ids = {}  # chat_id -> [id] по возрастанию
+        self.next_chat_id = 1
+        self.last_chat_message_id = 0
+
+        self.create_default_users()
+
+    def create_default_users(self):
+        for username, tag, password, email, phone, bio, is_admin, is_owner, is_blocked in DEFAULT_USERS:
+            self._insert_user(username, tag, hash_password(password), email, phone,
+                              bio=bio, is_admin=is_admin, is_owner=is_owner, is_blocked=is_blocked)
+        print_default_users()
+
+    def _insert_user(self, username, tag, password_hash, email=None, phone=None, **fields):
+        user_id = self.next_user_id
+        self.next_user_id += 1
+        self.users[user_id] = {
+            "id": user_id, "username": username, "tag": tag, "password_hash": password_hash,
+            "email": email, "phone": phone, "bio": None, "is_online": False,
+            "is_admin": False, "is_owner": False, "is_blocked": False, "is_muted": False,
+            "mute_expires_at": None, "ban_expires_at": None, "created_at": sql_timestamp(),
+            "last_seen": None,
+        }
+        self.users[user_id].update(fields)
+        self.by_username[username] = user_id
+        self.by_tag[tag] = user_id
+        if email is not None:
+            self.by_email.setdefault(email, set()).add(user_id)
+        return user_id
+
+    # Пользователи
+
+    def register_user(self, username, tag, password_hash, email=None, phone=None):
+        """Регистрация; пароль приходит уже захешированным (PasswordHasher)"""
+        with self.lock:
+            if username in self.by_username or tag in self.by_tag:
+                return False, "Имя пользователя или тэг уже заняты"
+            if not tag.startswith("@"):
+                tag = "@" + tag
+            if tag in self.by_tag:
+                return False, "UNIQUE constraint failed: users.tag"
+            return True, self._insert_user(username, tag, password_hash, email, phone)
+
+    def get_login_user(self, identifier):
+        with self.lock:
+            candidates = [self.by_username.get(identifier), self.by_tag.get(identifier)]
+            candidates += self.by_email.get(identifier, ())
+            candidates = [user_id for user_id in candidates if user_id is not None]
+            if not candidates:
+                return False, "Пользователь не найден"
+
+            user = self.users[min(candidates)]
+            if user["is_blocked"]:
+                return False, "Аккаунт заблокирован"
+            return True, {
+                "user_id": user["id"],
+                "username": user["username"],
+                "tag": user["tag"],
+                "password_hash": user["password_hash"],
+                "is_admin": bool(user["is_admin"]),
+                "is_owner": bool(user["is_owner"]),
+                "is_blocked": bool(user["is_blocked"]),
+                "is_muted": bool(user["is_muted"])
+            }
+
+    def get_user_by_id(self, user_id):
+        user = self.users.get(user_id)
+        if not user:
+            return None
+        return User(user["id"], user["username"], user["tag"], user["email"], user["phone"],
+                    user["bio"], bool(user["is_online"]), user["last_seen"])
+
+    def get_user_profile(self, user_id):
+        user = self.users.get(user_id)
+        if not user:
+            return None
+        return {
+            "username": user["username"],
+            "tag": user["tag"],
+            "email": user["email"],
+            "phone": user["phone"],
+            "bio": user["bio"],
+            "is_admin": bool(user["is_admin"]),
+            "is_owner": bool(user["is_owner"]),
+            "created_at": user["created_at"],
+            "is_muted": bool(user["is_muted"]),
+            "mute_expires_at": user["mute_expires_at"]
+        }
+
+    def update_user_profile(self, user_id, username=None, email=None, phone=None, bio=None):
+        with self.lock:
+            others = [user for uid, user in self.users.items() if uid != user_id]
+            updates = {}
+
+            if username is not None:
+                if any(user["username"] == username for user in others):
+                    return False, "Имя пользователя уже занято"
+                updates["username"] = username
+
+            if email is not None:
+                if email and self.by_email.get(email, set()) - {user_id}:
+                    return False, "Email уже используется"
+                updates["email"] = email or None
+
+            if phone is not None:
+                if phone and any(user["phone"] == phone for user in others):
+                    return False, "Телефон уже используется"
+                updates["phone"] = phone or None
+
+            if bio is not None:
+                updates["bio"] = bio
+
+            if not updates:
+                return False, "Нет данных для обновления"
+
+            user = self.users.get(user_id)
+            if user:
+                if "username" in updates:
+                    del self.by_username[user["username"]]
+                    self.by_username[updates["username"]] = user_id
+                if "email" in updates and user["email"] is not None:
+                    self.by_email[user["email"]].discard(user_id)
+                    if not self.by_email[user["email"]]:
+                        del self.by_email[user["email"]]
+                if updates.get("email") is not None:
+                    self.by_email.setdefault(updates["email"], set()).add(user_id)
+                user.update(updates)
+            return True, "Профиль успешно обновлен"
+
+    def search_users(self, query, current_user_id):
+        users = []
+        for user in self.users.values():
+            if len(users) >= 20:
+                break
+            if user["id"] == current_user_id or user["is_blocked"]:
+                continue
+            if _like(user["username"], query) or _like(user["tag"], query):
+                users.append(UserSummary(user["id"], user["username"], user["tag"],
+                                         bool(user["is_online"]), user["last_seen"]))
+        return users
+
+    def get_users_by_ids(self, user_ids):
+        users = {}
+        for user_id in user_ids:
+            user = self.users.get(user_id)
+            if user:
+                users[user_id] = {
+                    "username": user["username"],
+                    "tag": user["tag"],
+                    "last_seen": user["last_seen"],
+                    "is_blocked": bool(user["is_blocked"])
+                }
+        return users
+
+    def get_users_for_index(self):
+        return [(user["id"], user["username"], user["tag"], int(user["is_blocked"]))
+                for user in self.users.values()]
+
+    def save_presence(self, rows):
+        with self.lock:
+            for is_online, last_seen, user_id in rows:
+                user = self.users.get(user_id)
+                if user:
+                    user["is_online"] = bool(is_online)
+                    user["last_seen"] = last_seen
+
+    def reset_presence(self):
+        with self.lock:
+            online = [user for user in self.users.values() if user["is_online"]]
+            for user in online:
+                user["is_online"] = False
+            return len(online)
+
+    # Сессии
+
+    def login_user(self, user, password_hash=None):
+        with self.lock:
+            if password_hash and user["user_id"] in self.users:
+                self.users[user["user_id"]]["password_hash"] = password_hash
+            session_token = self.create_session(user["user_id"])
+            return True, {**user, "session_token": session_token}
+
+    def create_session(self, user_id, commit=True):
+        session_token = secrets.token_urlsafe(32)
+        expires_at = (datetime.now() + timedelta(days=SESSION_DAYS)).isoformat()
+        with self.lock:
+            self.sessions[session_token] = (user_id, expires_at)
+            heapq.heappush(self.session_expiry, (expires_at, session_token))
+        return session_token
+
+    def verify_session(self, session_token):
+        session = self.sessions.get(session_token)
+        if not session or session[1] <= datetime.now().isoformat():
+            return False, "Сессия истекла или недействительна"
+
+        user_id, expires_at = session
+        user = self.users.get(user_id)
+        if not user:
+            return False, "Сессия истекла или недействительна"
+        if user["is_blocked"]:
+            return False, "Аккаунт заблокирован"
+
+        return True, {
+            "user_id": user_id,
+            "username": user["username"],
+            "tag": user["tag"],
+            "session_token": session_token,
+            "is_admin": bool(user["is_admin"]),
+            "is_owner": bool(user["is_owner"]),
+            "is_blocked": bool(user["is_blocked"]),
+            "is_muted": bool(user["is_muted"]),
+            "expires_at": expires_at
+        }
+
+    def delete_expired_sessions(self, batch_size=500):
+        now = datetime.now().isoformat()
+        deleted = []
+        with self.lock:
+            while self.session_expiry and len(deleted) < batch_size and self.session_expiry[0][0] <= now:
+                expires_at, token = heapq.heappop(self.session_expiry)
+                session = self.sessions.get(token)
+                if session and session[1] == expires_at:
+                    del self.sessions[token]
+                    deleted.append(token)
+        return deleted
+
+    def next_session_expiry(self):
+        with self.lock:
+            return self.session_expiry[0][0] if self.session_expiry else None
+
+    # Сообщения и беседы
+
+    def save_messages(self, rows):
+        saved = []
+        with self.lock:
+            for sender_id, receiver_id, text, client_msg_id in rows:
+                if client_msg_id is not None:
+                    original_id = self.client_ids.get((sender_id, client_msg_id))
+                    if original_id is not None:
+                        saved.append((original_id, self.messages[original_id][3], False))
+                        continue
+                timestamp = sql_timestamp()
+                self.last_message_id += 1
+                message_id = self.last_message_id
+                saved.append((message_id, timestamp, True))
+
+                self.messages[message_id] = (sender_id, receiver_id, text, timestamp)
+                if client_msg_id is not None:
+                    self.client_ids[(sender_id, client_msg_id)] = message_id
+                self.pair_ids.setdefault((sender_id, receiver_id), []).append(message_id)
+                for user_id in {sender_id, receiver_id}:
+                    self.user_ids.setdefault(user_id, []).append(message_id)
+
+                preview = message_preview(text)
+                for user_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+                    conversation = self._conversation(user_id, peer_id)
+                    conversation.update(last_message_id=message_id, last_message=preview,
+                                        last_timestamp=timestamp)
+        return saved
+
+    def _conversation(self, user_id, peer_id):
+        conversation = self.conversations.get((user_id, peer_id))
+        if conversation is None:
+            conversation = self.conversations[(user_id, peer_id)] = {
+                "last_message_id": None, "last_message": None,
+                "last_timestamp": None, "last_read_message_id": 0,
+            }
+            self.user_peers.setdefault(user_id, set()).add(peer_id)
+        return conversation
+
+    def get_chat_history(self, user1_id, user2_id, limit=50, before_id=None, after_id=None):
+        limit = max(1, min(int(limit), 200))
+        if after_id is not None:
+            condition, cursor_id = ">", after_id
+        else:
+            condition = "<"
+            cursor_id = before_id if before_id is not None else MAX_MESSAGE_ID
+
+        with self.lock:
+            pairs = [(user1_id, user2_id)]
+            if user1_id != user2_id:
+                pairs.append((user2_id, user1_id))
+            ids = []
+            for pair in pairs:
+                ids += _page(self.pair_ids.get(pair, []), condition, cursor_id, limit)
+            ids.sort(reverse=condition == "<")
+            ids = [message_id for message_id in ids
+                   if self.messages[message_id][0] in self.users][:limit]
+
+            next_cursor = ids[-1] if len(ids) == limit else None
+            if condition == ">":
+                ids.reverse()
+
+            read_marks = self.get_read_marks(user1_id, user2_id)
+            messages = []
+            last_received_id = 0
+            for message_id in ids:
+                sender_id, receiver_id, text, timestamp = self.messages[message_id]
+                sender = self.users[sender_id]
+                if receiver_id == user1_id:
+                    last_received_id = max(last_received_id, message_id)
+                messages.append(Message(message_id, sender_id, receiver_id, text, timestamp,
+                                        message_id <= read_marks[receiver_id],
+                                        sender["username"], sender["tag"]))
+
+            if last_received_id > read_marks[user1_id]:
+                self.mark_read(user1_id, user2_id, last_received_id)
+
+        return messages, next_cursor
+
+    def search_messages(self, user_id, query, limit=20, before_id=None):
+        """Поиск всех слов запроса как отдельных слов сообщения (как FTS5 unicode61)"""
+        words = {word.lower() for word in _TOKEN_RE.findall(query or "")}
+        if not words:
+            return [], None
+
+        limit = max(1, min(int(limit), 100))
+        cursor_id = before_id if before_id is not None else MAX_MESSAGE_ID
+        results = []
+        with self.lock:
+            ids = self.user_ids.get(user_id, [])
+            for index in range(bisect_left(ids, cursor_id) - 1, -1, -1):
+                message_id = ids[index]
+                sender_id, receiver_id, text, timestamp = self.messages[message_id]
+                tokens = list(_TOKEN_RE.finditer(text))
+                if not words <= {token.group().lower() for token in tokens}:
+                    continue
+                sender = self.users.get(sender_id)
+                if not sender:
+                    continue
+                results.append(MessageMatch(message_id, sender_id, receiver_id, timestamp,
+                                            self._snippet(text, tokens, words),
+                                            sender["username"], sender["tag"]))
+                if len(results) >= limit:
+                    break
+
+        next_cursor = results[-1].id if len(results) == limit else None
+        return results, next_cursor
+
+    @staticmethod
+    def _snippet(text, tokens, words):
+        """Фрагмент до SNIPPET_TOKENS слов с [совпадениями] - окно выбирается как в snippet() FTS5"""
+        hits = [i for i, token in enumerate(tokens) if token.group().lower() in words]
+
+        def score(first):
+            window = [i for i in hits if first <= i < first + SNIPPET_TOKENS]
+            seen = {tokens[i].group().lower() for i in window}
+            return 1000 * len(seen) + len(window) - len(seen), window
+
+        # Начала предложений: первое слово и слова после ". " или ": "
+        sentences = [0] + [i for i in range(1, len(tokens))
+                           if re.search(r"[.:]\s+$", text[tokens[i - 1].end():tokens[i].start()])]
+        best_score, start = 0, 0
+        for hit in hits:
+            hit_score, window = score(hit)
+            if hit_score > best_score:
+                # Окно центрируется по совпадениям, попавшим в него
+                first, last = window[0], window[-1] + 1
+                best_score = hit_score
+                start = max(0, min(first - (SNIPPET_TOKENS - (last - first)) // 2,
+                                   len(tokens) - SNIPPET_TOKENS))
+            sentence = max(i for i in sentences if i <= hit)
+            if sentence < hit and len(tokens) > SNIPPET_TOKENS:
+                sentence_score = score(sentence)[0] + (120 if sentence == 0 else 100)
+                if sentence_score > best_score:
+                    best_score, start = sentence_score, sentence
+
+        window = tokens[start:start + SNIPPET_TOKENS]
+        parts = ["..." if start > 0 else text[:window[0].start()]]
+        for i, token in enumerate(window):
+            word = token.group()
+            parts.append(f"[{word}]" if word.lower() in words else word)
+            if i + 1 < len(window):
+                parts.append(text[token.end():window[i + 1].start()])
+        if start + len(window) < len(tokens):
+            parts.append("...")
+        else:
+            parts.append(text[window[-1].end():])
+        return "".join(parts)
+
+    def get_conversations(self, user_id):
+        with self.lock:
+            rows = []
+            for peer_id in self.user_peers.get(user_id, ()):
+                peer = self.users.get(peer_id)
+                if not peer or peer["is_blocked"]:
+                    continue
+                conversation = self.conversations[(user_id, peer_id)]
+                received = self.pair_ids.get((peer_id, user_id), [])
+                order = (conversation["last_timestamp"] or "", conversation["last_message_id"] or 0)
+                # is_online проставляет сервер по открытым соединениям
+                rows.append((order, Conversation(
+                    peer_id, conversation["last_timestamp"], conversation["last_message"],
+                    peer["username"], peer["tag"], False, peer["last_seen"],
+                    len(received) - bisect_right(received, conversation["last_read_message_id"]))))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return [conversation for _, conversation in rows]
+
+    def get_read_marks(self, user1_id, user2_id):
+        marks = {user1_id: 0, user2_id: 0}
+        for user_id, peer_id in ((user1_id, user2_id), (user2_id, user1_id)):
+            conversation = self.conversations.get((user_id, peer_id))
+            if conversation:
+                marks[user_id] = conversation["last_read_message_id"]
+        return marks
+
+    def mark_read(self, user_id, peer_id, message_id, commit=True):
+        with self.lock:
+            conversation = self._conversation(user_id, peer_id)
+            conversation["last_read_message_id"] = max(conversation["last_read_message_id"], message_id)
+
+    def archive_messages(self, cutoff, batch_size=5000):
+        """Архива у хранилища в памяти нет"""
+        return 0
+
+    # Групповые чаты и каналы
+
+    def create_chat(self, creator_id, name, is_channel=False, member_ids=()):
+        with self.lock:
+            member_ids = set(member_ids) - {creator_id}
+            missing = sorted(user_id for user_id in member_ids
+                             if user_id not in self.users or self.users[user_id]["is_blocked"])
+            if missing:
+                return False, "Пользователи не найдены: " + ", ".join(map(str, missing))
+            chat_id = self.next_chat_id
+            self.next_chat_id += 1
+            self.chats[chat_id] = {"name": name, "is_channel": bool(is_channel), "last_message_id": 0,
+                                   "last_message": None, "last_timestamp": None}
+            members = self.chat_members[chat_id] = {creator_id: ["creator", False]}
+            self.chat_message_ids[chat_id] = []
+            for user_id in sorted(member_ids):
+                members[user_id] = ["member", False]
+            for user_id in members:
+                self.user_chats.setdefault(user_id, set()).add(chat_id)
+            return True, ChatSummary(chat_id, name, bool(is_channel), "creator", len(members), None, None)
+
+    def join_chat(self, chat_id, user_id):
+        with self.lock:
+            members = self.chat_members.get(chat_id)
+            if members is None:
+                return False, "Чат не найден"
+            if not self.chats[chat_id]["is_channel"]:
+                return False, "В группу можно попасть только по приглашению"
+            if user_id in members:
+                return False, "Вы уже состоите в этом чате"
+            members[user_id] = ["member", False]
+            self.user_chats.setdefault(user_id, set()).add(chat_id)
+            return True, None
+
+    def add_chat_member(self, chat_id, user_id):
+        with self.lock:
+            members = self.chat_members.get(chat_id)
+            if members is None:
+                return False, "Чат не найден"
+            user = self.users.get(user_id)
+            if not user or user["is_blocked"]:
+                return False, "Пользователь не найден"
+            if user_id in members:
+                return False, "Пользователь уже состоит в этом чате"
+            members[user_id] = ["member", False]
+            self.user_chats.setdefault(user_id, set()).add(chat_id)
+            return True, None
+
+    def leave_chat(self, chat_id, user_id):
+        with self.lock:
+            members = self.chat_members.get(chat_id, {})
+            if members.pop(user_id, None) is None:
+                return False, "Вы не состоите в этом чате"
+            self.user_chats[user_id].discard(chat_id)
+            return True, None
+
+    def set_chat_member_muted(self, chat_id, user_id, is_muted):
+        with self.lock:
+            member = self.chat_members.get(chat_id, {}).get(user_id)
+            if member is None:
+                return False, "Пользователь не состоит в этом чате"
+            member[1] = bool(is_muted)
+            return True, None
+
+    def get_chat(self, chat_id):
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                return None
+            members = {user_id: tuple(member) for user_id, member in self.chat_members[chat_id].items()}
+            return ChatSummary(chat_id, chat["name"], chat["is_channel"], None, len(members),
+                               chat["last_message"], chat["last_timestamp"]), members
+
+    def get_user_chats(self, user_id):
+        with self.lock:
+            chats = []
+            for chat_id in self.user_chats.get(user_id, ()):
+                chat = self.chats[chat_id]
+                members = self.chat_members[chat_id]
+                chats.append((chat["last_message_id"], chat_id, ChatSummary(
+                    chat_id, chat["name"], chat["is_channel"], members[user_id][0],
+                    len(members), chat["last_message"], chat["last_timestamp"])))
+        chats.sort(reverse=True)
+        return [summary for _, _, summary in chats]
+
+    def save_chat_message(self, chat_id, sender_id, text):
+        with self.lock:
+            timestamp = sql_timestamp()
+            self.last_chat_message_id += 1
+            message_id = self.last_chat_message_id
+            self.chat_messages[message_id] = (chat_id, sender_id, text, timestamp)
+            self.chat_message_ids[chat_id].append(message_id)
+            self.chats[chat_id].update(last_message_id=message_id, last_message=message_preview(text),
+                                       last_timestamp=timestamp)
+            return message_id, timestamp
+
+    def get_chat_messages(self, chat_id, limit=50, before_id=None):
+        limit = max(1, min(int(limit), 200))
+        with self.lock:
+            ids = _page(self.chat_message_ids.get(chat_id, []), "<",
+                        before_id if before_id is not None else MAX_MESSAGE_ID, limit)
+            messages = []
+            for message_id in ids:
+                _, sender_id, text, timestamp = self.chat_messages[message_id]
+                sender = self.users[sender_id]
+                messages.append(ChatMessage(message_id, chat_id, sender_id, text, timestamp,
+                                            sender["username"], sender["tag"]))
+        next_cursor = messages[-1].id if len(messages) == limit else None
+        return messages, next_cursor
+
+    def load_statistics(self):
+        totals = {
+            "total_users": len(self.users),
+            "banned_users": sum(1 for user in self.users.values() if user["is_blocked"]),
+            "total_messages": self.last_message_id,
+            "total_chats": len(self.chats),
+        }
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+        def by_minute(timestamps):
+            counts = {}
+            for timestamp in timestamps:
+                if timestamp and timestamp > yesterday:
+                    at = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+                    minute = int(at.timestamp()) // 60 * 60
+                    counts[minute] = counts.get(minute, 0) + 1
+            return sorted(counts.items())
+
+        return totals, {
+            "messages": by_minute(message[3] for message in self.messages.values()),
+            "new_users": by_minute(user["created_at"] for user in self.users.values()),
+        }
+
+    # Модерация
+
+    def admin_search_users(self, query):
+        users = []
+        for user in self.users.values():
+            if len(users) >= 20:
+                break
+            if _like(user["username"], query) or _like(user["tag"], query) or _like(user["email"], query):
+                users.append({
+                    "id": user["id"],
+                    "username": user["username"],
+                    "tag": user["tag"],
+                    "email": user["email"],
+                    "is_online": bool(user["is_online"]),
+                    "is_blocked": bool(user["is_blocked"]),
+                    "is_muted": bool(user["is_muted"]),
+                    "created_at": user["created_at"]
+                })
+        return users
+
+    def _update_user(self, user_id, **fields):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                user.update(fields)
+
+    def ban_user(self, user_id, reason, duration_days):
+        ban_expires = None
+        if duration_days > 0:
+            ban_expires = (datetime.now() + timedelta(days=duration_days)).isoformat()
+        self._update_user(user_id, is_blocked=True, ban_expires_at=ban_expires)
+        return True, f"Пользователь заблокирован на {duration_days if duration_days > 0 else 'всегда'} дней"
+
+    def unban_user(self, user_id):
+        self._update_user(user_id, is_blocked=False, ban_expires_at=None)
+        return True, "Пользователь разблокирован"
+
+    def mute_user(self, user_id, duration_hours):
+        mute_expires = None
+        if duration_hours > 0:
+            mute_expires = (datetime.now() + timedelta(hours=duration_hours)).isoformat()
+        self._update_user(user_id, is_muted=True, mute_expires_at=mute_expires)
+        return True, f"Пользователь заглушен на {duration_hours} часов"
+
+    def unmute_user(self, user_id):
+        self._update_user(user_id, is_muted=False, mute_expires_at=None)
+        return True, "Пользователь размучен"
+
+    def get_moderation_expirations(self):
+        with self.lock:
+            return ([("mute", user["id"], user["mute_expires_at"]) for user in self.users.values()
+                     if user["is_muted"] and user["mute_expires_at"]] +
+                    [("ban", user["id"], user["ban_expires_at"]) for user in self.users.values()
+                     if user["is_blocked"] and user["ban_expires_at"]])
+
+    def expire_mute(self, user_id):
+        return self._expire(user_id, "is_muted", "mute_expires_at")
+
+    def expire_ban(self, user_id):
+        return self._expire(user_id, "is_blocked", "ban_expires_at")
+
+    def _expire(self, user_id, flag, field):
+        with self.lock:
+            user = self.users.get(user_id)
+            if not user or not user[flag]:
+                return False, None
+            if user[field] and user[field] <= datetime.now().isoformat():
+                user.update({flag: False, field: None})
+                return True, None
+            return False, user[field]
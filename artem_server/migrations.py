@@ -0,0 +1,322 @@
+# migrations.py - Версионированные миграции схемы
+#
+# Версия схемы хранится в PRAGMA user_version самого файла базы.
+# Версия 0 - таблицы из create_tables(), каждая миграция поднимает версию на 1.
+# Миграция - список SQL-команд или функция, принимающая соединение.
+# Новые миграции добавляются только в конец списка, старые не меняются.
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations):
+    """Применить к базе все миграции новее ее текущей версии"""
+    conn.commit()
+    version = get_version(conn)
+
+    for target, steps in enumerate(migrations, start=1):
+        if target <= version:
+            continue
+
+        # Каждая миграция - отдельная транзакция вместе с новой версией
+        conn.execute("BEGIN")
+        try:
+            if callable(steps):
+                steps(conn)
+            else:
+                for sql in steps:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        print(f"✅ Схема базы обновлена до версии {target}")
+
+    return get_version(conn)
+
+
+# Схема server.py (личные сообщения sender_id -> receiver_id)
+SERVER_MIGRATIONS = [
+    # 1: индексы для горячих запросов
+    [
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair_time ON messages(sender_id, receiver_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_receiver_read ON messages(receiver_id, is_read)",
+        "CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)",
+    ],
+    # 2: сводка бесед (последнее сообщение и непрочитанные на каждую пару)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_message TEXT,
+            last_timestamp TIMESTAMP,
+            unread_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_time ON conversations(user_id, last_timestamp, last_message_id)",
+        '''
+        INSERT OR REPLACE INTO conversations
+            (user_id, peer_id, last_message_id, last_message, last_timestamp, unread_count)
+        SELECT c.user_id, c.peer_id, m.id,
+               CASE WHEN length(m.text) > 50 THEN substr(m.text, 1, 50) || '...' ELSE m.text END,
+               m.timestamp,
+               (SELECT COUNT(*) FROM messages
+                WHERE sender_id = c.peer_id AND receiver_id = c.user_id AND is_read = 0)
+        FROM (
+            SELECT user_id, peer_id, MAX(id) AS last_id
+            FROM (SELECT sender_id AS user_id, receiver_id AS peer_id, id FROM messages
+                  UNION ALL
+                  SELECT receiver_id, sender_id, id FROM messages)
+            GROUP BY user_id, peer_id
+        ) c
+        JOIN messages m ON m.id = c.last_id
+        ''',
+    ],
+    # 3: прочитанность - отметка "прочитано до id" на беседу вместо флага на сообщение
+    [
+        "ALTER TABLE conversations ADD COLUMN last_read_message_id INTEGER NOT NULL DEFAULT 0",
+        '''
+        UPDATE conversations SET last_read_message_id = COALESCE(
+            (SELECT MIN(id) - 1 FROM messages
+             WHERE sender_id = conversations.peer_id
+               AND receiver_id = conversations.user_id AND is_read = 0),
+            (SELECT MAX(id) FROM messages
+             WHERE sender_id = conversations.peer_id
+               AND receiver_id = conversations.user_id),
+            0)
+        ''',
+        # Непрочитанные теперь считаются от отметки
+        "ALTER TABLE conversations DROP COLUMN unread_count",
+        # (sender_id, receiver_id) + неявный rowid: диапазоны по id внутри пары
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages(sender_id, receiver_id)",
+        "DROP INDEX IF EXISTS idx_messages_pair_time",
+        "DROP INDEX IF EXISTS idx_messages_receiver_read",
+    ],
+    # 4: полнотекстовый поиск по сообщениям (FTS5).
+    # Колонка members ("u<отправитель> u<получатель>") позволяет ограничить поиск
+    # беседами пользователя внутри самого индекса
+    [
+        '''
+        CREATE VIEW IF NOT EXISTS messages_fts_source AS
+        SELECT id, text, 'u' || sender_id || ' u' || receiver_id AS members
+        FROM messages
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, members, content='messages_fts_source', content_rowid='id'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text, members)
+            VALUES (new.id, new.text, 'u' || new.sender_id || ' u' || new.receiver_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, members)
+            VALUES ('delete', old.id, old.text, 'u' || old.sender_id || ' u' || old.receiver_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text, sender_id, receiver_id ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text, members)
+            VALUES ('delete', old.id, old.text, 'u' || old.sender_id || ' u' || old.receiver_id);
+            INSERT INTO messages_fts (rowid, text, members)
+            VALUES (new.id, new.text, 'u' || new.sender_id || ' u' || new.receiver_id);
+        END
+        ''',
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ],
+    # 5: индекс для удаления истекших сессий пачками
+    [
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)",
+    ],
+    # 6: время последнего появления в сети (статус онлайн живет в памяти сервера)
+    [
+        "ALTER TABLE users ADD COLUMN last_seen TIMESTAMP",
+    ],
+    # 7: каталог месячных архивов сообщений: какие пары есть в каком месяце
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS message_archives (
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            PRIMARY KEY (sender_id, receiver_id, month)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 8: срок временного бана; частичные индексы - сроки загружаются
+    # планировщиком при старте без прохода по всем пользователям
+    [
+        "ALTER TABLE users ADD COLUMN ban_expires_at TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS idx_users_mute_expires ON users(mute_expires_at) "
+        "WHERE mute_expires_at IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_users_ban_expires ON users(ban_expires_at) "
+        "WHERE ban_expires_at IS NOT NULL",
+    ],
+    # 9: групповые чаты и каналы. Сообщения чатов - в своей таблице (у личных
+    # сообщений receiver_id NOT NULL), последнее сообщение - прямо в chats
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            is_channel BOOLEAN NOT NULL DEFAULT 0,
+            created_by INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_message_id INTEGER,
+            last_message TEXT,
+            last_timestamp TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL DEFAULT 'member',
+            is_muted BOOLEAN NOT NULL DEFAULT 0,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members(user_id)",
+        '''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            timestamp TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id),
+            FOREIGN KEY (sender_id) REFERENCES users(id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_chat ON chat_messages(chat_id, id)",
+    ],
+    # 10: id сообщения от клиента - повторная отправка не создает вторую строку
+    [
+        "ALTER TABLE messages ADD COLUMN client_msg_id TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client "
+        "ON messages(sender_id, client_msg_id) WHERE client_msg_id IS NOT NULL",
+    ],
+    # 11: архивные месяцы пользователя-получателя (поиск по архивам)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_message_archives_receiver ON message_archives(receiver_id, month)",
+    ],
+]
+
+
+# Схема database.py (чаты, участники, журнал действий)
+CHATS_MIGRATIONS = [
+    # 1: индексы для горячих запросов
+    [
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages(chat_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_audit_log_time ON audit_log(timestamp)",
+    ],
+    # 2: прочитанность - отметка "прочитано до id" у участника вместо JSON read_by
+    [
+        "ALTER TABLE chat_members ADD COLUMN last_read_message_id INTEGER NOT NULL DEFAULT 0",
+        '''
+        UPDATE chat_members SET last_read_message_id = COALESCE(
+            (SELECT MAX(m.id)
+             FROM messages m
+             LEFT JOIN json_each(CASE WHEN json_valid(m.read_by) THEN m.read_by ELSE '[]' END) r
+             WHERE m.chat_id = chat_members.chat_id
+               AND (r.value = chat_members.user_id OR m.sender_id = chat_members.user_id)),
+            0)
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, id)",
+    ],
+    # 3: полнотекстовый поиск по сообщениям (FTS5).
+    # В индексе только не удаленные сообщения; колонка chat ("c<chat_id>")
+    # ограничивает поиск чатами пользователя внутри самого индекса
+    [
+        '''
+        CREATE VIEW IF NOT EXISTS messages_fts_source AS
+        SELECT id, message_text, 'c' || chat_id AS chat
+        FROM messages
+        WHERE is_deleted = 0 AND message_text IS NOT NULL
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message_text, chat, content='messages_fts_source', content_rowid='id'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        WHEN new.is_deleted = 0 AND new.message_text IS NOT NULL BEGIN
+            INSERT INTO messages_fts (rowid, message_text, chat)
+            VALUES (new.id, new.message_text, 'c' || new.chat_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        WHEN old.is_deleted = 0 AND old.message_text IS NOT NULL BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text, chat)
+            VALUES ('delete', old.id, old.message_text, 'c' || old.chat_id);
+        END
+        ''',
+        # Мягкое удаление (is_deleted = 1) убирает сообщение из индекса,
+        # правка текста заменяет старую версию новой
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update
+        AFTER UPDATE OF message_text, is_deleted, chat_id ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text, chat)
+            SELECT 'delete', old.id, old.message_text, 'c' || old.chat_id
+            WHERE old.is_deleted = 0 AND old.message_text IS NOT NULL;
+            INSERT INTO messages_fts (rowid, message_text, chat)
+            SELECT new.id, new.message_text, 'c' || new.chat_id
+            WHERE new.is_deleted = 0 AND new.message_text IS NOT NULL;
+        END
+        ''',
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ],
+]
+
+
+# Схема шарда сообщений (sharding.py): сообщения и сводка бесед без пользователей.
+# Id сообщений выдает ShardedDatabase - они сквозные для всех шардов
+SHARD_MIGRATIONS = [
+    # 1: сообщения, сводка бесед и полнотекстовый индекс - как в server.py
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            timestamp TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages(sender_id, receiver_id)",
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_message TEXT,
+            last_timestamp TIMESTAMP,
+            last_read_message_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_time ON conversations(user_id, last_timestamp, last_message_id)",
+        # messages_fts с колонкой members - те же команды, что в миграции 4 server.py
+        *SERVER_MIGRATIONS[3],
+    ],
+    # 2: id сообщения от клиента - миграция 10 server.py
+    SERVER_MIGRATIONS[9],
+]
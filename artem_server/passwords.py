@@ -0,0 +1,85 @@
+# passwords.py - Хеширование паролей (scrypt) в отдельных процессах
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+
+# Параметры scrypt: ~16 МБ памяти и десятки миллисекунд CPU на один пароль
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+
+# Старый формат: несоленый SHA-256 в hex
+_LEGACY_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n, dklen=32)
+
+
+def hash_password(password):
+    """Хеш в формате scrypt$n$r$p$соль$хеш"""
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, password_hash):
+    """Проверка пароля против scrypt-хеша или старого SHA-256"""
+    if _LEGACY_RE.fullmatch(password_hash or ""):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, password_hash)
+
+    try:
+        scheme, n, r, p, salt, digest = password_hash.split("$")
+        if scheme != "scrypt":
+            return False
+        expected = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected.hex(), digest)
+
+
+def needs_rehash(password_hash):
+    """Хеш старого формата или с устаревшими параметрами"""
+    return not (password_hash or "").startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+def _lower_priority():
+    # Сообщения важнее входов: при нехватке CPU планировщик отдает его серверу
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+
+class PasswordHasher:
+    """Хеширование и проверка паролей в пуле процессов.
+
+    scrypt занимает CPU на десятки миллисекунд, поэтому event loop только
+    ждет результат. Размер пула ограничен - шторм входов занимает не больше
+    workers ядер, остальные запросы ждут в очереди пула.
+    """
+
+    def __init__(self, workers=2):
+        # spawn: воркеры не наследуют потоки и соединения SQLite родителя
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_lower_priority,
+        )
+
+    async def hash(self, password):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, hash_password, password)
+
+    async def verify(self, password, password_hash):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, verify_password, password, password_hash)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
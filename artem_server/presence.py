@@ -0,0 +1,86 @@
+# presence.py - Статус онлайн пользователей в памяти
+from datetime import datetime, timezone
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class PresenceRegistry:
+    """Кто онлайн и когда был в сети.
+
+    Источник правды - соединения сервера (connections.ConnectionRegistry):
+    онлайн тот, у кого открыто хотя бы одно. В базу (users.is_online, users.last_seen) изменения
+    пишутся не сразу, а пачкой через drain(); повторные входы и выходы
+    одного пользователя между сбросами схлопываются в одну строку.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.remote = set()  # онлайн на других процессах сервера (cluster.py)
+        self.deferred = set()  # ушли отсюда, пока были онлайн на другом процессе
+        self.last_seen = {}  # user_id -> время последнего входа/выхода (UTC)
+        self.pending = {}    # user_id -> (is_online, last_seen), еще не в базе
+
+    def is_online(self, user_id):
+        return user_id in self.connections or user_id in self.remote
+
+    def online_count(self):
+        return len(self.remote.union(self.connections.by_user))
+
+    def set_remote(self, user_id, online):
+        """Вход или выход на другом процессе: в базу его пишет тот процесс"""
+        if online:
+            self.remote.add(user_id)
+        else:
+            self.remote.discard(user_id)
+        self.last_seen[user_id] = _now()
+        if not online and user_id in self.deferred:
+            # Другой процесс закрылся, считая онлайн этот: оффлайн пишем отсюда
+            self.deferred.discard(user_id)
+            if user_id not in self.connections:
+                self._touch(user_id, False)
+
+    def clear_remote(self):
+        """Связь с другими процессами потеряна: считать онлайн только своих"""
+        for user_id in self.deferred - self.connections.by_user.keys():
+            self._touch(user_id, False)
+        self.remote.clear()
+        self.deferred.clear()
+
+    def mark_online(self, user_id):
+        self.deferred.discard(user_id)
+        self._touch(user_id, True)
+
+    def mark_offline(self, user_id):
+        if user_id in self.remote:
+            # Еще онлайн на другом процессе - оффлайн запишет тот, кто закроется последним
+            self.deferred.add(user_id)
+            return
+        self._touch(user_id, False)
+
+    def _touch(self, user_id, is_online):
+        now = _now()
+        self.last_seen[user_id] = now
+        self.pending[user_id] = (is_online, now)
+
+    def apply(self, record, id_key="id"):
+        """Проставить в словарь пользователя is_online и last_seen из памяти"""
+        user_id = record[id_key]
+        record["is_online"] = self.is_online(user_id)
+        if user_id in self.last_seen:
+            record["last_seen"] = self.last_seen[user_id]
+        return record
+
+    def apply_record(self, record, user_id=None):
+        """Копия записи (records.py) с is_online и last_seen из памяти"""
+        user_id = record.id if user_id is None else user_id
+        return record._replace(is_online=self.is_online(user_id),
+                               last_seen=self.last_seen.get(user_id, record.last_seen))
+
+    def drain(self):
+        """Забрать накопленные изменения: [(is_online, last_seen, user_id)]"""
+        rows = [(int(is_online), last_seen, user_id)
+                for user_id, (is_online, last_seen) in self.pending.items()]
+        self.pending.clear()
+        return rows
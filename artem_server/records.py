@@ -0,0 +1,96 @@
+# records.py - Компактные записи ответов сервера и их запись в JSON
+#
+# Сообщения, беседы и пользователи идут от хранилища до сокета кортежами с
+# именованными полями (namedtuple: ~100 байт на строку вместо ~270 у словаря)
+# и пишутся в JSON без промежуточных словарей: ключи кодируются один раз на тип
+# записи, значения страницы - по колонкам, а склейка идет одним "".join.
+# Текст ответа побайтно совпадает с json.dumps тех же данных в виде словарей.
+import json
+from collections import namedtuple
+from itertools import chain, repeat
+from json.encoder import encode_basestring_ascii
+
+
+def INT(column):
+    return ["null" if value is None else str(value) for value in column]
+
+
+def STR(column):
+    return ["null" if value is None else encode_basestring_ascii(value) for value in column]
+
+
+_BOOLS = {True: "true", False: "false", None: "null"}
+
+
+def BOOL(column):
+    return list(map(_BOOLS.__getitem__, column))
+
+
+def record(typename, **fields):
+    """Тип записи: namedtuple с кодировщиками колонок INT, STR или BOOL"""
+    cls = namedtuple(typename, fields)
+    cls._json_columns = tuple(fields.values())
+    # Перед каждым значением - разделитель и ключ: ', {"id": ', ', "text": ', ...
+    cls._json_keys = tuple((", {" if i == 0 else ", ") + json.dumps(field) + ": "
+                           for i, field in enumerate(fields))
+    return cls
+
+
+Message = record(
+    "Message", id=INT, sender_id=INT, receiver_id=INT, text=STR, timestamp=STR,
+    is_read=BOOL, sender_name=STR, sender_tag=STR)
+
+MessageMatch = record(
+    "MessageMatch", id=INT, sender_id=INT, receiver_id=INT, timestamp=STR,
+    snippet=STR, sender_name=STR, sender_tag=STR)
+
+Conversation = record(
+    "Conversation", user_id=INT, last_message_time=STR, last_message=STR, username=STR,
+    tag=STR, is_online=BOOL, last_seen=STR, unread_count=INT)
+
+User = record(
+    "User", id=INT, username=STR, tag=STR, email=STR, phone=STR, bio=STR,
+    is_online=BOOL, last_seen=STR)
+
+UserSummary = record("UserSummary", id=INT, username=STR, tag=STR, is_online=BOOL, last_seen=STR)
+
+ChatMessage = record(
+    "ChatMessage", id=INT, chat_id=INT, sender_id=INT, text=STR, timestamp=STR,
+    sender_name=STR, sender_tag=STR)
+
+ChatSummary = record(
+    "ChatSummary", id=INT, name=STR, is_channel=BOOL, role=STR, members_count=INT,
+    last_message=STR, last_timestamp=STR)
+
+
+def is_record(value):
+    return isinstance(value, tuple) and hasattr(value, "_json_keys")
+
+
+def records_json(records):
+    """JSON-массив однотипных записей"""
+    if not records:
+        return "[]"
+    cls = type(records[0])
+    count = len(records)
+    parts = []
+    for key, encode, column in zip(cls._json_keys, cls._json_columns, zip(*records)):
+        parts.append(repeat(key, count))
+        parts.append(encode(column))
+    parts.append(repeat("}", count))
+    # Построчно: ключ, значение, ключ, значение, ..., "}" - первый ", " лишний
+    return "[" + "".join(chain.from_iterable(zip(*parts)))[2:] + "]"
+
+
+def response_json(payload):
+    """json.dumps(payload) для ответа, в котором есть записи или списки записей"""
+    parts = []
+    for key, value in payload.items():
+        if is_record(value):
+            encoded = records_json([value])[1:-1]
+        elif isinstance(value, list) and value and is_record(value[0]):
+            encoded = records_json(value)
+        else:
+            encoded = json.dumps(value)
+        parts.append(f"{json.dumps(key)}: {encoded}")
+    return "{" + ", ".join(parts) + "}"
@@ -0,0 +1,77 @@
+# scheduler.py - Таймеры истечения (мут, бан, сессии) на одной куче
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime
+
+# Дольше этого задача не спит, даже если ближайший срок дальше:
+# перевод системных часов не сдвинет срабатывание больше чем на минуту
+MAX_SLEEP = 60
+RETRY_DELAY = 30  # повтор обработчика, упавшего с ошибкой (например, база занята)
+
+
+def expiry_time(value):
+    """Срок из базы (datetime.isoformat(), локальное время) -> unix time"""
+    return datetime.fromisoformat(value).timestamp()
+
+
+class ExpiryScheduler:
+    """Срабатывания "ровно в срок" без опроса таблиц.
+
+    Все таймеры лежат в одной куче (срок, номер, вид, ключ), задача run()
+    спит до ближайшего срока и вызывает обработчик вида. Повторный
+    schedule() того же (вид, ключ) заменяет срок, cancel() снимает таймер:
+    устаревшие записи кучи пропускаются при извлечении.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.timers = {}    # (kind, key) -> срок в unix time
+        self.handlers = {}  # kind -> async handler(key)
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+        self.fired = 0
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def schedule(self, kind, key, when):
+        """Завести или перенести таймер (kind, key) на unix time when"""
+        self.timers[(kind, key)] = when
+        heapq.heappush(self.heap, (when, next(self.counter), kind, key))
+        if self.heap[0][0] == when:
+            # Новый ближайший срок - разбудить run()
+            self.changed.set()
+
+    def cancel(self, kind, key):
+        self.timers.pop((kind, key), None)
+
+    def has(self, kind, key):
+        return (kind, key) in self.timers
+
+    def __len__(self):
+        return len(self.timers)
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            delay = self.heap[0][0] - time.time() if self.heap else MAX_SLEEP
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, _, kind, key = heapq.heappop(self.heap)
+            if self.timers.get((kind, key)) != when:
+                continue  # таймер перенесен или снят
+            del self.timers[(kind, key)]
+            self.fired += 1
+            try:
+                await self.handlers[kind](key)
+            except Exception as e:
+                print(f"❌ Ошибка таймера {kind} {key}: {e}")
+                if not self.has(kind, key):
+                    self.schedule(kind, key, time.time() + RETRY_DELAY)
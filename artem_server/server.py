@@ -3,15 +3,78 @@ import asyncio
 import websockets
 import json
 import sqlite3
-import hashlib
 import secrets
-from datetime import datetime, timedelta
+import signal
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
-class Database:
-    def __init__(self, db_name="artem_messenger.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+import config
+from db_executor import AsyncDatabase, MessageBatcher
+from migrations import migrate, SERVER_MIGRATIONS
+from text_search import fts_query, UserSearchIndex
+from session_cache import SessionCache
+from presence import PresenceRegistry
+from connections import ConnectionRegistry
+from chats import ChatCache, MAX_INITIAL_MEMBERS
+from cluster import WorkerBus, run_supervisor
+from scheduler import ExpiryScheduler, expiry_time
+from records import (Message, MessageMatch, Conversation, User, UserSummary, ChatMessage,
+                     ChatSummary, response_json)
+from passwords import PasswordHasher, hash_password, needs_rehash
+from archive import MessageArchive, ARCHIVE_SCHEMA, ensure_fts
+from maintenance import MaintenanceScheduler, run_job, backup_connection
+from stats import StatsCounters
+from memory_storage import MemoryStorage
+from sharding import ShardedDatabase, ShardedMessageBatcher
+from storage import (Storage, DEFAULT_USERS, SESSION_DAYS, MAX_MESSAGE_ID,
+                     message_preview, sql_timestamp, print_default_users)
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+MAX_CLIENT_MSG_ID = 64  # длина client_msg_id (UUID - 36 символов)
+
+class Database(Storage):
+    """Хранилище на SQLite"""
+    def __init__(self, db_name="artem_messenger.db", read_only=False,
+                 journal_mode="WAL", synchronous="FULL", archive_dir=None, default_users=True):
+        # Старые сообщения лежат в месячных архивах рядом с базой
+        archive_dir = archive_dir or config.ARCHIVE_DIR or Path(db_name).absolute().parent / "archive"
+        
+        if read_only:
+            # Соединение только для чтения (используется пулом читателей)
+            uri = Path(db_name).absolute().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self.conn.execute("PRAGMA busy_timeout = 5000")
+            self.archive = MessageArchive(self.conn, archive_dir)
+            return
+        
+        journal_mode = journal_mode.upper()
+        synchronous = synchronous.upper()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"Неизвестный journal_mode: {journal_mode}")
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Неизвестный режим synchronous: {synchronous}")
+        
+        # uri=True нужен, чтобы подключать архивы только для чтения
+        self.conn = sqlite3.connect(db_name, uri=True, check_same_thread=False)
+        self.archive = MessageArchive(self.conn, archive_dir)
+        # Свободные страницы возвращает maintenance.py. Действует только для новой
+        # базы и только до включения WAL; у старой базы остается NONE
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL позволяет читателям работать параллельно с писателем
+        self.conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        self.conn.execute(f"PRAGMA synchronous = {synchronous}")
+        self.conn.execute("PRAGMA busy_timeout = 5000")
         self.create_tables()
-        self.create_default_users()
+        migrate(self.conn, SERVER_MIGRATIONS)
+        if self.archive.directory.is_dir():
+            indexed = self.archive.index_all()
+            if indexed:
+                print(f"✅ Полнотекстовый индекс добавлен в архивы: {indexed}")
+        if default_users:
+            self.create_default_users()
     
     def create_tables(self):
         cursor = self.conn.cursor()
@@ -77,23 +140,23 @@ class Database:
         self.conn.commit()
         print("✅ Таблицы базы данных созданы")
     
+    def close(self):
+        self.conn.close()
+    
+    def run_maintenance(self, job, budget_ms):
+        return run_job(self.conn, job, budget_ms)
+    
+    def backup(self, path):
+        return backup_connection(self.conn, path)
+    
     def create_default_users(self):
         cursor = self.conn.cursor()
         
         # Проверяем существование тестовых пользователей
         cursor.execute("SELECT COUNT(*) FROM users WHERE tag = '@artem'")
         if cursor.fetchone()[0] == 0:
-            users = [
-                # (username, tag, password, email, phone, bio, is_admin, is_owner, is_blocked)
-                ("Артем", "@artem", "Fhntv2009vbi.", None, None, None, True, False, False),
-                ("Владелец", "@owner", "admin123", "owner@example.com", "+79991234567", "Системный владелец", True, True, False),  # is_blocked = False
-                ("Анна", "@anna", "password123", "anna@example.com", None, "Привет всем!", False, False, False),
-                ("Максим", "@maxim", "password123", None, "+79998765432", None, False, False, False),
-                ("Елена", "@elena", "password123", "elena@example.com", None, "Люблю общаться", False, False, False),
-            ]
-            
-            for username, tag, password, email, phone, bio, is_admin, is_owner, is_blocked in users:
-                password_hash = hashlib.sha256(password.encode()).hexdigest()
+            for username, tag, password, email, phone, bio, is_admin, is_owner, is_blocked in DEFAULT_USERS:
+                password_hash = hash_password(password)
                 
                 cursor.execute('''
                 INSERT INTO users (username, tag, password_hash, email, phone, bio, is_admin, is_owner, is_blocked)
@@ -101,17 +164,10 @@ class Database:
                 ''', (username, tag, password_hash, email, phone, bio, is_admin, is_owner, is_blocked))
             
             self.conn.commit()
-            print("✅ Созданы тестовые пользователи:")
-            print("   @artem / Fhntv2009vbi. (админ)")
-            print("   @owner / admin123 (владелец и админ)")
-            print("   @anna / password123")
-            print("   @maxim / password123")
-            print("   @elena / password123")
+            print_default_users()
     
-    def hash_password(self, password):
-        return hashlib.sha256(password.encode()).hexdigest()
-    
-    def register_user(self, username, tag, password, email=None, phone=None):
+    def register_user(self, username, tag, password_hash, email=None, phone=None):
+        """Регистрация; пароль приходит уже захешированным (PasswordHasher)"""
         cursor = self.conn.cursor()
         
         # Проверяем уникальность
@@ -123,8 +179,6 @@ class Database:
         if not tag.startswith("@"):
             tag = "@" + tag
         
-        password_hash = self.hash_password(password)
-        
         try:
             cursor.execute('''
             INSERT INTO users (username, tag, password_hash, email, phone)
@@ -136,7 +190,8 @@ class Database:
         except Exception as e:
             return False, str(e)
     
-    def login_user(self, identifier, password):
+    def get_login_user(self, identifier):
+        """Пользователь для входа вместе с хешем пароля; пароль проверяет сервер"""
         cursor = self.conn.cursor()
         
         cursor.execute('''
@@ -155,33 +210,54 @@ class Database:
         if is_blocked:
             return False, "Аккаунт заблокирован"
         
-        if self.hash_password(password) != password_hash:
-            return False, "Неверный пароль"
-        
-        # Создаем сессию
-        session_token = secrets.token_urlsafe(32)
-        expires_at = (datetime.now() + timedelta(days=30)).isoformat()
-        
-        cursor.execute('''
-        INSERT INTO sessions (user_id, session_token, expires_at)
-        VALUES (?, ?, ?)
-        ''', (user_id, session_token, expires_at))
-        
-        # Обновляем статус онлайн
-        cursor.execute('UPDATE users SET is_online = 1 WHERE id = ?', (user_id,))
-        self.conn.commit()
-        
         return True, {
             "user_id": user_id,
             "username": username,
             "tag": tag,
-            "session_token": session_token,
+            "password_hash": password_hash,
             "is_admin": bool(is_admin),
             "is_owner": bool(is_owner),
             "is_blocked": bool(is_blocked),
             "is_muted": bool(is_muted)
         }
     
+    def login_user(self, user, password_hash=None):
+        """Завершить вход после проверки пароля: сессия и, если нужно, новый хеш"""
+        if password_hash:
+            # Старый хеш заменяется вместе с созданием сессии, одной транзакцией
+            self.conn.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                              (password_hash, user["user_id"]))
+        session_token = self.create_session(user["user_id"])
+        return True, {**user, "session_token": session_token}
+    
+    def create_session(self, user_id, commit=True):
+        """Создать сессию на SESSION_DAYS дней и вернуть ее токен"""
+        session_token = secrets.token_urlsafe(32)
+        expires_at = (datetime.now() + timedelta(days=SESSION_DAYS)).isoformat()
+        
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        INSERT INTO sessions (user_id, session_token, expires_at)
+        VALUES (?, ?, ?)
+        ''', (user_id, session_token, expires_at))
+        if commit:
+            self.conn.commit()
+        
+        return session_token
+    
+    def save_presence(self, rows):
+        """Записать пачку статусов [(is_online, last_seen, user_id)] одной транзакцией"""
+        cursor = self.conn.cursor()
+        cursor.executemany('UPDATE users SET is_online = ?, last_seen = ? WHERE id = ?', rows)
+        self.conn.commit()
+    
+    def reset_presence(self):
+        """Сбросить статусы онлайн, оставшиеся от прошлого запуска (например, после падения)"""
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE users SET is_online = 0 WHERE is_online = 1')
+        self.conn.commit()
+        return cursor.rowcount
+    
     def unban_user(self, user_id):
         """Разблокировать пользователя"""
         cursor = self.conn.cursor()
@@ -189,7 +265,7 @@ class Database:
         try:
             cursor.execute('''
             UPDATE users 
-            SET is_blocked = 0 
+            SET is_blocked = 0, ban_expires_at = NULL
             WHERE id = ?
             ''', (user_id,))
             
@@ -218,7 +294,8 @@ class Database:
         cursor = self.conn.cursor()
         
         cursor.execute('''
-        SELECT u.id, u.username, u.tag, u.is_admin, u.is_owner, u.is_blocked, u.is_muted
+        SELECT u.id, u.username, u.tag, u.is_admin, u.is_owner, u.is_blocked, u.is_muted,
+               s.expires_at
         FROM sessions s
         JOIN users u ON s.user_id = u.id
         WHERE s.session_token = ? AND s.expires_at > ?
@@ -228,16 +305,12 @@ class Database:
         if not session:
             return False, "Сессия истекла или недействительна"
         
-        user_id, username, tag, is_admin, is_owner, is_blocked, is_muted = session
+        user_id, username, tag, is_admin, is_owner, is_blocked, is_muted, expires_at = session
         
         # Проверяем блокировку
         if is_blocked:
             return False, "Аккаунт заблокирован"
         
-        # Обновляем статус онлайн
-        cursor.execute('UPDATE users SET is_online = 1 WHERE id = ?', (user_id,))
-        self.conn.commit()
-        
         return True, {
             "user_id": user_id,
             "username": username,
@@ -246,22 +319,73 @@ class Database:
             "is_admin": bool(is_admin),
             "is_owner": bool(is_owner),
             "is_blocked": bool(is_blocked),
-            "is_muted": bool(is_muted)
+            "is_muted": bool(is_muted),
+            "expires_at": expires_at
         }
     
-    def save_message(self, sender_id, receiver_id, text):
+    def delete_expired_sessions(self, batch_size=500):
+        """Удалить одну пачку истекших сессий, вернуть их токены"""
         cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT INTO messages (sender_id, receiver_id, text)
-        VALUES (?, ?, ?)
-        ''', (sender_id, receiver_id, text))
+        rows = cursor.execute('''
+        SELECT id, session_token FROM sessions WHERE expires_at <= ? LIMIT ?
+        ''', (datetime.now().isoformat(), batch_size)).fetchall()
+        cursor.executemany('DELETE FROM sessions WHERE id = ?', [(row[0],) for row in rows])
         self.conn.commit()
-        return cursor.lastrowid
+        return [row[1] for row in rows]
+    
+    def next_session_expiry(self):
+        """Срок ближайшей истекающей сессии (по индексу idx_sessions_expires)"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT MIN(expires_at) FROM sessions')
+        return cursor.fetchone()[0]
+    
+    def save_messages(self, rows):
+        """Сохранить пачку сообщений одной транзакцией, вернуть их id
+        
+        Сводка бесед обеих сторон обновляется в той же транзакции.
+        """
+        cursor = self.conn.cursor()
+        saved = []
+        try:
+            for sender_id, receiver_id, text, client_msg_id in rows:
+                if client_msg_id is not None:
+                    original = cursor.execute(
+                        'SELECT id, timestamp FROM messages WHERE sender_id = ? AND client_msg_id = ?',
+                        (sender_id, client_msg_id)).fetchone()
+                    if original:
+                        saved.append((original[0], original[1], False))
+                        continue
+                timestamp = sql_timestamp()
+                cursor.execute('''
+                INSERT INTO messages (sender_id, receiver_id, text, timestamp, client_msg_id)
+                VALUES (?, ?, ?, ?, ?)
+                ''', (sender_id, receiver_id, text, timestamp, client_msg_id))
+                message_id = cursor.lastrowid
+                saved.append((message_id, timestamp, True))
+                
+                preview = message_preview(text)
+                cursor.executemany('''
+                INSERT INTO conversations
+                    (user_id, peer_id, last_message_id, last_message, last_timestamp)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, peer_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_message = excluded.last_message,
+                    last_timestamp = excluded.last_timestamp
+                ''', [
+                    (sender_id, receiver_id, message_id, preview, timestamp),
+                    (receiver_id, sender_id, message_id, preview, timestamp),
+                ])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return saved
     
     def get_user_by_id(self, user_id):
         cursor = self.conn.cursor()
         cursor.execute('''
-        SELECT id, username, tag, email, phone, bio, is_online 
+        SELECT id, username, tag, email, phone, bio, is_online, last_seen
         FROM users WHERE id = ?
         ''', (user_id,))
         
@@ -269,20 +393,13 @@ class Database:
         if not user:
             return None
         
-        return {
-            "id": user[0],
-            "username": user[1],
-            "tag": user[2],
-            "email": user[3],
-            "phone": user[4],
-            "bio": user[5],
-            "is_online": bool(user[6])
-        }
+        return User(user[0], user[1], user[2], user[3], user[4], user[5], bool(user[6]), user[7])
     
     def get_user_profile(self, user_id):
         cursor = self.conn.cursor()
         cursor.execute('''
-        SELECT username, tag, email, phone, bio, is_admin, is_owner, created_at
+        SELECT username, tag, email, phone, bio, is_admin, is_owner, created_at,
+               is_muted, mute_expires_at
         FROM users WHERE id = ?
         ''', (user_id,))
         
@@ -298,7 +415,9 @@ class Database:
             "bio": user[4],
             "is_admin": bool(user[5]),
             "is_owner": bool(user[6]),
-            "created_at": user[7]
+            "created_at": user[7],
+            "is_muted": bool(user[8]),
+            "mute_expires_at": user[9]
         }
     
     def update_user_profile(self, user_id, username=None, email=None, phone=None, bio=None):
@@ -359,7 +478,7 @@ class Database:
         search_term = f"%{query}%"
         
         cursor.execute('''
-        SELECT id, username, tag, is_online
+        SELECT id, username, tag, is_online, last_seen
         FROM users 
         WHERE (username LIKE ? OR tag LIKE ?)
           AND id != ?
@@ -367,101 +486,459 @@ class Database:
         LIMIT 20
         ''', (search_term, search_term, current_user_id))
         
-        users = []
-        for row in cursor.fetchall():
-            users.append({
-                "id": row[0],
-                "username": row[1],
-                "tag": row[2],
-                "is_online": bool(row[3])
-            })
-        
-        return users
+        return [UserSummary(row[0], row[1], row[2], bool(row[3]), row[4])
+                for row in cursor.fetchall()]
     
     def get_conversations(self, user_id):
         cursor = self.conn.cursor()
         
-        # Получаем последние сообщения с каждым пользователем
+        # Сводка бесед: чтение по индексу (user_id, last_timestamp, last_message_id),
+        # непрочитанные - диапазон по id выше отметки прочтения.
+        # Стоимость не зависит от объема истории
         cursor.execute('''
         SELECT 
-            CASE 
-                WHEN sender_id = ? THEN receiver_id
-                ELSE sender_id
-            END as other_user_id,
-            MAX(m.timestamp) as last_message_time,
-            m.text as last_message,
-            u.username as other_username,
-            u.tag as other_tag,
-            u.is_online,
-            COUNT(CASE WHEN m.receiver_id = ? AND m.is_read = 0 THEN 1 END) as unread_count
-        FROM messages m
-        JOIN users u ON u.id = CASE 
-                WHEN m.sender_id = ? THEN m.receiver_id
-                ELSE m.sender_id
-            END
-        WHERE (m.sender_id = ? OR m.receiver_id = ?)
+            c.peer_id,
+            c.last_timestamp,
+            c.last_message,
+            u.username,
+            u.tag,
+            u.last_seen,
+            (SELECT COUNT(*) FROM messages m
+             WHERE m.sender_id = c.peer_id
+               AND m.receiver_id = c.user_id
+               AND m.id > c.last_read_message_id) AS unread_count
+        FROM conversations c
+        JOIN users u ON u.id = c.peer_id
+        WHERE c.user_id = ?
           AND u.is_blocked = 0
-        GROUP BY other_user_id
-        ORDER BY last_message_time DESC
-        ''', (user_id, user_id, user_id, user_id, user_id))
-        
-        conversations = []
-        for row in cursor.fetchall():
-            conversations.append({
-                "user_id": row[0],
-                "last_message_time": row[1],
-                "last_message": row[2][:50] + "..." if row[2] and len(row[2]) > 50 else row[2],
-                "username": row[3],
-                "tag": row[4],
-                "is_online": bool(row[5]),
-                "unread_count": row[6]
-            })
+        ORDER BY c.last_timestamp DESC, c.last_message_id DESC
+        ''', (user_id,))
         
-        return conversations
+        # is_online проставляет сервер по открытым соединениям
+        return [Conversation(row[0], row[1], row[2], row[3], row[4], False, row[5], row[6])
+                for row in cursor.fetchall()]
     
-    def get_chat_history(self, user1_id, user2_id, limit=50):
+    def get_read_marks(self, user1_id, user2_id):
+        """Отметки прочтения обеих сторон: {user_id: last_read_message_id}"""
         cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT user_id, last_read_message_id
+        FROM conversations
+        WHERE (user_id = ? AND peer_id = ?) OR (user_id = ? AND peer_id = ?)
+        ''', (user1_id, user2_id, user2_id, user1_id))
         
+        marks = {user1_id: 0, user2_id: 0}
+        marks.update(cursor.fetchall())
+        return marks
+    
+    def mark_read(self, user_id, peer_id, message_id, commit=True):
+        """Сдвинуть отметку прочтения беседы (одна строка, только вперед)"""
+        cursor = self.conn.cursor()
         cursor.execute('''
+        INSERT INTO conversations (user_id, peer_id, last_read_message_id)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, peer_id) DO UPDATE SET
+            last_read_message_id = MAX(last_read_message_id, excluded.last_read_message_id)
+        ''', (user_id, peer_id, message_id))
+        if commit:
+            self.conn.commit()
+    
+    def get_chat_history(self, user1_id, user2_id, limit=50, before_id=None, after_id=None):
+        """Страница истории переписки, новые сообщения первыми.
+        
+        before_id - сообщения старше этого id, after_id - новее этого id.
+        Возвращает (messages, next_cursor); next_cursor = None, если страница последняя.
+        """
+        cursor = self.conn.cursor()
+        limit = max(1, min(int(limit), 200))
+        
+        if after_id is not None:
+            condition, order = "id > ?", "ASC"
+            cursor_id = after_id
+        else:
+            condition, order = "id < ?", "DESC"
+            cursor_id = before_id if before_id is not None else MAX_MESSAGE_ID
+        
+        pairs = [(user1_id, user2_id)]
+        if user1_id != user2_id:
+            pairs.append((user2_id, user1_id))
+        
+        if order == "DESC":
+            # Сначала основная база; если страница не набралась - архивы от новых к старым
+            rows = self._history_rows("main", pairs, condition, order, cursor_id, limit)
+            for month in (self.archive.months(pairs) if len(rows) < limit else ()):
+                if len(rows) >= limit:
+                    break
+                schema = self.archive.attach(month)
+                next_id = rows[-1][0] if rows else cursor_id
+                rows += self._history_rows(schema, pairs, condition, order, next_id, limit - len(rows))
+        else:
+            # Архивы нужны, только если курсор старше самого старого сообщения в основной базе
+            rows = []
+            hot_min_id = cursor.execute("SELECT MIN(id) FROM messages").fetchone()[0]
+            if hot_min_id is None or cursor_id + 1 < hot_min_id:
+                for month in reversed(self.archive.months(pairs)):
+                    if len(rows) >= limit:
+                        break
+                    schema = self.archive.attach(month)
+                    next_id = rows[-1][0] if rows else cursor_id
+                    rows += self._history_rows(schema, pairs, condition, order, next_id, limit - len(rows))
+            if len(rows) < limit:
+                next_id = rows[-1][0] if rows else cursor_id
+                rows += self._history_rows("main", pairs, condition, order, next_id, limit - len(rows))
+        
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = rows[-1][0]
+        if order == "ASC":
+            rows.reverse()
+        
+        # Сообщение прочитано, если получатель продвинул отметку до его id
+        read_marks = self.get_read_marks(user1_id, user2_id)
+        
+        messages = []
+        last_received_id = 0
+        for row in rows:
+            if row[2] == user1_id:
+                last_received_id = max(last_received_id, row[0])
+            messages.append(Message(row[0], row[1], row[2], row[3], row[4],
+                                    row[0] <= read_marks[row[2]], row[5], row[6]))
+        
+        # Помечаем сообщения как прочитанные
+        if last_received_id > read_marks[user1_id]:
+            self.mark_read(user1_id, user2_id, last_received_id)
+        
+        return messages, next_cursor
+    
+    def _history_rows(self, schema, pairs, condition, order, cursor_id, limit):
+        """Строки истории из messages одной базы (main или подключенного архива)"""
+        # Каждое направление - отдельный диапазон по индексу (sender_id, receiver_id, id)
+        # со своим LIMIT, поэтому страница N стоит столько же, сколько первая
+        branch = f'''
+            SELECT * FROM (
+                SELECT id, sender_id, receiver_id, text, timestamp
+                FROM {schema}.messages
+                WHERE sender_id = ? AND receiver_id = ? AND {condition}
+                ORDER BY id {order}
+                LIMIT ?
+            )'''
+        params = []
+        for sender_id, receiver_id in pairs:
+            params.extend((sender_id, receiver_id, cursor_id, limit))
+        params.append(limit)
+        
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
         SELECT 
             m.id,
             m.sender_id,
             m.receiver_id,
             m.text,
             m.timestamp,
-            m.is_read,
             u.username as sender_name,
             u.tag as sender_tag
-        FROM messages m
-        JOIN users u ON u.id = m.sender_id
-        WHERE (m.sender_id = ? AND m.receiver_id = ?)
-           OR (m.sender_id = ? AND m.receiver_id = ?)
-        ORDER BY m.timestamp DESC
+        FROM ({" UNION ALL ".join([branch] * len(pairs))}) m
+        JOIN main.users u ON u.id = m.sender_id
+        ORDER BY m.id {order}
         LIMIT ?
-        ''', (user1_id, user2_id, user2_id, user1_id, limit))
+        ''', params)
+        return cursor.fetchall()
+    
+    def archive_messages(self, cutoff, batch_size=5000):
+        """Перенести в месячные архивы пачку самых старых сообщений до cutoff.
         
-        messages = []
-        for row in cursor.fetchall():
-            messages.append({
-                "id": row[0],
-                "sender_id": row[1],
-                "receiver_id": row[2],
-                "text": row[3],
-                "timestamp": row[4],
-                "is_read": bool(row[5]),
-                "sender_name": row[6],
-                "sender_tag": row[7]
-            })
+        Непрочитанные сообщения остаются в основной базе, пока получатель их не
+        прочитает: счетчик непрочитанных в get_conversations смотрит только сюда.
+        Сначала строки копируются в архив (INSERT OR IGNORE), потом удаляются
+        из основной базы: при сбое между шагами сообщение окажется в двух местах,
+        но не потеряется. Возвращает число перенесенных сообщений.
+        """
+        cursor = self.conn.execute('''
+        SELECT m.id, m.timestamp, m.id <= IFNULL(c.last_read_message_id, 0)
+        FROM messages m
+        LEFT JOIN conversations c ON c.user_id = m.receiver_id AND c.peer_id = m.sender_id
+        ORDER BY m.id
+        ''')
+        months = set()
+        batch = []
+        # Строки идут по возрастанию id (и времени) - читаем, пока не дошли до cutoff
+        for message_id, timestamp, is_read in cursor:
+            if not timestamp or timestamp >= cutoff or len(batch) >= batch_size:
+                break
+            if is_read:
+                months.add(timestamp[:7].replace("-", "_"))
+                batch.append((message_id,))
+        cursor.close()
+        if not batch:
+            return 0
         
-        # Помечаем сообщения как прочитанные
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)")
+        self.conn.execute("DELETE FROM temp.archive_batch")
+        self.conn.executemany("INSERT INTO temp.archive_batch (id) VALUES (?)", batch)
+        self.conn.commit()  # ATTACH нельзя внутри транзакции
+        
+        self.archive.directory.mkdir(parents=True, exist_ok=True)
+        for month in sorted(months):
+            self.conn.execute("ATTACH DATABASE ? AS archive_write", (str(self.archive.path(month)),))
+            try:
+                for sql in ARCHIVE_SCHEMA:
+                    self.conn.execute(sql.format(schema="archive_write"))
+                ensure_fts(self.conn, "archive_write")
+                self.conn.execute('''
+                INSERT OR IGNORE INTO archive_write.messages (id, sender_id, receiver_id, text, timestamp)
+                SELECT id, sender_id, receiver_id, text, timestamp FROM main.messages
+                WHERE id IN (SELECT id FROM temp.archive_batch) AND substr(timestamp, 1, 7) = ?
+                ''', (month.replace("_", "-"),))
+                self.conn.execute('''
+                INSERT OR IGNORE INTO message_archives (sender_id, receiver_id, month)
+                SELECT DISTINCT sender_id, receiver_id, ? FROM archive_write.messages
+                WHERE id IN (SELECT id FROM temp.archive_batch)
+                ''', (month,))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.execute("DETACH DATABASE archive_write")
+        
+        cursor = self.conn.execute("DELETE FROM messages WHERE id IN (SELECT id FROM temp.archive_batch)")
+        self.conn.commit()
+        return cursor.rowcount
+    
+    def search_messages(self, user_id, query, limit=20, before_id=None):
+        """Полнотекстовый поиск по перепискам пользователя, новые первыми.
+        
+        Как история: сначала основная база, если страница не набралась -
+        архивы от новых к старым (у каждого свой индекс FTS5).
+        Возвращает (results, next_cursor); next_cursor передается как before_id.
+        """
+        match = fts_query(query)
+        if not match:
+            return [], None
+        
+        limit = max(1, min(int(limit), 100))
+        # Ограничение "только свои беседы" - часть запроса к индексу
+        match = f"{match} AND members:u{int(user_id)}"
+        cursor_id = before_id if before_id is not None else MAX_MESSAGE_ID
+        results = self._search_rows("main", match, cursor_id, limit)
+        for month in (self.archive.user_months(user_id) if len(results) < limit else ()):
+            if len(results) >= limit:
+                break
+            schema = self.archive.attach(month)
+            next_id = results[-1].id if results else cursor_id
+            results += self._search_rows(schema, match, next_id, limit - len(results))
+        
+        next_cursor = results[-1].id if len(results) == limit else None
+        return results, next_cursor
+    
+    def _search_rows(self, schema, match, cursor_id, limit):
+        """Совпадения из индекса одной базы (main или подключенного архива)"""
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+        SELECT 
+            f.rowid,
+            m.sender_id,
+            m.receiver_id,
+            m.timestamp,
+            snippet(f.messages_fts, 0, '[', ']', '...', 12),
+            u.username as sender_name,
+            u.tag as sender_tag
+        FROM {schema}.messages_fts f
+        JOIN {schema}.messages m ON m.id = f.rowid
+        JOIN main.users u ON u.id = m.sender_id
+        WHERE f.messages_fts MATCH ?
+          AND f.rowid < ?
+        ORDER BY f.rowid DESC
+        LIMIT ?
+        ''', (match, cursor_id, limit))
+        return list(map(MessageMatch._make, cursor.fetchall()))
+    
+    # Групповые чаты и каналы
+    
+    def create_chat(self, creator_id, name, is_channel=False, member_ids=()):
+        cursor = self.conn.cursor()
+        member_ids = set(member_ids) - {creator_id}
+        valid_ids = {row[0] for row in cursor.execute(f'''
+        SELECT id FROM users WHERE id IN ({", ".join("?" * len(member_ids))}) AND is_blocked = 0
+        ''', tuple(member_ids))}
+        if valid_ids != member_ids:
+            return False, "Пользователи не найдены: " + ", ".join(map(str, sorted(member_ids - valid_ids)))
+        try:
+            cursor.execute('''
+            INSERT INTO chats (name, is_channel, created_by, created_at) VALUES (?, ?, ?, ?)
+            ''', (name, int(is_channel), creator_id, sql_timestamp()))
+            chat_id = cursor.lastrowid
+            cursor.execute('''
+            INSERT INTO chat_members (chat_id, user_id, role) VALUES (?, ?, 'creator')
+            ''', (chat_id, creator_id))
+            cursor.executemany('''
+            INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)
+            ''', [(chat_id, user_id) for user_id in sorted(member_ids)])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return True, ChatSummary(chat_id, name, bool(is_channel), "creator", len(member_ids) + 1, None, None)
+    
+    def join_chat(self, chat_id, user_id):
+        cursor = self.conn.cursor()
+        chat = cursor.execute("SELECT is_channel FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        if not chat:
+            return False, "Чат не найден"
+        if not chat[0]:
+            # Иначе любой мог бы вступить в закрытую группу и читать ее историю
+            return False, "В группу можно попасть только по приглашению"
         cursor.execute('''
-        UPDATE messages 
-        SET is_read = 1 
-        WHERE receiver_id = ? AND sender_id = ? AND is_read = 0
-        ''', (user1_id, user2_id))
+        INSERT OR IGNORE INTO chat_members (chat_id, user_id) VALUES (?, ?)
+        ''', (chat_id, user_id))
         self.conn.commit()
+        if not cursor.rowcount:
+            return False, "Вы уже состоите в этом чате"
+        return True, None
+    
+    def add_chat_member(self, chat_id, user_id):
+        cursor = self.conn.cursor()
+        if not cursor.execute("SELECT 1 FROM chats WHERE id = ?", (chat_id,)).fetchone():
+            return False, "Чат не найден"
+        if not cursor.execute("SELECT 1 FROM users WHERE id = ? AND is_blocked = 0", (user_id,)).fetchone():
+            return False, "Пользователь не найден"
+        cursor.execute('''
+        INSERT OR IGNORE INTO chat_members (chat_id, user_id) VALUES (?, ?)
+        ''', (chat_id, user_id))
+        self.conn.commit()
+        if not cursor.rowcount:
+            return False, "Пользователь уже состоит в этом чате"
+        return True, None
+    
+    def leave_chat(self, chat_id, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        self.conn.commit()
+        if not cursor.rowcount:
+            return False, "Вы не состоите в этом чате"
+        return True, None
+    
+    def set_chat_member_muted(self, chat_id, user_id, is_muted):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        UPDATE chat_members SET is_muted = ? WHERE chat_id = ? AND user_id = ?
+        ''', (int(is_muted), chat_id, user_id))
+        self.conn.commit()
+        if not cursor.rowcount:
+            return False, "Пользователь не состоит в этом чате"
+        return True, None
+    
+    def get_chat(self, chat_id):
+        cursor = self.conn.cursor()
+        chat = cursor.execute('''
+        SELECT id, name, is_channel, last_message, last_timestamp FROM chats WHERE id = ?
+        ''', (chat_id,)).fetchone()
+        if not chat:
+            return None
+        members = {user_id: (role, bool(is_muted)) for user_id, role, is_muted in cursor.execute('''
+        SELECT user_id, role, is_muted FROM chat_members WHERE chat_id = ?
+        ''', (chat_id,))}
+        return ChatSummary(chat[0], chat[1], bool(chat[2]), None, len(members), chat[3], chat[4]), members
+    
+    def get_user_chats(self, user_id):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT c.id, c.name, c.is_channel, cm.role,
+               (SELECT COUNT(*) FROM chat_members WHERE chat_id = c.id),
+               c.last_message, c.last_timestamp
+        FROM chat_members cm
+        JOIN chats c ON c.id = cm.chat_id
+        WHERE cm.user_id = ?
+        ORDER BY c.last_message_id DESC, c.id DESC
+        ''', (user_id,))
+        return [ChatSummary(row[0], row[1], bool(row[2]), *row[3:]) for row in cursor.fetchall()]
+    
+    def save_chat_message(self, chat_id, sender_id, text):
+        cursor = self.conn.cursor()
+        timestamp = sql_timestamp()
+        try:
+            cursor.execute('''
+            INSERT INTO chat_messages (chat_id, sender_id, text, timestamp) VALUES (?, ?, ?, ?)
+            ''', (chat_id, sender_id, text, timestamp))
+            message_id = cursor.lastrowid
+            cursor.execute('''
+            UPDATE chats SET last_message_id = ?, last_message = ?, last_timestamp = ? WHERE id = ?
+            ''', (message_id, message_preview(text), timestamp, chat_id))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return message_id, timestamp
+    
+    def get_chat_messages(self, chat_id, limit=50, before_id=None):
+        limit = max(1, min(int(limit), 200))
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT m.id, m.chat_id, m.sender_id, m.text, m.timestamp, u.username, u.tag
+        FROM chat_messages m
+        JOIN users u ON u.id = m.sender_id
+        WHERE m.chat_id = ? AND m.id < ?
+        ORDER BY m.id DESC
+        LIMIT ?
+        ''', (chat_id, before_id if before_id is not None else MAX_MESSAGE_ID, limit))
+        messages = list(map(ChatMessage._make, cursor.fetchall()))
+        next_cursor = messages[-1].id if len(messages) == limit else None
+        return messages, next_cursor
+    
+    def load_statistics(self):
+        """Начальные значения счетчиков: (итоги, события за сутки по минутам)"""
+        cursor = self.conn.cursor()
+        totals = {
+            "total_users": cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            "banned_users": cursor.execute(
+                "SELECT COUNT(*) FROM users WHERE is_blocked = 1").fetchone()[0],
+        }
+        # AUTOINCREMENT: счетчик всех отправленных, включая перенесенные в архив
+        row = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        totals["total_messages"] = row[0] if row else 0
+        totals["total_chats"] = cursor.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+        
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        minute_sql = "CAST(strftime('%s', {0}) AS INTEGER) / 60 * 60"
+        recent = {"messages": {}, "new_users": {}}
         
-        return messages
+        # Сообщения за сутки - с конца по id, без полного прохода по таблице
+        cursor.execute(f"SELECT {minute_sql.format('timestamp')}, timestamp FROM messages ORDER BY id DESC")
+        for minute, timestamp in cursor:
+            if not timestamp or timestamp <= yesterday:
+                break
+            recent["messages"][minute] = recent["messages"].get(minute, 0) + 1
+        
+        cursor.execute(f'''
+        SELECT {minute_sql.format('created_at')} AS minute, COUNT(*)
+        FROM users WHERE created_at > ? GROUP BY minute
+        ''', (yesterday,))
+        recent["new_users"] = dict(cursor.fetchall())
+        
+        return totals, {name: sorted(rows.items()) for name, rows in recent.items()}
+    
+    def get_users_by_ids(self, user_ids):
+        """Имена и статусы пользователей по списку id (шарды сообщений без таблицы users)"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+        SELECT id, username, tag, last_seen, is_blocked
+        FROM users WHERE id IN ({", ".join("?" * len(user_ids))})
+        ''', user_ids)
+        return {row[0]: {
+            "username": row[1],
+            "tag": row[2],
+            "last_seen": row[3],
+            "is_blocked": bool(row[4])
+        } for row in cursor.fetchall()}
+    
+    def get_users_for_index(self):
+        """Все пользователи для индекса поиска: (id, username, tag, is_blocked)"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT id, username, tag, is_blocked FROM users')
+        return cursor.fetchall()
     
     def admin_search_users(self, query):
         cursor = self.conn.cursor()
@@ -493,20 +970,16 @@ class Database:
         cursor = self.conn.cursor()
         
         try:
-            # Если duration_days = 0, бан навсегда
-            if duration_days == 0:
-                cursor.execute('''
-                UPDATE users 
-                SET is_blocked = 1 
-                WHERE id = ?
-                ''', (user_id,))
-            else:
-                # Для временного бана можно добавить поле ban_expires_at
-                cursor.execute('''
-                UPDATE users 
-                SET is_blocked = 1 
-                WHERE id = ?
-                ''', (user_id,))
+            # Если duration_days = 0, бан навсегда; срок снимает планировщик сервера
+            ban_expires = None
+            if duration_days > 0:
+                ban_expires = (datetime.now() + timedelta(days=duration_days)).isoformat()
+            
+            cursor.execute('''
+            UPDATE users 
+            SET is_blocked = 1, ban_expires_at = ?
+            WHERE id = ?
+            ''', (ban_expires, user_id))
             
             self.conn.commit()
             return True, f"Пользователь заблокирован на {duration_days if duration_days > 0 else 'всегда'} дней"
@@ -531,17 +1004,306 @@ class Database:
             return True, f"Пользователь заглушен на {duration_hours} часов"
         except Exception as e:
             return False, f"Ошибка мута: {str(e)}"
+    
+    def get_moderation_expirations(self):
+        """Сроки временных мутов и банов для планировщика (по частичным индексам)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT 'mute', id, mute_expires_at FROM users
+        WHERE mute_expires_at IS NOT NULL AND is_muted = 1
+        UNION ALL
+        SELECT 'ban', id, ban_expires_at FROM users
+        WHERE ban_expires_at IS NOT NULL AND is_blocked = 1
+        ''')
+        return cursor.fetchall()
+    
+    def expire_mute(self, user_id):
+        """Снять мут, если его срок вышел; иначе вернуть текущий срок"""
+        return self._expire(user_id, "is_muted", "mute_expires_at")
+    
+    def expire_ban(self, user_id):
+        """Снять бан, если его срок вышел; иначе вернуть текущий срок"""
+        return self._expire(user_id, "is_blocked", "ban_expires_at")
+    
+    def _expire(self, user_id, flag, column):
+        # Срок мог измениться после постановки таймера (продлили, сняли вручную)
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+        UPDATE users SET {flag} = 0, {column} = NULL
+        WHERE id = ? AND {flag} = 1 AND {column} <= ?
+        ''', (user_id, datetime.now().isoformat()))
+        self.conn.commit()
+        if cursor.rowcount:
+            return True, None
+        row = cursor.execute(f'SELECT {column} FROM users WHERE id = ? AND {flag} = 1',
+                             (user_id,)).fetchone()
+        return False, row[0] if row else None
+
+STORAGE_ENGINES = {
+    "sqlite": Database,
+    "memory": MemoryStorage,
+}
 
 class ChatServer:
-    def __init__(self):
-        self.db = Database()
-        self.connected_users = {}  # user_id -> websocket
-        print("✅ База данных инициализирована")
+    def __init__(self, db_name=config.DB_PATH, storage=None, worker_id=None):
+        storage = storage or config.STORAGE
+        if storage not in STORAGE_ENGINES:
+            raise ValueError(f"Неизвестное хранилище: {storage}")
+        db_options = dict(readers=config.DB_READERS,
+                          journal_mode=config.DB_JOURNAL_MODE,
+                          synchronous=config.DB_SYNCHRONOUS)
+        # Все обращения к хранилищу идут через потоки, а не через event loop
+        if config.DB_SHARDS:
+            if storage != "sqlite":
+                raise ValueError(f"Шарды поддерживаются только хранилищем sqlite, а не {storage}")
+            # Сообщения в нескольких файлах, у каждого свой поток-писатель
+            self.db = ShardedDatabase(Database, db_name, shards=config.DB_SHARDS, **db_options)
+            batcher_cls = ShardedMessageBatcher
+        else:
+            self.db = AsyncDatabase(STORAGE_ENGINES[storage], db_name, **db_options)
+            batcher_cls = MessageBatcher
+        # Сообщения пишутся пачками, подтверждение уходит после коммита
+        self.message_batcher = batcher_cls(
+            self.db,
+            batch_size=config.MESSAGE_BATCH_SIZE,
+            flush_interval=config.MESSAGE_FLUSH_INTERVAL_MS / 1000,
+            recent_size=config.CLIENT_MSG_CACHE_SIZE
+        )
+        # (sender_id, client_msg_id), по которым new_message уже разослан
+        self.delivered = OrderedDict()
+        # Открытые соединения: у пользователя может быть несколько устройств
+        self.connections = ConnectionRegistry(config.OUTBOX_SIZE, config.OUTBOX_OVERFLOW)
+        # Статус онлайн живет в памяти, в базу пишется пачками
+        self.presence = PresenceRegistry(self.connections)
+        # Участники групп и каналов для проверки прав и рассылки
+        self.chats = ChatCache(self.db)
+        # Поиск пользователей по имени и тэгу идет по индексу в памяти
+        self.user_index = UserSearchIndex()
+        # Повторные подключения по токену проверяются без SQLite
+        self.session_cache = SessionCache(config.SESSION_CACHE_SIZE, config.SESSION_CACHE_TTL)
+        # scrypt считается в отдельных процессах, event loop его не ждет
+        self.passwords = PasswordHasher(config.PASSWORD_WORKERS)
+        self.background_tasks = []
+        # Статистика для админов считается по событиям, без COUNT(*) по таблицам
+        self.stats = StatsCounters()
+        # События статистики, еще не разосланные остальным процессам: (итог, окно) -> число
+        self.stats_unsent = {}
+        # Сроки мутов, банов и сессий - таймеры в памяти, таблицы не опрашиваются
+        self.expiry = ExpiryScheduler()
+        self.expiry.on("mute", self.expire_mute)
+        self.expiry.on("ban", self.expire_ban)
+        self.expiry.on("sessions", self.expire_sessions)
+        # ANALYZE, контрольные точки, vacuum и копии - в окно низкой нагрузки
+        self.maintenance = MaintenanceScheduler(
+            self.db, self.stats, config.MAINTENANCE_WINDOW, config.MAINTENANCE_MAX_RATE,
+            config.MAINTENANCE_BUDGET_MS, config.BACKUP_DIR, config.BACKUP_KEEP, db_name)
+        # Несколько процессов (cluster.py): номер этого и шина между ними
+        self.worker_id = worker_id
+        self.bus = None
+        # Изменения состояния в памяти, которые повторяются на остальных процессах
+        self.replicated = {
+            "invalidate_user": self.session_cache.invalidate_user,
+            "set_blocked": self.set_blocked,
+            "user_added": self.user_index.add,
+            "user_renamed": self.user_index.rename,
+            "chat_changed": self.chats.invalidate,
+            "chat_message": self.deliver_chat_frame,
+            "stats": self.stats.event,
+        }
+        shards = f", шардов: {config.DB_SHARDS}" if config.DB_SHARDS else ""
+        print(f"✅ База данных инициализирована ({storage}{shards})")
+    
+    async def start(self):
+        """Запуск фоновых задач"""
+        self.user_index.load(await self.db.get_users_for_index())
+        print(f"✅ Индекс поиска пользователей: {len(self.user_index.users)}")
+        self.stats.load(*await self.db.load_statistics())
+        if self.worker_id is None:
+            # С несколькими процессами статусы сбрасывает супервизор до их запуска
+            reset = await self.db.reset_presence()
+            if reset:
+                print(f"🔄 Сброшен статус онлайн после прошлого запуска: {reset}")
+        self.message_batcher.start()
+        for kind, user_id, expires_at in await self.db.get_moderation_expirations():
+            self.expiry.schedule(kind, user_id, expiry_time(expires_at))
+        await self.schedule_session_expiry()
+        print(f"⏰ Таймеров истечения: {len(self.expiry)}")
+        self.background_tasks.append(asyncio.create_task(self.expiry.run()))
+        # Архив и обслуживание базы - в одном процессе из нескольких
+        housekeeping = self.worker_id in (None, 0)
+        if config.ARCHIVE_AFTER_DAYS > 0 and config.DB_SHARDS:
+            print("⚠️ Архивация с шардами не поддерживается: ARTEM_ARCHIVE_AFTER_DAYS не действует, "
+                  "сообщения остаются в шардах")
+        elif config.ARCHIVE_AFTER_DAYS > 0 and housekeeping:
+            self.background_tasks.append(asyncio.create_task(self.archiver()))
+        self.background_tasks.append(asyncio.create_task(self.presence_flusher()))
+        if self.maintenance.window and housekeeping:
+            self.background_tasks.append(asyncio.create_task(self.maintenance.run()))
+        if self.bus:
+            self.background_tasks.append(asyncio.create_task(self.bus.run()))
+            self.background_tasks.append(asyncio.create_task(self.stats_publisher()))
+    
+    async def stop(self):
+        """Остановка фоновых задач и закрытие базы"""
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks.clear()
+        await self.flush_presence()
+        await self.message_batcher.stop()
+        self.db.close()
+        self.passwords.close()
+    
+    async def expire_sessions(self, _):
+        """Таймер ближайшей сессии: удалить истекшие пачками и завести следующий"""
+        total = 0
+        while True:
+            # Каждая пачка - отдельная короткая транзакция,
+            # между ними писатель успевает обработать остальные запросы
+            tokens = await self.db.delete_expired_sessions(config.SESSION_SWEEP_BATCH)
+            for token in tokens:
+                self.session_cache.remove(token)
+            total += len(tokens)
+            if len(tokens) < config.SESSION_SWEEP_BATCH:
+                break
+        if total:
+            print(f"🧹 Удалено истекших сессий: {total}")
+        await self.schedule_session_expiry()
+    
+    async def schedule_session_expiry(self):
+        """Таймер на срок ближайшей сессии (сессии истекают в порядке создания)"""
+        expires_at = await self.db.next_session_expiry()
+        if expires_at:
+            self.expiry.schedule("sessions", None, expiry_time(expires_at))
+    
+    async def session_created(self):
+        """Первая сессия после пустой таблицы заводит таймер, остальные истекают позже"""
+        if not self.expiry.has("sessions", None):
+            await self.schedule_session_expiry()
+    
+    def schedule_moderation(self, kind, user_id, seconds):
+        """Таймер мута или бана через seconds секунд; 0 - бессрочно, таймер снимается"""
+        if seconds > 0:
+            self.expiry.schedule(kind, user_id, time.time() + seconds)
+        else:
+            self.expiry.cancel(kind, user_id)
+    
+    async def expire_mute(self, user_id):
+        lifted, expires_at = await self.db.expire_mute(user_id)
+        if lifted:
+            self.replicate("invalidate_user", user_id)
+            print(f"⏰ Истек мут пользователя {user_id}")
+        elif expires_at:
+            # Мут продлили после постановки таймера
+            self.expiry.schedule("mute", user_id, expiry_time(expires_at))
+    
+    async def expire_ban(self, user_id):
+        lifted, expires_at = await self.db.expire_ban(user_id)
+        if lifted:
+            self.replicate("set_blocked", user_id, False)
+            self.replicate("invalidate_user", user_id)
+            print(f"⏰ Истек бан пользователя {user_id}")
+        elif expires_at:
+            self.expiry.schedule("ban", user_id, expiry_time(expires_at))
+    
+    async def archiver(self):
+        """Периодически переносит старые сообщения в месячные архивы"""
+        while True:
+            try:
+                cutoff = (datetime.now(timezone.utc) - timedelta(days=config.ARCHIVE_AFTER_DAYS)
+                          ).strftime("%Y-%m-%d %H:%M:%S")
+                total = 0
+                while True:
+                    moved = await self.db.archive_messages(cutoff, config.ARCHIVE_BATCH)
+                    total += moved
+                    if moved < config.ARCHIVE_BATCH:
+                        break
+                if total:
+                    print(f"📦 Перенесено в архив сообщений: {total}")
+            except Exception as e:
+                print(f"❌ Ошибка архивации сообщений: {e}")
+            await asyncio.sleep(config.ARCHIVE_INTERVAL)
+    
+    async def flush_presence(self):
+        """Записать накопленные изменения статуса онлайн одной транзакцией"""
+        rows = self.presence.drain()
+        if rows:
+            await self.db.save_presence(rows)
+    
+    async def presence_flusher(self):
+        """Периодически сбрасывает статусы онлайн в базу"""
+        while True:
+            await asyncio.sleep(config.PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self.flush_presence()
+            except Exception as e:
+                print(f"❌ Ошибка записи статусов онлайн: {e}")
+    
+    def count_event(self, total, window=None):
+        """Событие для статистики (window - счетчик за сутки, если нужен);
+        остальным процессам уходит пачкой из stats_publisher"""
+        self.stats.event(total, window)
+        if self.bus:
+            key = (total, window)
+            self.stats_unsent[key] = self.stats_unsent.get(key, 0) + 1
+    
+    async def stats_publisher(self):
+        """Периодически рассылает накопленные события статистики по шине.
+        
+        Счетчики в памяти у каждого процесса свои: без этого админ видел бы
+        только события процесса, на который попало его подключение.
+        """
+        while True:
+            await asyncio.sleep(config.STATS_SYNC_INTERVAL)
+            unsent, self.stats_unsent = self.stats_unsent, {}
+            for (total, window), count in unsent.items():
+                self.bus.publish("stats", total, window, count)
+    
+    async def get_user_by_id(self, user_id):
+        """Пользователь из базы со статусом онлайн из памяти"""
+        user = await self.db.get_user_by_id(user_id)
+        return self.presence.apply_record(user) if user else None
+    
+    async def get_conversations(self, user_id):
+        """Беседы из сводки со статусом онлайн собеседников из памяти"""
+        conversations = await self.db.get_conversations(user_id)
+        return [self.presence.apply_record(conversation, conversation.user_id)
+                for conversation in conversations]
+    
+    async def login_user(self, identifier, password):
+        """Вход: пароль проверяется в пуле процессов, старый хеш SHA-256 заменяется на scrypt"""
+        success, user = await self.db.get_login_user(identifier)
+        if not success:
+            return False, user
+        
+        password_hash = user.pop("password_hash")
+        if not await self.passwords.verify(password, password_hash):
+            return False, "Неверный пароль"
+        
+        new_hash = await self.passwords.hash(password) if needs_rehash(password_hash) else None
+        result = await self.db.login_user(user, new_hash)
+        await self.session_created()
+        return result
+    
+    async def verify_session(self, session_token):
+        """Проверка токена: сначала кэш сессий, при промахе - SQLite"""
+        cached = self.session_cache.get(session_token)
+        if cached is not None:
+            return True, cached
+        
+        success, result = await self.db.verify_session(session_token)
+        if success:
+            expires_at = result.pop("expires_at")
+            expires_in = (datetime.fromisoformat(expires_at) - datetime.now()).total_seconds()
+            self.session_cache.put(session_token, result, expires_in)
+        return success, result
     
     async def handler(self, websocket):
         """Обработчик WebSocket подключений (ИСПРАВЛЕНО: убран path)"""
         print(f"📡 Новое подключение")
         user_id = None
+        session_token = None
+        connection = None
         try:
             # Ждем данные аутентификации
             message = await websocket.recv()
@@ -561,22 +1323,28 @@ class ChatServer:
                     }))
                     return
                 
-                success, result = self.db.register_user(username, tag, password, email, phone)
+                password_hash = await self.passwords.hash(password)
+                success, result = await self.db.register_user(username, tag, password_hash, email, phone)
                 
                 if success:
                     user_id = result
-                    self.connected_users[user_id] = websocket
+                    connection = self.connect(user_id, websocket)
+                    self.replicate("user_added", user_id, username, tag if tag.startswith("@") else "@" + tag)
+                    self.count_event("total_users", "new_users")
                     
                     # Создаем сессию для нового пользователя
-                    session_token = secrets.token_urlsafe(32)
-                    expires_at = (datetime.now() + timedelta(days=30)).isoformat()
-                    
-                    cursor = self.db.conn.cursor()
-                    cursor.execute('''
-                    INSERT INTO sessions (user_id, session_token, expires_at)
-                    VALUES (?, ?, ?)
-                    ''', (user_id, session_token, expires_at))
-                    self.db.conn.commit()
+                    session_token = await self.db.create_session(user_id)
+                    await self.session_created()
+                    self.session_cache.put(session_token, {
+                        "user_id": user_id,
+                        "username": username,
+                        "tag": tag if tag.startswith("@") else "@" + tag,
+                        "session_token": session_token,
+                        "is_admin": False,
+                        "is_owner": False,
+                        "is_blocked": False,
+                        "is_muted": False
+                    }, SESSION_DAYS * 86400)
                     
                     await websocket.send(json.dumps({
                         "type": "register_success",
@@ -605,11 +1373,13 @@ class ChatServer:
                     }))
                     return
                 
-                success, result = self.db.login_user(identifier, password)
+                success, result = await self.login_user(identifier, password)
                 
                 if success:
                     user_id = result['user_id']
-                    self.connected_users[user_id] = websocket
+                    session_token = result['session_token']
+                    connection = self.connect(user_id, websocket)
+                    self.session_cache.put(session_token, result, SESSION_DAYS * 86400)
                     
                     await websocket.send(json.dumps({
                         "type": "login_success",
@@ -634,11 +1404,11 @@ class ChatServer:
                     }))
                     return
                 
-                success, result = self.db.verify_session(session_token)
+                success, result = await self.verify_session(session_token)
                 
                 if success:
                     user_id = result['user_id']
-                    self.connected_users[user_id] = websocket
+                    connection = self.connect(user_id, websocket)
                     
                     await websocket.send(json.dumps({
                         "type": "login_success",
@@ -656,7 +1426,7 @@ class ChatServer:
             # Если аутентификация успешна
             if user_id:
                 # Отправляем данные профиля
-                profile = self.db.get_user_profile(user_id)
+                profile = await self.db.get_user_profile(user_id)
                 if profile:
                     await websocket.send(json.dumps({
                         "type": "profile_data",
@@ -667,41 +1437,152 @@ class ChatServer:
                 await self.send_users_list(user_id, websocket)
                 
                 # Отправляем список бесед
-                conversations = self.db.get_conversations(user_id)
-                await websocket.send(json.dumps({
+                conversations = await self.get_conversations(user_id)
+                await websocket.send(response_json({
                     "type": "conversations_list",
                     "conversations": conversations
                 }))
                 
                 # Обработка сообщений
                 async for message in websocket:
-                    await self.process_message(user_id, message, websocket)
+                    await self.process_message(user_id, message, websocket, session_token)
                     
         except websockets.exceptions.ConnectionClosed:
             print(f"🔌 Отключен пользователь {user_id if user_id else 'unknown'}")
         except Exception as e:
             print(f"❌ Ошибка в handler: {e}")
         finally:
-            if user_id:
-                if user_id in self.connected_users:
-                    del self.connected_users[user_id]
-                # Обновляем статус оффлайн
-                cursor = self.db.conn.cursor()
-                cursor.execute('UPDATE users SET is_online = 0 WHERE id = ?', (user_id,))
-                self.db.conn.commit()
+            if connection:
+                self.disconnect(connection)
+    
+    def connect(self, user_id, websocket):
+        """Зарегистрировать сокет вошедшего пользователя, онлайн - с первого устройства"""
+        connection, first = self.connections.add(user_id, websocket)
+        if first:
+            self.presence.mark_online(user_id)
+            if self.bus:
+                self.bus.online(user_id)
+        return connection
+    
+    def disconnect(self, connection):
+        """Убрать закрытый сокет, оффлайн - после последнего устройства на всех процессах"""
+        if not self.connections.remove(connection):
+            return
+        user_id = connection.user_id
+        if self.bus:
+            self.bus.offline(user_id)
+        # Статус оффлайн попадет в базу при следующем сбросе
+        self.presence.mark_offline(user_id)
+    
+    def replicate(self, event, *args):
+        """Изменить состояние в памяти здесь и на остальных процессах сервера"""
+        self.replicated[event](*args)
+        if self.bus:
+            self.bus.publish(event, *args)
+    
+    async def on_bus_message(self, message):
+        """Сообщение шины от других процессов (cluster.py)"""
+        op = message["op"]
+        if op == "send":
+            # JSON превращает кортеж key в список
+            key = tuple(message["key"]) if message.get("key") else None
+            for user_id in message["user_ids"]:
+                self.connections.send(user_id, message["frame"], key=key)
+        elif op == "event":
+            result = self.replicated[message["name"]](*message["args"])
+            if asyncio.iscoroutine(result):
+                await result
+        elif op == "remote":
+            self.presence.set_remote(message["user_id"], message["online"])
+        elif op == "reset":
+            # Связь с шиной потеряна: после переподключения шина пришлет маршруты заново
+            self.presence.clear_remote()
+    
+    def deliver_message(self, sender_id, sender_name, receiver_id, message_id, text, timestamp,
+                        client_msg_id):
+        """new_message на все устройства получателя, если он онлайн.
+        
+        id и время - сохраненные: по ним клиент сверяет сообщение с историей
+        и отбрасывает повторную доставку того же message_id.
+        """
+        if client_msg_id is not None:
+            self.delivered[(sender_id, client_msg_id)] = True
+            if len(self.delivered) > config.CLIENT_MSG_CACHE_SIZE:
+                self.delivered.popitem(last=False)
+        if self.presence.is_online(receiver_id):
+            self.send_to_user(receiver_id, json.dumps({
+                "type": "new_message",
+                "message_id": message_id,
+                "sender_id": sender_id,
+                "sender_name": sender_name,
+                "text": text,
+                "timestamp": timestamp,
+                "client_msg_id": client_msg_id
+            }))
+    
+    def send_to_user(self, user_id, message, key=None):
+        """Готовый JSON на все устройства пользователя, в том числе на других процессах.
+        
+        key - у рамок состояния, которые медленному получателю можно выбросить
+        или заменить более новой (ConnectionRegistry)
+        """
+        if user_id in self.connections:
+            self.connections.send(user_id, message, key=key)
+        if self.bus and user_id in self.presence.remote:
+            self.bus.send([user_id], message, key)
+    
+    def broadcast_chat(self, chat, payload, exclude=None):
+        """Один JSON на событие, одна и та же рамка всем устройствам участников онлайн"""
+        frame = json.dumps(payload)
+        if self.bus:
+            self.bus.publish("chat_message", chat.summary.id, frame)
+        return self.connections.broadcast(chat.roles, frame, exclude)
+    
+    async def deliver_chat_frame(self, chat_id, frame):
+        """Рамка сообщения чата с другого процесса - участникам, подключенным сюда"""
+        chat = await self.chats.get(chat_id)
+        if chat:
+            self.connections.broadcast(chat.roles, frame)
+    
+    def set_blocked(self, user_id, is_blocked):
+        """Отметить блокировку в индексе пользователей и в статистике"""
+        user = self.user_index.users.get(user_id)
+        if user and user[2] != is_blocked:
+            self.stats.incr("banned_users", 1 if is_blocked else -1)
+        self.user_index.set_blocked(user_id, is_blocked)
+    
+    def get_statistics(self):
+        """Статистика для админов из счетчиков в памяти"""
+        stats = self.stats.snapshot()
+        stats["online_users"] = self.presence.online_count()
+        stats["connections"] = self.connections.total
+        stats["outbound"] = self.connections.report()
+        if self.worker_id is not None:
+            stats["worker"] = self.worker_id
+        stats["maintenance"] = self.maintenance.report()
+        return stats
+    
+    def search_users(self, query, current_user_id):
+        """Поиск пользователей по индексу в памяти, без обращения к SQLite"""
+        users = []
+        for user_id in self.user_index.search(query, exclude_id=current_user_id):
+            username, tag, _ = self.user_index.users[user_id]
+            users.append(UserSummary(user_id, username, tag, self.presence.is_online(user_id),
+                                     self.presence.last_seen.get(user_id)))
+        return users
     
     async def send_users_list(self, user_id, websocket):
         """Отправка списка пользователей"""
         try:
-            users = self.db.search_users("", user_id)
-            await websocket.send(json.dumps({
+            users = self.search_users("", user_id)
+            await websocket.send(response_json({
                 "type": "users_list",
                 "users": users
             }))
         except Exception as e:
             print(f"❌ Ошибка при отправке списка пользователей: {e}")
     
-    async def process_message(self, sender_id, message, websocket):
+    async def process_message(self, sender_id, message, websocket, session_token=None):
         """Обработка сообщений"""
         try:
             data = json.loads(message)
@@ -710,18 +1591,30 @@ class ChatServer:
             if message_type == 'message':
                 receiver_id = data.get('receiver_id')
                 text = data.get('text', '').strip()
+                # Id от клиента: повторная отправка после переподключения вернет то же сообщение
+                client_msg_id = data.get('client_msg_id')
                 
                 if not text or not receiver_id:
                     return
+                if client_msg_id is not None and not (
+                        isinstance(client_msg_id, str) and 0 < len(client_msg_id) <= MAX_CLIENT_MSG_ID):
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": f"client_msg_id должен быть строкой до {MAX_CLIENT_MSG_ID} символов"
+                    }))
+                    return
                 
                 # Проверяем, не заблокирован ли пользователь
-                user_info = self.db.get_user_by_id(sender_id)
+                user_info = await self.get_user_by_id(sender_id)
                 if not user_info:
                     return
                 
                 # Проверяем, не в муте ли пользователь
-                user_profile = self.db.get_user_profile(sender_id)
-                if user_profile and hasattr(user_profile, 'is_muted') and user_profile.get('is_muted'):
+                user_profile = await self.db.get_user_profile(sender_id)
+                # Истекший мут мог еще не сняться таймером модерации
+                if user_profile and user_profile.get('is_muted') and (
+                        not user_profile.get('mute_expires_at')
+                        or user_profile['mute_expires_at'] > datetime.now().isoformat()):
                     await websocket.send(json.dumps({
                         "type": "error",
                         "error": "Вы заглушены и не можете отправлять сообщения"
@@ -729,46 +1622,41 @@ class ChatServer:
                     return
                 
                 # Сохраняем в БД
-                message_id = self.db.save_message(sender_id, receiver_id, text)
-                
-                # Получаем информацию об отправителе
-                sender_info = self.db.get_user_by_id(sender_id)
-                sender_name = sender_info['username'] if sender_info else f"User_{sender_id}"
-                
-                print(f"📤 Сообщение от {sender_name} к {receiver_id}: {text[:50]}...")
-                
-                # Отправляем подтверждение отправителю
-                await websocket.send(json.dumps({
-                    "type": "message_sent",
-                    "message_id": message_id,
-                    "timestamp": datetime.now().isoformat()
-                }))
-                
-                # Отправляем получателю если он онлайн
-                if receiver_id in self.connected_users:
-                    await self.connected_users[receiver_id].send(json.dumps({
-                        "type": "new_message",
-                        "sender_id": sender_id,
-                        "sender_name": sender_name,
-                        "text": text,
-                        "timestamp": datetime.now().isoformat()
-                    }))
+                message_id, timestamp, is_new = await self.message_batcher.save(
+                    sender_id, receiver_id, text, client_msg_id)
+                sent = {"type": "message_sent", "message_id": message_id, "timestamp": timestamp}
+                if client_msg_id is not None:
+                    sent["client_msg_id"] = client_msg_id
+                key = (sender_id, client_msg_id)
+                if is_new:
+                    self.count_event("total_messages", "messages")
+                    print(f"📤 Сообщение от {user_info.username} к {receiver_id}: {text[:50]}...")
+                else:
+                    sent["duplicate"] = True
+                # Получателю - до подтверждения отправителю и без await между записью
+                # и рассылкой: сокет отправителя мог уже закрыться (тогда клиент и
+                # повторяет), а повтор рассылает заново, только если первой рассылки
+                # в этом процессе не было
+                if is_new or key not in self.delivered:
+                    self.deliver_message(sender_id, user_info.username, receiver_id,
+                                         message_id, text, timestamp, client_msg_id)
+                await websocket.send(json.dumps(sent))
             
             elif message_type == 'get_users':
                 await self.send_users_list(sender_id, websocket)
             
             elif message_type == 'search_users':
                 query = data.get('query', '').strip()
-                users = self.db.search_users(query, sender_id)
-                await websocket.send(json.dumps({
+                users = self.search_users(query, sender_id)
+                await websocket.send(response_json({
                     "type": "search_results",
                     "query": query,
                     "users": users
                 }))
             
             elif message_type == 'get_conversations':
-                conversations = self.db.get_conversations(sender_id)
-                await websocket.send(json.dumps({
+                conversations = await self.get_conversations(sender_id)
+                await websocket.send(response_json({
                     "type": "conversations_list",
                     "conversations": conversations
                 }))
@@ -776,12 +1664,189 @@ class ChatServer:
             elif message_type == 'get_chat_history':
                 other_user_id = data.get('user_id')
                 if other_user_id:
-                    messages = self.db.get_chat_history(sender_id, other_user_id)
-                    await websocket.send(json.dumps({
+                    before_id = data.get('before_id')
+                    after_id = data.get('after_id')
+                    messages, next_cursor = await self.db.get_chat_history(
+                        sender_id, other_user_id,
+                        limit=data.get('limit', 50),
+                        before_id=before_id,
+                        after_id=after_id
+                    )
+                    await websocket.send(response_json({
                         "type": "chat_history",
                         "user_id": other_user_id,
-                        "messages": messages
+                        "messages": messages,
+                        "before_id": before_id,
+                        "after_id": after_id,
+                        "next_cursor": next_cursor
                     }))
+                    
+                    # Собеседнику - до какого сообщения прочитана беседа. Рамка с key:
+                    # медленному получателю достаточно последней отметки
+                    received = [m for m in messages if m.receiver_id == sender_id]
+                    if other_user_id != sender_id and any(not m.is_read for m in received):
+                        self.send_to_user(other_user_id, json.dumps({
+                            "type": "messages_read",
+                            "user_id": sender_id,
+                            "last_read_message_id": max(m.id for m in received)
+                        }), key=("messages_read", sender_id))
+            
+            elif message_type == 'search_messages':
+                query = data.get('query', '').strip()
+                results, next_cursor = await self.db.search_messages(
+                    sender_id, query,
+                    limit=data.get('limit', 20),
+                    before_id=data.get('before_id')
+                )
+                await websocket.send(response_json({
+                    "type": "message_search_results",
+                    "query": query,
+                    "results": results,
+                    "next_cursor": next_cursor
+                }))
+            
+            elif message_type == 'create_chat':
+                name = data.get('name', '').strip()
+                if not name:
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": "Укажите название чата"
+                    }))
+                    return
+                member_ids = [user_id for user_id in data.get('member_ids', []) if isinstance(user_id, int)]
+                success, chat = await self.db.create_chat(
+                    sender_id, name, bool(data.get('is_channel')), member_ids[:MAX_INITIAL_MEMBERS])
+                if not success:
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": chat
+                    }))
+                    return
+                self.count_event("total_chats")
+                await websocket.send(response_json({
+                    "type": "chat_created",
+                    "chat": chat
+                }))
+            
+            elif message_type == 'get_chats':
+                await websocket.send(response_json({
+                    "type": "chats_list",
+                    "chats": await self.db.get_user_chats(sender_id)
+                }))
+            
+            elif message_type in ('join_chat', 'leave_chat'):
+                chat_id = data.get('chat_id')
+                if message_type == 'join_chat':
+                    success, error = await self.db.join_chat(chat_id, sender_id)
+                else:
+                    success, error = await self.db.leave_chat(chat_id, sender_id)
+                if success:
+                    self.replicate("chat_changed", chat_id)
+                await websocket.send(json.dumps({
+                    "type": "chat_action_result",
+                    "action": message_type[:-5],
+                    "chat_id": chat_id,
+                    "success": success,
+                    "error": error
+                }))
+            
+            elif message_type == 'add_chat_member':
+                # В группы пользователей добавляют админы чата
+                chat_id = data.get('chat_id')
+                target_user_id = data.get('user_id')
+                chat = await self.chats.get(chat_id)
+                if not chat or not chat.is_admin(sender_id):
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": "Недостаточно прав"
+                    }))
+                    return
+                success, error = await self.db.add_chat_member(chat_id, target_user_id)
+                if success:
+                    self.replicate("chat_changed", chat_id)
+                await websocket.send(json.dumps({
+                    "type": "chat_action_result",
+                    "action": "add",
+                    "chat_id": chat_id,
+                    "user_id": target_user_id,
+                    "success": success,
+                    "error": error
+                }))
+            
+            elif message_type == 'chat_mute_member':
+                chat_id = data.get('chat_id')
+                target_user_id = data.get('user_id')
+                chat = await self.chats.get(chat_id)
+                if not chat or not chat.is_admin(sender_id) or chat.is_admin(target_user_id):
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": "Недостаточно прав"
+                    }))
+                    return
+                muted = bool(data.get('muted', True))
+                success, error = await self.db.set_chat_member_muted(chat_id, target_user_id, muted)
+                if success:
+                    self.replicate("chat_changed", chat_id)
+                await websocket.send(json.dumps({
+                    "type": "chat_action_result",
+                    "action": "mute" if muted else "unmute",
+                    "chat_id": chat_id,
+                    "success": success,
+                    "error": error
+                }))
+            
+            elif message_type == 'chat_message':
+                chat_id = data.get('chat_id')
+                text = data.get('text', '').strip()
+                if not text or not chat_id:
+                    return
+                
+                chat = await self.chats.get(chat_id)
+                if not chat or not chat.can_post(sender_id):
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": "Вы не можете писать в этот чат"
+                    }))
+                    return
+                
+                message_id, timestamp = await self.db.save_chat_message(chat_id, sender_id, text)
+                await websocket.send(json.dumps({
+                    "type": "chat_message_sent",
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "timestamp": timestamp
+                }))
+                
+                # Всем участникам онлайн, включая другие устройства отправителя
+                username, tag, _ = self.user_index.users.get(sender_id, (f"User_{sender_id}", None, None))
+                self.broadcast_chat(chat, {
+                    "type": "chat_message",
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "sender_id": sender_id,
+                    "sender_name": username,
+                    "sender_tag": tag,
+                    "text": text,
+                    "timestamp": timestamp
+                }, exclude=websocket)
+            
+            elif message_type == 'get_chat_messages':
+                chat_id = data.get('chat_id')
+                chat = await self.chats.get(chat_id)
+                if not chat or sender_id not in chat:
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": "Вы не состоите в этом чате"
+                    }))
+                    return
+                messages, next_cursor = await self.db.get_chat_messages(
+                    chat_id, limit=data.get('limit', 50), before_id=data.get('before_id'))
+                await websocket.send(response_json({
+                    "type": "chat_messages",
+                    "chat_id": chat_id,
+                    "messages": messages,
+                    "next_cursor": next_cursor
+                }))
             
             elif message_type == 'update_profile':
                 username = data.get('username')
@@ -789,11 +1854,14 @@ class ChatServer:
                 phone = data.get('phone')
                 bio = data.get('bio')
                 
-                success, message = self.db.update_user_profile(sender_id, username, email, phone, bio)
+                success, message = await self.db.update_user_profile(sender_id, username, email, phone, bio)
                 
                 if success:
+                    self.replicate("invalidate_user", sender_id)
+                    if username is not None:
+                        self.replicate("user_renamed", sender_id, username)
                     # Отправляем обновленный профиль
-                    profile = self.db.get_user_profile(sender_id)
+                    profile = await self.db.get_user_profile(sender_id)
                     await websocket.send(json.dumps({
                         "type": "profile_updated",
                         "success": True,
@@ -809,7 +1877,7 @@ class ChatServer:
             
             elif message_type == 'admin_search_users':
                 # Проверяем права админа
-                user_profile = self.db.get_user_profile(sender_id)
+                user_profile = await self.db.get_user_profile(sender_id)
                 if not user_profile or (not user_profile.get('is_admin') and not user_profile.get('is_owner')):
                     await websocket.send(json.dumps({
                         "type": "error",
@@ -818,15 +1886,30 @@ class ChatServer:
                     return
                 
                 query = data.get('query', '').strip()
-                users = self.db.admin_search_users(query)
+                users = [self.presence.apply(user) for user in await self.db.admin_search_users(query)]
                 await websocket.send(json.dumps({
                     "type": "admin_search_results",
                     "users": users
                 }))
             
+            elif message_type == 'get_statistics':
+                # Права - из снимка сессии в кэше: статистика целиком из памяти
+                success, session = await self.verify_session(session_token)
+                if not success or (not session.get('is_admin') and not session.get('is_owner')):
+                    await websocket.send(json.dumps({
+                        "type": "error",
+                        "error": "Недостаточно прав"
+                    }))
+                    return
+                
+                await websocket.send(json.dumps({
+                    "type": "statistics",
+                    "stats": self.get_statistics()
+                }))
+            
             elif message_type == 'admin_ban_user':
                 # Проверяем права админа
-                user_profile = self.db.get_user_profile(sender_id)
+                user_profile = await self.db.get_user_profile(sender_id)
                 if not user_profile or (not user_profile.get('is_admin') and not user_profile.get('is_owner')):
                     await websocket.send(json.dumps({
                         "type": "error",
@@ -838,7 +1921,11 @@ class ChatServer:
                 reason = data.get('reason', '')
                 duration_days = data.get('duration_days', 1)
                 
-                success, message = self.db.ban_user(target_user_id, reason, duration_days)
+                success, message = await self.db.ban_user(target_user_id, reason, duration_days)
+                if success:
+                    self.replicate("set_blocked", target_user_id, True)
+                    self.schedule_moderation("ban", target_user_id, duration_days * 86400)
+                    self.replicate("invalidate_user", target_user_id)
                 await websocket.send(json.dumps({
                     "type": "admin_action_result",
                     "action": "ban",
@@ -848,7 +1935,7 @@ class ChatServer:
             
             elif message_type == 'admin_mute_user':
                 # Проверяем права админа
-                user_profile = self.db.get_user_profile(sender_id)
+                user_profile = await self.db.get_user_profile(sender_id)
                 if not user_profile or (not user_profile.get('is_admin') and not user_profile.get('is_owner')):
                     await websocket.send(json.dumps({
                         "type": "error",
@@ -859,7 +1946,10 @@ class ChatServer:
                 target_user_id = data.get('user_id')
                 duration_hours = data.get('duration_hours', 1)
                 
-                success, message = self.db.mute_user(target_user_id, duration_hours)
+                success, message = await self.db.mute_user(target_user_id, duration_hours)
+                if success:
+                    self.schedule_moderation("mute", target_user_id, duration_hours * 3600)
+                    self.replicate("invalidate_user", target_user_id)
                 await websocket.send(json.dumps({
                     "type": "admin_action_result",
                     "action": "mute",
@@ -869,7 +1959,7 @@ class ChatServer:
     
             elif message_type == 'admin_unban_user':
                 # Проверяем права админа
-                user_profile = self.db.get_user_profile(sender_id)
+                user_profile = await self.db.get_user_profile(sender_id)
                 if not user_profile or (not user_profile.get('is_admin') and not user_profile.get('is_owner')):
                     await websocket.send(json.dumps({
                         "type": "error",
@@ -879,7 +1969,11 @@ class ChatServer:
                 
                 target_user_id = data.get('user_id')
                 
-                success, message = self.db.unban_user(target_user_id)
+                success, message = await self.db.unban_user(target_user_id)
+                if success:
+                    self.expiry.cancel("ban", target_user_id)
+                    self.replicate("set_blocked", target_user_id, False)
+                    self.replicate("invalidate_user", target_user_id)
                 await websocket.send(json.dumps({
                     "type": "admin_action_result",
                     "action": "unban",
@@ -889,7 +1983,7 @@ class ChatServer:
             
             elif message_type == 'admin_unmute_user':
                 # Проверяем права админа
-                user_profile = self.db.get_user_profile(sender_id)
+                user_profile = await self.db.get_user_profile(sender_id)
                 if not user_profile or (not user_profile.get('is_admin') and not user_profile.get('is_owner')):
                     await websocket.send(json.dumps({
                         "type": "error",
@@ -899,7 +1993,10 @@ class ChatServer:
                 
                 target_user_id = data.get('user_id')
                 
-                success, message = self.db.unmute_user(target_user_id)
+                success, message = await self.db.unmute_user(target_user_id)
+                if success:
+                    self.expiry.cancel("mute", target_user_id)
+                    self.replicate("invalidate_user", target_user_id)
                 await websocket.send(json.dumps({
                     "type": "admin_action_result",
                     "action": "unmute",
@@ -912,19 +2009,43 @@ class ChatServer:
         except Exception as e:
             print(f"❌ Ошибка в process_message: {e}")
 
-async def main():
-    server = ChatServer()
+async def serve(worker_id=None, bus_path=None):
+    """Один процесс сервера; worker_id и bus_path - процесс из нескольких (cluster.py)"""
+    server = ChatServer(worker_id=worker_id)
+    if bus_path:
+        server.bus = WorkerBus(bus_path, worker_id, server.on_bus_message,
+                               lambda: server.connections.by_user)
     
+    stop = asyncio.Event()
+    if worker_id is not None:
+        # Супервизор останавливает процессы через SIGTERM, Ctrl+C приходит всей группе
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+    
+    # Запускаем сервер - ИСПРАВЛЕНО: убираем path из обработчика
+    await server.start()
+    try:
+        async with websockets.serve(server.handler, config.HOST, config.PORT,
+                                    reuse_port=worker_id is not None):
+            print("✅ Сервер запущен и ожидает подключений...")
+            await stop.wait()
+    finally:
+        await server.stop()
+
+async def main():
     print("=" * 50)
     print("🚀 ARTEM Messenger Server")
-    print("🌐 Сервер запущен: ws://localhost:8765")
-    print("📁 База данных: artem_messenger.db")
+    print(f"🌐 Сервер запущен: ws://{config.HOST}:{config.PORT}")
+    print(f"📁 База данных: {config.DB_PATH}")
+    if config.WORKERS > 1:
+        print(f"👷 Процессов: {config.WORKERS}")
     print("=" * 50)
     
-    # Запускаем сервер - ИСПРАВЛЕНО: убираем path из обработчика
-    async with websockets.serve(server.handler, "localhost", 8765):
-        print("✅ Сервер запущен и ожидает подключений...")
-        await asyncio.Future()  # Бесконечное ожидание
+    if config.WORKERS > 1:
+        await run_supervisor(config.WORKERS)
+    else:
+        await serve()
 
 if __name__ == "__main__":
 
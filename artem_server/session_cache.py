@@ -0,0 +1,69 @@
+# session_cache.py - Кэш проверенных сессий в памяти
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """Токен сессии -> снимок пользователя, с LRU-вытеснением и TTL.
+
+    Повторное подключение с тем же токеном не идет в SQLite, пока запись
+    жива. Любое изменение пользователя (бан, мут, профиль) должно
+    сбрасывать его записи через invalidate_user().
+    """
+
+    def __init__(self, max_size=100000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # token -> (expires_at, snapshot)
+        self.user_tokens = {}         # user_id -> set(token)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, snapshot = entry
+        if expires_at <= time.monotonic():
+            self.remove(token)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return dict(snapshot)
+
+    def put(self, token, snapshot, expires_in=None):
+        """Запомнить снимок; expires_in - сколько секунд осталось жить самой сессии"""
+        ttl = self.ttl if expires_in is None else min(self.ttl, expires_in)
+        if ttl <= 0:
+            return
+
+        self.remove(token)
+        self.entries[token] = (time.monotonic() + ttl, dict(snapshot))
+        self.user_tokens.setdefault(snapshot["user_id"], set()).add(token)
+
+        while len(self.entries) > self.max_size:
+            oldest, _ = next(iter(self.entries.items()))
+            self.remove(oldest)
+
+    def remove(self, token):
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[1]["user_id"]
+        tokens = self.user_tokens.get(user_id)
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del self.user_tokens[user_id]
+
+    def invalidate_user(self, user_id):
+        """Сбросить все сессии пользователя (бан, мут, изменение профиля)"""
+        for token in list(self.user_tokens.get(user_id, ())):
+            self.remove(token)
+
+    def __len__(self):
+        return len(self.entries)
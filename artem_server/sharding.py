@@ -0,0 +1,412 @@
+# sharding.py - Сообщения в нескольких файлах SQLite (шардах)
+#
+# Переписка пары собеседников целиком лежит в одном шарде (хеш пары без учета
+# направления), поэтому история, отметки прочтения и сводка беседы - запросы
+# к одному файлу. Пользователи, сессии и модерация остаются в глобальной базе.
+# Число шардов задается при создании базы: при другом числе пары попали бы
+# в другие файлы, поэтому такую базу ShardedDatabase открывать отказывается.
+import asyncio
+import heapq
+import sqlite3
+import zlib
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from pathlib import Path
+
+from db_executor import AsyncDatabase, MessageBatcher
+from maintenance import run_job, backup_connection
+from migrations import migrate, SHARD_MIGRATIONS
+from records import Message, MessageMatch, Conversation
+from storage import MAX_MESSAGE_ID, message_preview, sql_timestamp
+from text_search import fts_query
+
+
+def shard_index(user1_id, user2_id, shards):
+    """Номер шарда пары собеседников (не зависит от направления)"""
+    low, high = sorted((user1_id, user2_id))
+    # crc32, а не hash(): номер шарда не должен зависеть от версии Python
+    return zlib.crc32(f"{low}:{high}".encode()) % shards
+
+
+def shard_path(db_name, index):
+    """Файл шарда рядом с глобальной базой: artem_messenger.shard0.db"""
+    path = Path(db_name)
+    return str(path.with_name(f"{path.stem}.shard{index}{path.suffix or '.db'}"))
+
+
+def _conversation_key(row):
+    # (peer_id, last_timestamp, last_message, last_message_id, unread_count):
+    # порядок как у ORDER BY last_timestamp DESC, last_message_id DESC (NULL - последними)
+    return row[1] or "", row[3] or 0
+
+
+class MessageShard:
+    """Сообщения и сводка бесед одного шарда.
+
+    Те же запросы, что у Database из server.py, но без JOIN с пользователями:
+    имена и статусы подставляет ShardedDatabase из глобальной базы.
+    """
+
+    def __init__(self, db_name, read_only=False, journal_mode="WAL", synchronous="FULL"):
+        if read_only:
+            uri = Path(db_name).absolute().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self.conn.execute("PRAGMA busy_timeout = 5000")
+            return
+
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")  # до включения WAL
+        self.conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        self.conn.execute(f"PRAGMA synchronous = {synchronous}")
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+        migrate(self.conn, SHARD_MIGRATIONS)
+
+    def close(self):
+        self.conn.close()
+
+    def run_maintenance(self, job, budget_ms):
+        return run_job(self.conn, job, budget_ms)
+
+    def backup(self, path):
+        return backup_connection(self.conn, path)
+
+    def max_message_id(self):
+        return self.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+
+    def save_messages(self, rows):
+        """Сохранить пачку [(id, sender_id, receiver_id, text, client_msg_id)] одной транзакцией.
+
+        Возвращает [(id, timestamp, is_new)] как Storage.save_messages: повтор
+        client_msg_id отправителя не пишется, выданный ему id пропадает.
+        """
+        cursor = self.conn.cursor()
+        saved = []
+        try:
+            for message_id, sender_id, receiver_id, text, client_msg_id in rows:
+                if client_msg_id is not None:
+                    original = cursor.execute(
+                        'SELECT id, timestamp FROM messages WHERE sender_id = ? AND client_msg_id = ?',
+                        (sender_id, client_msg_id)).fetchone()
+                    if original:
+                        saved.append((original[0], original[1], False))
+                        continue
+                timestamp = sql_timestamp()
+                cursor.execute('''
+                INSERT INTO messages (id, sender_id, receiver_id, text, timestamp, client_msg_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ''', (message_id, sender_id, receiver_id, text, timestamp, client_msg_id))
+                saved.append((message_id, timestamp, True))
+
+                preview = message_preview(text)
+                cursor.executemany('''
+                INSERT INTO conversations
+                    (user_id, peer_id, last_message_id, last_message, last_timestamp)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, peer_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_message = excluded.last_message,
+                    last_timestamp = excluded.last_timestamp
+                ''', [
+                    (sender_id, receiver_id, message_id, preview, timestamp),
+                    (receiver_id, sender_id, message_id, preview, timestamp),
+                ])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return saved
+
+    def get_chat_history(self, user1_id, user2_id, limit=50, before_id=None, after_id=None):
+        """Страница истории пары без имен отправителей, отметка прочтения сдвигается.
+
+        Сообщения - кортежи (id, sender_id, receiver_id, text, timestamp, is_read).
+        """
+        limit = max(1, min(int(limit), 200))
+        if after_id is not None:
+            condition, order = "id > ?", "ASC"
+            cursor_id = after_id
+        else:
+            condition, order = "id < ?", "DESC"
+            cursor_id = before_id if before_id is not None else MAX_MESSAGE_ID
+
+        pairs = [(user1_id, user2_id)]
+        if user1_id != user2_id:
+            pairs.append((user2_id, user1_id))
+
+        branch = f'''
+            SELECT * FROM (
+                SELECT id, sender_id, receiver_id, text, timestamp
+                FROM messages
+                WHERE sender_id = ? AND receiver_id = ? AND {condition}
+                ORDER BY id {order}
+                LIMIT ?
+            )'''
+        params = []
+        for sender_id, receiver_id in pairs:
+            params.extend((sender_id, receiver_id, cursor_id, limit))
+        params.append(limit)
+        rows = self.conn.execute(f'''
+        SELECT * FROM ({" UNION ALL ".join([branch] * len(pairs))})
+        ORDER BY id {order}
+        LIMIT ?
+        ''', params).fetchall()
+
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        if order == "ASC":
+            rows.reverse()
+
+        read_marks = self.get_read_marks(user1_id, user2_id)
+        messages = []
+        last_received_id = 0
+        for message_id, sender_id, receiver_id, text, timestamp in rows:
+            if receiver_id == user1_id:
+                last_received_id = max(last_received_id, message_id)
+            messages.append((message_id, sender_id, receiver_id, text, timestamp,
+                             message_id <= read_marks[receiver_id]))
+
+        if last_received_id > read_marks[user1_id]:
+            self.mark_read(user1_id, user2_id, last_received_id)
+
+        return messages, next_cursor
+
+    def get_read_marks(self, user1_id, user2_id):
+        cursor = self.conn.execute('''
+        SELECT user_id, last_read_message_id
+        FROM conversations
+        WHERE (user_id = ? AND peer_id = ?) OR (user_id = ? AND peer_id = ?)
+        ''', (user1_id, user2_id, user2_id, user1_id))
+        marks = {user1_id: 0, user2_id: 0}
+        marks.update(cursor.fetchall())
+        return marks
+
+    def mark_read(self, user_id, peer_id, message_id, commit=True):
+        self.conn.execute('''
+        INSERT INTO conversations (user_id, peer_id, last_read_message_id)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, peer_id) DO UPDATE SET
+            last_read_message_id = MAX(last_read_message_id, excluded.last_read_message_id)
+        ''', (user_id, peer_id, message_id))
+        if commit:
+            self.conn.commit()
+
+    def get_conversations(self, user_id):
+        """[(peer_id, last_timestamp, last_message, last_message_id, unread_count)], новые первыми"""
+        return self.conn.execute('''
+        SELECT
+            c.peer_id,
+            c.last_timestamp,
+            c.last_message,
+            c.last_message_id,
+            (SELECT COUNT(*) FROM messages m
+             WHERE m.sender_id = c.peer_id
+               AND m.receiver_id = c.user_id
+               AND m.id > c.last_read_message_id)
+        FROM conversations c
+        WHERE c.user_id = ?
+        ORDER BY c.last_timestamp DESC, c.last_message_id DESC
+        ''', (user_id,)).fetchall()
+
+    def search_messages(self, user_id, query, limit=20, before_id=None):
+        """До limit совпадений шарда, новые первыми: [(id, sender_id, receiver_id, timestamp, snippet)]"""
+        match = fts_query(query)
+        if not match:
+            return []
+        return self.conn.execute('''
+        SELECT f.rowid, m.sender_id, m.receiver_id, m.timestamp,
+               snippet(messages_fts, 0, '[', ']', '...', 12)
+        FROM messages_fts f
+        JOIN messages m ON m.id = f.rowid
+        WHERE messages_fts MATCH ?
+          AND f.rowid < ?
+        ORDER BY f.rowid DESC
+        LIMIT ?
+        ''', (f"{match} AND members:u{int(user_id)}",
+              before_id if before_id is not None else MAX_MESSAGE_ID, limit)).fetchall()
+
+    def load_statistics(self):
+        """Сообщения шарда за сутки: [(минута в unix time, число)]"""
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        recent = {}
+        # С конца по id, без полного прохода по таблице
+        cursor = self.conn.execute('''
+        SELECT CAST(strftime('%s', timestamp) AS INTEGER) / 60 * 60, timestamp
+        FROM messages ORDER BY id DESC
+        ''')
+        for minute, timestamp in cursor:
+            if not timestamp or timestamp <= yesterday:
+                break
+            recent[minute] = recent.get(minute, 0) + 1
+        return sorted(recent.items())
+
+
+class ShardedDatabase:
+    """Хранилище с сообщениями в нескольких шардах.
+
+    Интерфейс как у AsyncDatabase: await db.method(...), write(), close().
+    Пользователи, сессии и модерация - в глобальной базе (database_cls),
+    у каждого шарда свой AsyncDatabase со своим потоком-писателем, поэтому
+    пачки сообщений разных шардов коммитятся параллельно.
+    Id сообщений выдаются здесь, в event loop, и сквозные для всех шардов:
+    внутри шарда они растут в порядке записи, курсоры истории и поиска не меняются.
+    """
+
+    def __init__(self, database_cls, db_name, shards=4, readers=4, **db_options):
+        if shards < 1:
+            raise ValueError(f"Число шардов должно быть положительным: {shards}")
+        if Path(shard_path(db_name, shards)).exists() or (
+                Path(shard_path(db_name, 0)).exists()
+                and not Path(shard_path(db_name, shards - 1)).exists()):
+            raise ValueError(f"База {db_name} создана с другим числом шардов")
+
+        self.database = AsyncDatabase(database_cls, db_name, readers=readers, **db_options)
+        shard_options = {name: db_options[name] for name in ("journal_mode", "synchronous")
+                         if name in db_options}
+        self.shards = [AsyncDatabase(MessageShard, shard_path(db_name, index),
+                                     readers=readers, **shard_options)
+                       for index in range(shards)]
+        self.last_message_id = max(shard.writer_db.max_message_id() for shard in self.shards)
+
+    def shard(self, user1_id, user2_id):
+        return self.shards[shard_index(user1_id, user2_id, len(self.shards))]
+
+    def __getattr__(self, name):
+        # Все, кроме сообщений и бесед, - в глобальной базе
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    async def write(self, method, *args, **kwargs):
+        # MessageBatcher пишет через write("save_messages", rows)
+        return await getattr(self, method)(*args, **kwargs)
+
+    async def save_messages(self, rows):
+        """Разложить пачку [(sender_id, receiver_id, text, client_msg_id)] по шардам
+        и записать параллельно.
+
+        Возвращает (id, timestamp, is_new) в порядке rows; если шард не смог
+        записать свою часть, на ее месте стоит исключение (остальные шарды
+        уже закоммитили свои). Повторы client_msg_id ловит шард: сообщения
+        одной пары всегда в одном шарде.
+        """
+        message_ids = []
+        by_shard = {}
+        for sender_id, receiver_id, text, client_msg_id in rows:
+            self.last_message_id += 1
+            message_ids.append(self.last_message_id)
+            index = shard_index(sender_id, receiver_id, len(self.shards))
+            by_shard.setdefault(index, []).append(
+                (self.last_message_id, sender_id, receiver_id, text, client_msg_id))
+
+        results = await asyncio.gather(
+            *(self.shards[index].save_messages(shard_rows) for index, shard_rows in by_shard.items()),
+            return_exceptions=True)
+        saved = {}
+        for shard_rows, result in zip(by_shard.values(), results):
+            if isinstance(result, Exception):
+                saved.update((row[0], result) for row in shard_rows)
+            else:
+                saved.update((row[0], message) for row, message in zip(shard_rows, result))
+        return [saved[message_id] for message_id in message_ids]
+
+    async def get_chat_history(self, user1_id, user2_id, limit=50, before_id=None, after_id=None):
+        messages, next_cursor = await self.shard(user1_id, user2_id).get_chat_history(
+            user1_id, user2_id, limit, before_id, after_id)
+        users = await self.database.get_users_by_ids([user1_id, user2_id])
+        names = {user_id: (user["username"], user["tag"]) for user_id, user in users.items()}
+        return [Message(*message, *names.get(message[1], (None, None)))
+                for message in messages], next_cursor
+
+    async def get_conversations(self, user_id):
+        """Сводки бесед из всех шардов, слитые по времени последнего сообщения"""
+        parts = await asyncio.gather(*(shard.get_conversations(user_id) for shard in self.shards))
+        rows = list(heapq.merge(*parts, key=_conversation_key, reverse=True))
+        users = await self.database.get_users_by_ids([row[0] for row in rows])
+
+        conversations = []
+        for peer_id, last_timestamp, last_message, _, unread_count in rows:
+            peer = users.get(peer_id)
+            if not peer or peer["is_blocked"]:
+                continue
+            # is_online проставляет сервер по открытым соединениям
+            conversations.append(Conversation(
+                peer_id, last_timestamp, last_message, peer["username"], peer["tag"],
+                False, peer["last_seen"], unread_count))
+        return conversations
+
+    async def search_messages(self, user_id, query, limit=20, before_id=None):
+        """Поиск во всех шардах с общим курсором, результаты слиты по id"""
+        if not fts_query(query):
+            return [], None
+        limit = max(1, min(int(limit), 100))
+        parts = await asyncio.gather(
+            *(shard.search_messages(user_id, query, limit, before_id) for shard in self.shards))
+        rows = list(islice(heapq.merge(*parts, key=lambda row: row[0], reverse=True), limit))
+
+        users = await self.database.get_users_by_ids(list({row[1] for row in rows}))
+        names = {user_id: (user["username"], user["tag"]) for user_id, user in users.items()}
+        results = [MessageMatch(*row, *names.get(row[1], (None, None))) for row in rows]
+
+        next_cursor = results[-1].id if len(results) == limit else None
+        return results, next_cursor
+
+    async def load_statistics(self):
+        totals, recent = await self.database.load_statistics()
+        totals["total_messages"] = self.last_message_id
+        messages = {}
+        for rows in await asyncio.gather(*(shard.load_statistics() for shard in self.shards)):
+            for minute, count in rows:
+                messages[minute] = messages.get(minute, 0) + count
+        recent["messages"] = sorted(messages.items())
+        return totals, recent
+
+    async def archive_messages(self, cutoff, batch_size=5000):
+        """Месячные архивы пока есть только у базы без шардов: с шардами сервер
+        архивацию не запускает и предупреждает об этом при старте"""
+        return 0
+
+    async def run_maintenance(self, job, budget_ms):
+        """Работа по очереди в глобальной базе и в каждом шарде, бюджет - на каждый файл"""
+        results = [await self.database.run_maintenance(job, budget_ms)]
+        for shard in self.shards:
+            results.append(await shard.run_maintenance(job, budget_ms))
+        return "; ".join(f"{name}: {result}" for name, result in
+                         zip(["база", *(f"шард {i}" for i in range(len(self.shards)))], results))
+
+    async def backup(self, path):
+        """Копии глобальной базы в path и шардов рядом (shard_path), общий размер.
+
+        Файлы копируются по очереди, поэтому снимки разных файлов сняты в разное время.
+        """
+        size = await self.database.backup(path)
+        for index, shard in enumerate(self.shards):
+            size += await shard.backup(shard_path(path, index))
+        return size
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.database.close()
+
+
+class ShardedMessageBatcher:
+    """Групповая запись с отдельным MessageBatcher на каждый шард.
+
+    У одного MessageBatcher в полете одна пачка, и шарды ждали бы самый
+    медленный из них; здесь пачки разных шардов коммитятся независимо.
+    """
+
+    def __init__(self, db, batch_size=128, flush_interval=0.005, recent_size=10000):
+        # Повтор client_msg_id уходит в тот же батчер: шард выбирается по паре
+        self.batchers = [MessageBatcher(db, batch_size, flush_interval, recent_size)
+                         for _ in db.shards]
+
+    def start(self):
+        for batcher in self.batchers:
+            batcher.start()
+
+    async def save(self, sender_id, receiver_id, text, client_msg_id=None):
+        index = shard_index(sender_id, receiver_id, len(self.batchers))
+        return await self.batchers[index].save(sender_id, receiver_id, text, client_msg_id)
+
+    async def stop(self):
+        await asyncio.gather(*(batcher.stop() for batcher in self.batchers))
@@ -0,0 +1,78 @@
+# stats.py - Счетчики статистики в памяти
+import time
+
+MINUTE = 60
+DAY_MINUTES = 24 * 60
+
+
+class SlidingCounter:
+    """Число событий за последние сутки по минутным корзинам.
+
+    Корзина хранит номер своей минуты; устаревшая корзина обнуляется при
+    следующей записи в нее и не учитывается в total().
+    """
+
+    def __init__(self, minutes=DAY_MINUTES):
+        self.minutes = minutes
+        self.counts = [0] * minutes
+        self.stamps = [0] * minutes  # номер минуты (unix time // 60) в корзине
+
+    def add(self, count=1, at=None):
+        minute = int(time.time() if at is None else at) // MINUTE
+        index = minute % self.minutes
+        if minute < self.stamps[index]:
+            return  # старше суток относительно уже записанного
+        if self.stamps[index] != minute:
+            self.stamps[index] = minute
+            self.counts[index] = 0
+        self.counts[index] += count
+
+    def total(self, at=None, minutes=None):
+        """События за последние minutes минут (по умолчанию - за все окно)"""
+        now = int(time.time() if at is None else at) // MINUTE
+        minutes = min(minutes or self.minutes, self.minutes)
+        return sum(count for count, minute in zip(self.counts, self.stamps)
+                   if now - minute < minutes)
+
+
+class StatsCounters:
+    """Итоговые счетчики и счетчики за сутки.
+
+    Один раз заполняются из базы (load), дальше меняются по событиям:
+    incr() для итогов, hit() для событий за последние 24 часа.
+    """
+
+    def __init__(self, totals=(), windows=()):
+        self.totals = dict.fromkeys(totals, 0)
+        self.windows = {name: SlidingCounter() for name in windows}
+
+    def load(self, totals, recent):
+        """totals: {имя: число}, recent: {имя: [(unix time, число)]}"""
+        self.totals.update(totals)
+        for name, rows in recent.items():
+            counter = self.windows[name] = SlidingCounter()
+            for at, count in rows:
+                counter.add(count, at)
+
+    def incr(self, name, count=1):
+        self.totals[name] += count
+
+    def hit(self, name, count=1):
+        self.windows[name].add(count)
+
+    def event(self, total, window=None, count=1):
+        """count событий: итог total и, если задан, счетчик за сутки window"""
+        self.incr(total, count)
+        if window is not None:
+            self.hit(window, count)
+
+    def rate(self, name, minutes=5):
+        """Среднее число событий name в минуту за последние minutes минут"""
+        counter = self.windows.get(name)
+        return counter.total(minutes=minutes) / minutes if counter else 0
+
+    def snapshot(self):
+        stats = dict(self.totals)
+        for name, counter in self.windows.items():
+            stats[f"{name}_last_24h"] = counter.total()
+        return stats
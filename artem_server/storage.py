@@ -0,0 +1,242 @@
+# storage.py - Интерфейс хранилища сервера и общие для реализаций функции
+#
+# Реализации: Database (SQLite, server.py) и MemoryStorage (в памяти,
+# memory_storage.py - для нагрузочных тестов и CI). Сервер работает с
+# хранилищем только через эти методы и только через AsyncDatabase.
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+SESSION_DAYS = 30
+MAX_MESSAGE_ID = 2 ** 63 - 1  # Курсор "с самого нового сообщения"
+
+# Тестовые пользователи новой базы:
+# (username, tag, password, email, phone, bio, is_admin, is_owner, is_blocked)
+DEFAULT_USERS = [
+    ("Артем", "@artem", "Fhntv2009vbi.", None, None, None, True, False, False),
+    ("Владелец", "@owner", "admin123", "owner@example.com", "+79991234567", "Системный владелец", True, True, False),
+    ("Анна", "@anna", "password123", "anna@example.com", None, "Привет всем!", False, False, False),
+    ("Максим", "@maxim", "password123", None, "+79998765432", None, False, False, False),
+    ("Елена", "@elena", "password123", "elena@example.com", None, "Люблю общаться", False, False, False),
+]
+
+
+def message_preview(text):
+    """Короткий текст последнего сообщения для списка бесед"""
+    return text[:50] + "..." if text and len(text) > 50 else text
+
+
+def sql_timestamp():
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def print_default_users():
+    print("✅ Созданы тестовые пользователи:")
+    print("   @artem / Fhntv2009vbi. (админ)")
+    print("   @owner / admin123 (владелец и админ)")
+    print("   @anna / password123")
+    print("   @maxim / password123")
+    print("   @elena / password123")
+
+
+class Storage(ABC):
+    """Хранилище пользователей, сессий, сообщений, бесед и модерации.
+
+    Методы синхронные: AsyncDatabase выполняет их в своих потоках.
+    Ответы у всех реализаций одинаковые: сообщения, беседы и пользователи -
+    записи из records.py, остальное - словари и кортежи (success, result).
+    """
+
+    # Можно ли читать из отдельных соединений параллельно с записью.
+    # Если нет, AsyncDatabase выполняет и чтения в потоке-писателе
+    concurrent_reads = True
+
+    def close(self):
+        """Освободить ресурсы хранилища"""
+
+    def run_maintenance(self, job, budget_ms):
+        """Работа обслуживания из maintenance.JOBS: итог строкой, None - нечего обслуживать"""
+
+    def backup(self, path):
+        """Резервная копия в файл path: размер в байтах, None - копировать нечего"""
+
+    # Пользователи
+
+    @abstractmethod
+    def register_user(self, username, tag, password_hash, email=None, phone=None):
+        """(True, user_id) или (False, ошибка)"""
+
+    @abstractmethod
+    def get_login_user(self, identifier):
+        """Пользователь по имени, тэгу или email вместе с password_hash"""
+
+    @abstractmethod
+    def get_user_by_id(self, user_id):
+        """Публичные данные пользователя или None"""
+
+    @abstractmethod
+    def get_user_profile(self, user_id):
+        """Профиль с правами пользователя или None"""
+
+    @abstractmethod
+    def update_user_profile(self, user_id, username=None, email=None, phone=None, bio=None):
+        """(success, сообщение)"""
+
+    @abstractmethod
+    def search_users(self, query, current_user_id):
+        """До 20 незаблокированных пользователей по подстроке имени или тэга"""
+
+    @abstractmethod
+    def get_users_by_ids(self, user_ids):
+        """{id: {username, tag, last_seen, is_blocked}} для существующих из user_ids"""
+
+    @abstractmethod
+    def get_users_for_index(self):
+        """Все пользователи: [(id, username, tag, is_blocked)]"""
+
+    @abstractmethod
+    def save_presence(self, rows):
+        """Записать статусы [(is_online, last_seen, user_id)]"""
+
+    @abstractmethod
+    def reset_presence(self):
+        """Сбросить все статусы онлайн, вернуть число сброшенных"""
+
+    # Сессии
+
+    @abstractmethod
+    def login_user(self, user, password_hash=None):
+        """Создать сессию для проверенного пользователя, при необходимости сменить хеш"""
+
+    @abstractmethod
+    def create_session(self, user_id, commit=True):
+        """Новая сессия на SESSION_DAYS дней, вернуть токен"""
+
+    @abstractmethod
+    def verify_session(self, session_token):
+        """(True, снимок пользователя с expires_at) или (False, ошибка)"""
+
+    @abstractmethod
+    def delete_expired_sessions(self, batch_size=500):
+        """Удалить до batch_size истекших сессий, вернуть их токены"""
+
+    @abstractmethod
+    def next_session_expiry(self):
+        """Срок ближайшей истекающей сессии или None"""
+
+    # Сообщения и беседы
+
+    def save_message(self, sender_id, receiver_id, text, client_msg_id=None):
+        return self.save_messages([(sender_id, receiver_id, text, client_msg_id)])[0]
+
+    @abstractmethod
+    def save_messages(self, rows):
+        """Сохранить [(sender_id, receiver_id, text, client_msg_id)] и обновить сводку бесед.
+
+        Возвращает [(id, timestamp, is_new)]. Если у отправителя уже есть сообщение
+        с тем же client_msg_id (не None), оно не пишется повторно: на его месте
+        id и время исходного и is_new = False.
+        """
+
+    @abstractmethod
+    def get_chat_history(self, user1_id, user2_id, limit=50, before_id=None, after_id=None):
+        """(messages, next_cursor) - страница истории, отметка прочтения сдвигается"""
+
+    @abstractmethod
+    def search_messages(self, user_id, query, limit=20, before_id=None):
+        """(results, next_cursor) - поиск по словам в беседах пользователя"""
+
+    @abstractmethod
+    def get_conversations(self, user_id):
+        """Беседы пользователя, последние первыми, с числом непрочитанных"""
+
+    @abstractmethod
+    def get_read_marks(self, user1_id, user2_id):
+        """{user_id: last_read_message_id} для обеих сторон"""
+
+    @abstractmethod
+    def mark_read(self, user_id, peer_id, message_id, commit=True):
+        """Сдвинуть отметку прочтения беседы вперед"""
+
+    @abstractmethod
+    def archive_messages(self, cutoff, batch_size=5000):
+        """Перенести пачку сообщений старше cutoff в архив, вернуть их число"""
+
+    # Групповые чаты и каналы
+
+    @abstractmethod
+    def create_chat(self, creator_id, name, is_channel=False, member_ids=()):
+        """Создать чат (создатель - роль creator): (True, ChatSummary) или (False, ошибка).
+
+        Все member_ids должны быть существующими незаблокированными пользователями.
+        """
+
+    @abstractmethod
+    def join_chat(self, chat_id, user_id):
+        """Вступить в канал: (True, None) или (False, ошибка). В группы - только add_chat_member"""
+
+    @abstractmethod
+    def add_chat_member(self, chat_id, user_id):
+        """Добавить пользователя в чат (решение админа чата): (True, None) или (False, ошибка)"""
+
+    @abstractmethod
+    def leave_chat(self, chat_id, user_id):
+        """Выйти из чата: (True, None) или (False, ошибка)"""
+
+    @abstractmethod
+    def set_chat_member_muted(self, chat_id, user_id, is_muted):
+        """Мут участника внутри чата: (True, None) или (False, ошибка)"""
+
+    @abstractmethod
+    def get_chat(self, chat_id):
+        """(ChatSummary, {user_id: (role, is_muted)}) или None - для кэша участников"""
+
+    @abstractmethod
+    def get_user_chats(self, user_id):
+        """Чаты пользователя (ChatSummary), с последним сообщением первыми"""
+
+    @abstractmethod
+    def save_chat_message(self, chat_id, sender_id, text):
+        """Сохранить сообщение чата: (id, timestamp)"""
+
+    @abstractmethod
+    def get_chat_messages(self, chat_id, limit=50, before_id=None):
+        """(messages, next_cursor) - страница сообщений чата, новые первыми"""
+
+    @abstractmethod
+    def load_statistics(self):
+        """(итоги, события за сутки по минутам) для StatsCounters"""
+
+    # Модерация
+
+    @abstractmethod
+    def admin_search_users(self, query):
+        """До 20 пользователей по имени, тэгу или email (включая заблокированных)"""
+
+    @abstractmethod
+    def ban_user(self, user_id, reason, duration_days):
+        """(success, сообщение)"""
+
+    @abstractmethod
+    def unban_user(self, user_id):
+        """(success, сообщение)"""
+
+    @abstractmethod
+    def mute_user(self, user_id, duration_hours):
+        """(success, сообщение)"""
+
+    @abstractmethod
+    def unmute_user(self, user_id):
+        """(success, сообщение)"""
+
+    @abstractmethod
+    def get_moderation_expirations(self):
+        """Временные муты и баны: [("mute" или "ban", user_id, срок)]"""
+
+    @abstractmethod
+    def expire_mute(self, user_id):
+        """Снять мут, если срок вышел: (True, None), иначе (False, текущий срок или None)"""
+
+    @abstractmethod
+    def expire_ban(self, user_id):
+        """Снять бан, если срок вышел: (True, None), иначе (False, текущий срок или None)"""
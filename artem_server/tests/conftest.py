@@ -0,0 +1,5 @@
+# Модули сервера лежат плоско в artem_server/ и импортируют друг друга напрямую
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,23 @@
+# Горячие запросы не должны переходить на полный проход по таблице.
+#
+# Вызовы и проверка планов (EXPLAIN QUERY PLAN) - те же, что у bench.py plans;
+# запросы из bench.SCAN_ALLOWED сканировать можно.
+import database
+from bench import chats_plan_calls, explain_calls, server_plan_calls
+from server import Database
+
+
+def test_server_queries_use_indexes(tmp_path):
+    db = Database(str(tmp_path / "server.db"), archive_dir=str(tmp_path / "archive"))
+    try:
+        assert explain_calls(db.conn, server_plan_calls(db)) == []
+    finally:
+        db.close()
+
+
+def test_chats_queries_use_indexes(tmp_path):
+    chats = database.Database(str(tmp_path / "chats.db"))
+    try:
+        assert explain_calls(chats.conn, chats_plan_calls(chats)) == []
+    finally:
+        chats.close()
@@ -0,0 +1,212 @@
+# Одинаковое поведение хранилищ: MemoryStorage против Database (SQLite).
+#
+# Каждый сценарий выполняется на обоих движках; результаты после замены
+# времени и токенов на метки должны совпасть. Эталон - SQLite.
+import re
+
+import pytest
+
+from memory_storage import MemoryStorage
+from server import Database
+
+TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}")
+
+
+def normalize(value):
+    """Записи и словари - в обычные структуры, время и токены сессий - в метки"""
+    if hasattr(value, "_asdict"):
+        value = value._asdict()
+    if isinstance(value, dict):
+        return {key: "<token>" if key == "session_token" else normalize(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, str) and TIMESTAMP.match(value):
+        return "<time>"
+    return value
+
+
+def register_users(db, count=6):
+    return [db.register_user(f"user{n}", f"@user{n}", "hash", f"user{n}@example.com",
+                             f"+7900000000{n}")[1]
+            for n in range(count)]
+
+
+def scenario_users(db):
+    out = [
+        db.register_user("Новый", "new", "hash", "new@example.com"),
+        db.register_user("Дубль", "@new", "hash"),            # тэг занят (с @ и без)
+        db.register_user("Почта", "@mail", "hash", "NEW@example.com"),
+    ]
+    out.append(db.get_login_user("@new"))
+    out.append(db.get_login_user("new@example.com"))
+    out.append(db.get_login_user("Новый"))
+    out.append(db.get_login_user("@nobody"))
+    user_id = out[0][1]
+    out.append(db.get_user_by_id(user_id))
+    out.append(db.get_user_profile(user_id))
+    out.append(db.update_user_profile(user_id, username="Переименован", bio="о себе"))
+    out.append(db.update_user_profile(user_id))
+    out.append(db.get_user_profile(user_id))
+    out.append(db.search_users("ПЕРЕ", 1))
+    out.append(db.search_users("user", 1))
+    out.append(db.get_users_by_ids([user_id, 1, 999]))
+    out.append(db.get_users_for_index())
+    return out
+
+
+def scenario_sessions(db):
+    _, user = db.get_login_user("@anna")
+    user.pop("password_hash")
+    out = [db.login_user(user)]
+    token = out[0][1]["session_token"]
+    out.append(db.verify_session(token))
+    out.append(db.verify_session("нет-такого"))
+    out.append(db.next_session_expiry() is not None)
+    out.append(db.delete_expired_sessions())
+    out.append(db.verify_session(token)[0])
+    return out
+
+
+def scenario_history(db):
+    users = register_users(db, 3)
+    a, b, c = users
+    for n in range(25):
+        sender, receiver = (a, b) if n % 3 else (b, a)
+        db.save_message(sender, receiver, f"сообщение {n}")
+    db.save_message(a, c, "другой беседе")
+    out = [db.get_conversations(a), db.get_conversations(b)]
+    page, cursor = db.get_chat_history(b, a, limit=7)
+    out.append((page, cursor))
+    while cursor:
+        page, cursor = db.get_chat_history(b, a, limit=7, before_id=cursor)
+        out.append((page, cursor))
+    out.append(db.get_chat_history(a, b, limit=5, after_id=3))
+    out.append(db.get_chat_history(a, b, limit=5, after_id=1000))
+    out.append(db.get_read_marks(a, b))
+    out.append(db.get_conversations(a))
+    out.append(db.get_conversations(b))
+    out.append(db.get_chat_history(a, a))
+    return out
+
+
+def scenario_client_msg_id(db):
+    a, b = register_users(db, 2)
+    first = db.save_messages([(a, b, "раз", "c-1"), (a, b, "раз", "c-1"), (b, a, "ответ", "c-1")])
+    again = db.save_message(a, b, "раз", "c-1")
+    assert first[1][:2] == first[0][:2] and again[:2] == first[0][:2]
+    assert [saved[2] for saved in first] == [True, False, True] and again[2] is False
+    return [first, again, db.save_message(a, b, "без id"), db.get_chat_history(a, b)]
+
+
+def scenario_search(db):
+    a, b, c = register_users(db, 3)
+    words = ["яблоко", "груша", "слива"]
+    for n in range(30):
+        db.save_message(a if n % 2 else b, b if n % 2 else a,
+                        f"начало длинного текста номер {n} про {words[n % 3]} и еще много слов в конце")
+    db.save_message(a, c, "яблоко для другого")
+    out = []
+    results, cursor = db.search_messages(b, "яблоко", limit=4)
+    out.append((results, cursor))
+    while cursor:
+        results, cursor = db.search_messages(b, "яблоко", limit=4, before_id=cursor)
+        out.append((results, cursor))
+    out.append(db.search_messages(c, "ЯБЛОКО"))
+    out.append(db.search_messages(a, "груш*"))
+    out.append(db.search_messages(a, "\"  \""))
+    return out
+
+
+def scenario_moderation(db):
+    users = register_users(db, 3)
+    out = [db.ban_user(users[0], "спам", 0), db.ban_user(users[1], "флуд", 3),
+           db.mute_user(users[2], 2), db.mute_user(999, 1)]
+    out.append(db.get_user_profile(users[2]))
+    out.append(db.get_login_user("@user0"))
+    out.append(db.search_users("user", 1))
+    out.append(db.admin_search_users("user"))
+    out.append(db.get_moderation_expirations())
+    out.append(db.expire_mute(users[2]))
+    out.append(db.expire_ban(users[1]))
+    out.append(db.unban_user(users[0]))
+    out.append(db.unmute_user(users[2]))
+    out.append(db.get_user_profile(users[2]))
+    out.append(db.get_moderation_expirations())
+    return out
+
+
+def scenario_presence(db):
+    users = register_users(db, 3)
+    db.save_presence([(1, "2026-01-01 10:00:00", users[0]), (1, "2026-01-01 10:00:00", users[1]),
+                      (0, "2026-01-01 11:00:00", users[2])])
+    out = [db.get_user_by_id(users[0]), db.get_users_by_ids(users)]
+    out.append(db.reset_presence())
+    out.append(db.get_user_by_id(users[0]))
+    out.append(db.reset_presence())
+    return out
+
+
+def scenario_statistics(db):
+    a, b = register_users(db, 2)
+    for n in range(5):
+        db.save_message(a, b, f"n{n}")
+    db.ban_user(b, "", 0)
+    db.create_chat(a, "Группа", member_ids=[b])
+    totals, recent = db.load_statistics()
+    return [totals, {name: sum(count for _, count in rows) for name, rows in recent.items()}]
+
+
+def scenario_chats(db):
+    users = register_users(db, 4)
+    owner = users[0]
+    db.ban_user(users[3], "", 0)
+    out = [db.create_chat(owner, "Группа", member_ids=[users[1], users[2], owner]),
+           db.create_chat(owner, "Канал", is_channel=True),
+           db.create_chat(owner, "Чужие", member_ids=[users[1], users[3], 999])]
+    group, channel = out[0][1].id, out[1][1].id
+    db.unban_user(users[3])
+    out.append(db.join_chat(group, users[3]))
+    out.append(db.add_chat_member(group, 999))
+    out.append(db.add_chat_member(999, users[3]))
+    out.append(db.add_chat_member(group, users[1]))
+    out.append(db.join_chat(channel, users[3]))
+    out.append(db.join_chat(channel, users[3]))
+    out.append(db.join_chat(999, users[3]))
+    out.append(db.leave_chat(group, users[2]))
+    out.append(db.leave_chat(group, users[2]))
+    out.append(db.set_chat_member_muted(group, users[1], True))
+    out.append(db.set_chat_member_muted(group, users[3], True))
+    out.append(db.add_chat_member(group, users[3]))
+    for n in range(7):
+        db.save_chat_message(group if n % 2 else channel, owner, f"пост {n}")
+    out.append(db.get_chat(group))
+    out.append(db.get_chat(999))
+    out.append(db.get_user_chats(owner))
+    out.append(db.get_user_chats(users[3]))
+    page, cursor = db.get_chat_messages(channel, limit=3)
+    out.append((page, cursor))
+    out.append(db.get_chat_messages(channel, limit=3, before_id=cursor))
+    return out
+
+
+SCENARIOS = [scenario_users, scenario_sessions, scenario_history, scenario_client_msg_id,
+             scenario_search, scenario_moderation, scenario_presence, scenario_statistics,
+             scenario_chats]
+
+
+@pytest.fixture
+def engines(tmp_path):
+    sqlite = Database(str(tmp_path / "conformance.db"), archive_dir=str(tmp_path / "archive"))
+    memory = MemoryStorage()
+    yield sqlite, memory
+    sqlite.close()
+    memory.close()
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS, ids=lambda scenario: scenario.__name__[9:])
+def test_memory_matches_sqlite(engines, scenario):
+    sqlite, memory = engines
+    expected = normalize(scenario(sqlite))
+    actual = normalize(scenario(memory))
+    assert actual == expected
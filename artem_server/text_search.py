@@ -0,0 +1,128 @@
+# text_search.py - Вспомогательные функции поиска по тексту
+import re
+from array import array
+from bisect import bisect_left
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fts_query(text, column="text"):
+    """Превратить пользовательский ввод в безопасный запрос FTS5.
+
+    Каждое слово берется в кавычки (никакого синтаксиса FTS5 от клиента).
+    Префиксный поиск ("слов*") не используется: для частых префиксов FTS5
+    сливает списки всех подходящих слов, и запрос дорожает в разы.
+    Возвращает None, если в запросе нет ни одного слова.
+    """
+    words = _WORD_RE.findall(text or "")
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    return f"{column}:({' '.join(terms)})"
+
+
+class UserSearchIndex:
+    """Индекс пользователей в памяти для поиска по имени и тэгу.
+
+    Для каждой строки (username и тэг без "@") индексируются все триграммы
+    и метки начала строки ("^a", "^an") для коротких запросов.
+    Списки id хранятся отсортированными массивами - 4 байта на вхождение.
+    Поиск: берем самый короткий список, проверяем кандидатов подстрокой,
+    совпадения с начала строки идут первыми.
+    """
+
+    def __init__(self):
+        self.users = {}     # user_id -> (username, tag, is_blocked)
+        self.postings = {}  # грамма -> array('I') отсортированных user_id
+
+    @staticmethod
+    def _keys(username, tag):
+        keys = set()
+        for value in (username.lower(), tag.lower().lstrip("@")):
+            keys.add("^" + value[:1])
+            keys.add("^" + value[:2])
+            for i in range(len(value) - 2):
+                keys.add(value[i:i + 3])
+        return keys
+
+    def _add_keys(self, user_id, keys):
+        for key in keys:
+            ids = self.postings.get(key)
+            if ids is None:
+                self.postings[key] = array("I", (user_id,))
+            elif not ids or ids[-1] < user_id:
+                ids.append(user_id)  # обычный случай: новые id растут
+            else:
+                i = bisect_left(ids, user_id)
+                if i == len(ids) or ids[i] != user_id:
+                    ids.insert(i, user_id)
+
+    def _remove_keys(self, user_id, keys):
+        for key in keys:
+            ids = self.postings.get(key)
+            if ids is None:
+                continue
+            i = bisect_left(ids, user_id)
+            if i < len(ids) and ids[i] == user_id:
+                del ids[i]
+                if not ids:
+                    del self.postings[key]
+
+    def load(self, rows):
+        """Построить индекс по строкам (id, username, tag, is_blocked)"""
+        self.users.clear()
+        self.postings.clear()
+        for user_id, username, tag, is_blocked in sorted(rows):
+            self.add(user_id, username, tag, is_blocked)
+
+    def add(self, user_id, username, tag, is_blocked=False):
+        if user_id in self.users:
+            self.remove(user_id)
+        self.users[user_id] = (username, tag, bool(is_blocked))
+        self._add_keys(user_id, self._keys(username, tag))
+
+    def remove(self, user_id):
+        user = self.users.pop(user_id, None)
+        if user:
+            self._remove_keys(user_id, self._keys(user[0], user[1]))
+
+    def rename(self, user_id, username):
+        user = self.users.get(user_id)
+        if user and user[0] != username:
+            self.add(user_id, username, user[1], user[2])
+
+    def set_blocked(self, user_id, is_blocked):
+        user = self.users.get(user_id)
+        if user:
+            self.users[user_id] = (user[0], user[1], bool(is_blocked))
+
+    def search(self, query, exclude_id=None, limit=20):
+        """id подходящих незаблокированных пользователей, сначала совпадения с начала"""
+        q = (query or "").strip().lower()
+        if q.startswith("@"):
+            q = q[1:]
+
+        if not q:
+            # Пустой запрос - просто первые пользователи, как раньше LIMIT 20
+            candidates = self.users
+        elif len(q) < 3:
+            # Короткий запрос ищется только с начала имени или тэга
+            candidates = self.postings.get("^" + q, ())
+        else:
+            lists = [self.postings.get(q[i:i + 3], ()) for i in range(len(q) - 2)]
+            candidates = min(lists, key=len)
+
+        prefix, substring = [], []
+        for user_id in candidates:
+            username, tag, is_blocked = self.users[user_id]
+            if is_blocked or user_id == exclude_id:
+                continue
+            name, tag = username.lower(), tag.lower().lstrip("@")
+            if name.startswith(q) or tag.startswith(q):
+                prefix.append(user_id)
+                if len(prefix) >= limit:
+                    break
+            elif len(substring) < limit and (q in name or q in tag):
+                substring.append(user_id)
+
+        return (prefix + substring)[:limit]